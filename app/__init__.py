@@ -9,11 +9,15 @@ app.config.from_object(settings)
 app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=1)
 api = restful.Api(app)
 app.cache = Cache(app, config={'CACHE_TYPE': settings.value.CACHE_TYPE})
+# Turned off while the cache warms up, see services.warmup.Warmer.
+app.ready = True
 
 
 @app.route('/healthcheck')
 def healthcheck():
-    # The healthcheck returns status code 200
+    # The healthcheck returns status code 200, 503 while warming up
+    if not app.ready:
+        return 'Warming up', 503
     return 'OK'
 
 from . import routes  # noqa
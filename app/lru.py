@@ -19,6 +19,12 @@ class LRUCache(object):
         self.cache[key] = value
         return value
 
+    def __delitem__(self, key):
+        del self.cache[key]
+
+    def __len__(self):
+        return len(self.cache)
+
     def __setitem__(self, key, value):
         try:
             self.cache.pop(key)
@@ -26,3 +32,44 @@ class LRUCache(object):
             if len(self.cache) >= self.capacity:
                 self.cache.popitem(last=False)
         self.cache[key] = value
+
+
+class SizedLRUCache(LRUCache):
+    """LRU cache bounded by the total size of its values rather than by their number.
+
+    Least recently used values are evicted until a new value fits, values larger than the
+    whole budget are not kept at all.
+    """
+
+    def __init__(self, max_size, sizeof):
+        """
+        :param max_size: maximum total size of the values
+        :param sizeof: called with a value to get its size
+
+        :type max_size: int
+        :type sizeof: callable
+        """
+        super(SizedLRUCache, self).__init__(capacity=None)
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.sizes = {}
+        self.evictions = 0
+
+    def __delitem__(self, key):
+        del self.cache[key]
+        self.size -= self.sizes.pop(key)
+
+    def __setitem__(self, key, value):
+        if key in self.cache:
+            del self[key]
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            oldest, _ = self.cache.popitem(last=False)
+            self.size -= self.sizes.pop(oldest)
+            self.evictions += 1
+        self.cache[key] = value
+        self.sizes[key] = size
+        self.size += size
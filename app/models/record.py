@@ -0,0 +1,149 @@
+FIELDS = ('service', 'ip_address', 'service_repo_name', 'port', 'revision', 'last_check_in', 'tags')
+
+# Tags whose names and values are shared by many hosts and take few distinct values, interned.
+INTERNED_TAGS = ('az', 'region')
+
+# Values of the canary tag marking a host as canary, as sent by registrations.
+CANARY_VALUES = (True, 1, 'true', 'True', '1')
+
+_strings = {}
+
+
+def intern_string(value):
+    """Returns the single shared copy of the given string.
+
+    Only meant for strings with few distinct values, e.g. services or availability zones, the
+    shared copies are never released. Revisions, tag names and other tags are not interned, as
+    they take new values over time.
+
+    :param value: string to intern, None is passed through
+    :type value: str
+
+    :returns: the shared copy of the string
+    :rtype: str
+    """
+    if value is None:
+        return None
+    return _strings.setdefault(value, value)
+
+
+def _intern_tags(tags):
+    _tags = {}
+    for name, value in (tags or {}).items():
+        if name in INTERNED_TAGS:
+            name = intern_string(name)
+            if isinstance(value, type(name)):
+                value = intern_string(value)
+        _tags[name] = value
+    return _tags
+
+
+class HostRecord(object):
+    """An immutable host, as stored by the query backends and held by the caches.
+
+    Hosts are kept in slots rather than dicts to keep tens of thousands of them cheap, with
+    the service, service_repo_name, az and region interned. Being immutable, records are
+    shared between backends and caches instead of copied; replace and with_tags return
+    modified copies. The tags dict is owned by the record and must not be modified.
+
+    Hosts only become dicts at the API edge, see to_dict.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, service, ip_address, service_repo_name, port, revision, last_check_in, tags):
+        """
+        :param service: the service name of the host
+        :param ip_address: the ip address of the host
+        :param service_repo_name: the repo of the service, None or empty if unknown
+        :param port: the port of the host
+        :param revision: the revision of the host
+        :param last_check_in: the last check in
+        :param tags: metadata associated with the host, copied
+
+        :type service: str
+        :type ip_address: str
+        :type service_repo_name: str
+        :type port: int
+        :type revision: str
+        :type last_check_in: datetime
+        :type tags: dict
+        """
+        _set = object.__setattr__
+        _set(self, 'service', intern_string(service))
+        _set(self, 'ip_address', ip_address)
+        _set(self, 'service_repo_name', intern_string(service_repo_name))
+        _set(self, 'port', port)
+        _set(self, 'revision', revision)
+        _set(self, 'last_check_in', last_check_in)
+        _set(self, 'tags', _intern_tags(tags))
+
+    @classmethod
+    def from_dict(cls, host):
+        """Builds a record from a host dict, as stored by earlier versions or returned by plugins.
+
+        :param host: dict with host info
+        :type host: dict
+
+        :returns: the record
+        :rtype: HostRecord
+        """
+        return cls(*[host[field] for field in FIELDS])
+
+    def to_dict(self):
+        """Returns the host as a new dict, for the API edge.
+
+        :returns: dictionary with host info
+        :rtype: dict
+        """
+        host = dict((field, getattr(self, field)) for field in FIELDS)
+        host['tags'] = dict(self.tags)
+        return host
+
+    def replace(self, **fields):
+        """Returns a copy of the record with the given fields replaced.
+
+        :returns: the new record
+        :rtype: HostRecord
+        """
+        values = dict((field, getattr(self, field)) for field in FIELDS)
+        values.update(fields)
+        return HostRecord(**values)
+
+    def with_tags(self, tags):
+        """Returns a copy of the record with the given tags added, or replacing its own.
+
+        :param tags: tags to set
+        :type tags: dict
+
+        :returns: the new record
+        :rtype: HostRecord
+        """
+        _tags = dict(self.tags)
+        _tags.update(tags)
+        return self.replace(tags=_tags)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("HostRecord is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("HostRecord is immutable")
+
+    def __reduce__(self):
+        return (HostRecord, tuple(getattr(self, field) for field in FIELDS))
+
+    def __eq__(self, other):
+        if not isinstance(other, HostRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in FIELDS)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'HostRecord(%s)' % ', '.join('%s=%r' % (field, getattr(self, field)) for field in FIELDS)
@@ -4,13 +4,15 @@ from datetime import datetime
 import os
 import importlib
 
-from flask import request
+from flask import request, Response
 from flask.ext.restful import Resource
 
 from ..stats import get_stats
 from .. import settings
 from ..services import host
 from ..services import query
+from ..services.eds import EdsSerializer
+from ..services.serializer import HostSerializer
 
 logger = logging.getLogger('resources.api')
 logging.basicConfig(level=logging.DEBUG,
@@ -53,11 +55,20 @@ class BackendSelector(object):
         """
 
         if self.storage == 'DynamoDB':
-            return query.DynamoQueryBackend()
+            backend = query.DynamoQueryBackend(scan_segments=settings.value.DYNAMODB_SCAN_SEGMENTS)
+            if settings.value.DYNAMODB_WRITE_BEHIND_INTERVAL:
+                backend.write_buffer = query.WriteBuffer(
+                    backend.write_hosts,
+                    interval=settings.value.DYNAMODB_WRITE_BEHIND_INTERVAL,
+                    batch_size=settings.value.DYNAMODB_WRITE_BEHIND_BATCH_SIZE,
+                    max_pending=settings.value.DYNAMODB_WRITE_BEHIND_MAX_PENDING)
+            return backend
         elif self.storage == 'InMemory':
             return query.MemoryQueryBackend()
         elif self.storage == 'InFile':
             return query.LocalFileQueryBackend()
+        elif self.storage == 'MappedFile':
+            return query.MappedFileQueryBackend(settings.value.MAPPED_FILE)
         elif self.plugins_exist():
             # import the query backend starting from the plugins folder
             query_location_from_plugins = self.assemble_plugin_backend_location()
@@ -65,7 +76,7 @@ class BackendSelector(object):
             query_backend = self.get_query_plugin_from_location_and_name(
                 query_location_from_plugins, backend_name)
 
-            return query_backend
+            return query.PluginQueryBackend(query_backend)
 
         else:
             raise ValueError('Unknown backend storage type specified: {}'.format(self.storage))
@@ -73,40 +84,163 @@ class BackendSelector(object):
 
 # Run this to make sure that BACKEND_STORAGE is of known type.
 BACKEND_STORAGE = BackendSelector().select()
+if settings.value.HEARTBEAT_WRITE_FRACTION:
+    BACKEND_STORAGE = query.CoalescingQueryBackend(
+        BACKEND_STORAGE,
+        max_age=settings.value.HEARTBEAT_WRITE_FRACTION * settings.value.HOST_TTL,
+        capacity=settings.value.HEARTBEAT_TRACKED_HOSTS)
+
+
+def encoded_response(entry):
+    """Writes the pre-encoded body of a cache entry to a response, gzipped if the client accepts it.
+
+    The entry version is sent as ETag, and an empty 304 is returned if the client already
+    has that version (If-None-Match).
+
+    The body is passed on as a single chunk, so that a memoryview over a shared cache
+    entry is written out without being copied.
+
+    :param entry: cache entry holding the encoded body
+    :type entry: cache.CacheEntry
+
+    :returns: the response
+    :rtype: flask.Response
+    """
+
+    # The ETag is weak since the same version is served both gzipped and not.
+    if request.if_none_match.contains_weak(entry.version):
+        response = Response(status=304)
+    else:
+        gzipped = 'gzip' in request.accept_encodings
+        body = entry.gzip_body if gzipped else entry.body
+        response = Response([body], mimetype='application/json')
+        response.content_length = len(body)
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(entry.version, weak=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def bulk_response(entries):
+    """Writes the pre-encoded bodies of many cache entries to a single response, gzipped if the client accepts it.
+
+    :param entries: service and cache entry pairs, in response order
+    :type entries: list(tuple(str, cache.CacheEntry))
+
+    :returns: the response
+    :rtype: flask.Response
+    """
+
+    parts = [b'{"services": {']
+    for i, (service, entry) in enumerate(entries):
+        if i:
+            parts.append(b', ')
+        parts.extend([json.dumps(service).encode('utf-8'),
+                      b': {"version": ', json.dumps(entry.version).encode('utf-8'),
+                      b', "registration": ', entry.body, b'}'])
+    parts.append(b'}}')
+    body = b''.join(parts)
+    if 'gzip' in request.accept_encodings:
+        response = Response(HostSerializer.compress(body), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def delta_response(service, since, entry, delta):
+    """Writes the changes of a host list since a version to a response, gzipped if the client accepts it.
+
+    :param service: the service of the host list
+    :param since: version the changes are from
+    :param entry: cache entry holding the current host list
+    :param delta: the changes
+
+    :type service: str
+    :type since: str
+    :type entry: cache.CacheEntry
+    :type delta: changes.Delta
+
+    :returns: the response
+    :rtype: flask.Response
+    """
+
+    if request.if_none_match.contains_weak(entry.version):
+        response = Response(status=304)
+    else:
+        body = HostSerializer.encode({
+            'service': service,
+            'env': settings.value.APPLICATION_ENV,
+            'since': since,
+            'version': entry.version,
+            'added': HostSerializer.serialize(delta.added),
+            'updated': HostSerializer.serialize(delta.updated),
+            'removed': [host.ip_address for host in delta.removed],
+        })
+        if 'gzip' in request.accept_encodings:
+            response = Response(HostSerializer.compress(body), mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(body, mimetype='application/json')
+    response.set_etag(entry.version, weak=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def host_filters(args):
+    """Reads the host filters of a request, see index.HostIndex.select.
+
+    :param args: the request parameters
+    :type args: werkzeug.datastructures.MultiDict
+
+    :returns: (field, value) pairs, sorted by field
+    :rtype: tuple(tuple)
+
+    :raises ValueError: when a filter value is invalid
+    """
+
+    filters = []
+    for field in ('az', 'region', 'revision'):
+        if args.get(field):
+            filters.append((field, args[field]))
+    canary = args.get('canary')
+    if canary:
+        if canary.lower() not in ('true', 'false'):
+            raise ValueError("Invalid canary. Supply true or false.")
+        filters.append(('canary', canary.lower() == 'true'))
+    min_weight = args.get('min_weight')
+    if min_weight:
+        try:
+            filters.append(('min_weight', int(min_weight)))
+        except ValueError:
+            raise ValueError("Invalid min_weight. Supply an integer.")
+    return tuple(sorted(filters))
 
 
-class HostSerializer(object):
-
-    @staticmethod
-    def serialize(hosts):
-        """Makes host dictionary serializable
+class Registration(Resource):
 
-        :param hosts: list of hosts, each host is defined by dict host info
-        :type hosts: dict
+    def get(self, service):
+        """Return the hosts registered for this service, only the ones matching the filters if any
 
-        :returns: list of host info dictionaries
-        :rtype: list of dict
+        With since, only the hosts changed since that version are returned, unless they are not
+        known anymore. Filtered host lists are always returned in full.
         """
 
-        for _host in hosts:
-            _host['last_check_in'] = str(_host['last_check_in'])
-
-        return hosts
-
-
-class Registration(Resource):
-
-    def get(self, service):
-        """Return all the hosts registered for this service"""
+        try:
+            filters = host_filters(request.args)
+        except ValueError as ex:
+            return {"error": str(ex)}, 400
 
         host_service = host.HostService(BACKEND_STORAGE)
-        hosts = host_service.list(service)
-        response = {
-            'service': service,
-            'env': settings.value.APPLICATION_ENV,
-            'hosts': HostSerializer.serialize(hosts)
-        }
-        return response, 200
+        since = request.args.get('since')
+        if since and not filters:
+            entry, delta = host_service.list_delta(service, since)
+            if delta is not None:
+                return delta_response(service, since, entry, delta)
+            return encoded_response(entry)
+        return encoded_response(host_service.list_entry(service, filters))
 
     def post(self, service):
         """Update or add a service registration given the host information in this request"""
@@ -168,19 +302,128 @@ class Registration(Resource):
         return request.form[param] if param in request.form else default
 
 
+class RegistrationBatch(Resource):
+
+    def get(self):
+        """Return the hosts registered for many services, leaving out the ones the caller already has"""
+
+        services = []
+        for service in request.args.getlist('service'):
+            if service and service not in services:
+                services.append(service)
+        if not services:
+            return {"error": "Required parameter 'service' is missing."}, 400
+
+        host_service = host.HostService(BACKEND_STORAGE)
+        entries = host_service.list_entries(services)
+        return bulk_response([(service, entries[service]) for service in services
+                              if entries[service].version != request.args.get('version.' + service)])
+
+    def post(self):
+        """Update or add the service registrations of many hosts given as a JSON array"""
+
+        registrations = request.get_json(force=True, silent=True)
+        if not isinstance(registrations, list):
+            return {"error": "Supply a JSON array of registrations."}, 400
+
+        last_check_in = datetime.utcnow()
+        params = []
+        for registration in registrations:
+            if not isinstance(registration, dict):
+                registration = {}
+            params.append({
+                'service': registration.get('service'),
+                'ip_address': registration.get('ip'),
+                'service_repo_name': registration.get('service_repo_name', ''),
+                'port': registration.get('port'),
+                'revision': registration.get('revision'),
+                'last_check_in': last_check_in,
+                'tags': registration.get('tags', {}),
+            })
+
+        host_service = host.HostService(BACKEND_STORAGE)
+        errors = host_service.update_many(params)
+
+        statsd = get_stats("registration")
+        results = []
+        for param, error in zip(params, errors):
+            result = {'service': param['service'], 'ip': param['ip_address']}
+            if error is None:
+                result['status'] = 200
+                statsd.incr("%s.success" % param['service'])
+            else:
+                # Hosts which could not be stored may be registered again, invalid ones may not.
+                result['status'] = 503 if error == host.STORE_FAILED else 400
+                result['error'] = error
+                statsd.incr("%s.failure" % param['service'])
+            results.append(result)
+        return {'results': results}, 200
+
+
+class RegistrationWatch(Resource):
+
+    def get(self, service):
+        """Return the hosts registered for this service once they differ from the given version"""
+
+        version = request.args.get('version')
+        try:
+            timeout = float(request.args.get('timeout', settings.value.WATCH_TIMEOUT))
+        except ValueError:
+            return {"error": "Invalid timeout. Supply a number of seconds."}, 400
+        timeout = min(max(timeout, 0), settings.value.WATCH_TIMEOUT)
+
+        host_service = host.HostService(BACKEND_STORAGE)
+        entry = host_service.watch(service, version, timeout)
+        if entry.version == version:
+            response = Response(status=304)
+            response.set_etag(entry.version, weak=True)
+            return response
+        return encoded_response(entry)
+
+
+class EndpointDiscovery(Resource):
+
+    def post(self):
+        """Return the ClusterLoadAssignments of the requested services, Envoy v2 REST EDS
+
+        Requests acknowledging the current version, or rejecting it, are held for up to
+        EDS_WATCH_TIMEOUT seconds waiting for the hosts to change, see HostService.watch_many.
+        """
+
+        discovery_request = request.get_json(force=True, silent=True)
+        if not isinstance(discovery_request, dict):
+            return {"error": "Supply a JSON DiscoveryRequest."}, 400
+        services = []
+        for service in discovery_request.get('resource_names') or []:
+            if service and service not in services:
+                services.append(service)
+        if not services:
+            return {"error": "Required field 'resource_names' is missing."}, 400
+
+        node = (discovery_request.get('node') or {}).get('id')
+        statsd = get_stats("eds")
+        version = discovery_request.get('version_info')
+        if discovery_request.get('error_detail'):
+            # The nonce of a response is its version, the rejected one is held like an acknowledged one.
+            version = discovery_request.get('response_nonce')
+            logger.warn('msg="eds nack" node={} version={} error={}'
+                        .format(node, version, discovery_request['error_detail'].get('message')))
+            statsd.incr("nack")
+        elif version:
+            statsd.incr("ack")
+
+        host_service = host.HostService(BACKEND_STORAGE)
+        entries = host_service.watch_many(services, version, settings.value.EDS_WATCH_TIMEOUT)
+        return EdsSerializer.discovery_response(services, entries, host_service.entries_version(entries)), 200
+
+
 class RepoRegistration(Resource):
 
     def get(self, service_repo_name):
         """Return all the hosts that belong to the service_repo_name"""
 
         host_service = host.HostService(BACKEND_STORAGE)
-        hosts = host_service.list_by_service_repo_name(service_repo_name)
-        response = {
-            'service_repo_name': service_repo_name,
-            'env': settings.value.APPLICATION_ENV,
-            'hosts': HostSerializer.serialize(hosts)
-        }
-        return response, 200
+        return encoded_response(host_service.list_entry_by_service_repo_name(service_repo_name))
 
 
 class LoadBalancing(Resource):
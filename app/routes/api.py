@@ -1,10 +1,14 @@
 from .. import api
-from ..resources.api import Registration, RepoRegistration, LoadBalancing
+from ..resources.api import (Registration, RegistrationBatch, RegistrationWatch, RepoRegistration, LoadBalancing,
+                             EndpointDiscovery)
 
 api.add_resource(Registration,
                  '/v1/registration/<service>',
                  '/v1/registration/<service>/<ip_address>')
+api.add_resource(RegistrationBatch, '/v1/registration')
+api.add_resource(RegistrationWatch, '/v1/registration/<service>/watch')
 api.add_resource(RepoRegistration, '/v1/registration/repo/<service_repo_name>')
 api.add_resource(LoadBalancing,
                  '/v1/loadbalancing/<service>',
                  '/v1/loadbalancing/<service>/<ip_address>')
+api.add_resource(EndpointDiscovery, '/v2/discovery:endpoints')
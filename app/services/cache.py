@@ -0,0 +1,688 @@
+import collections
+import contextlib
+import gevent
+import hashlib
+import json
+import logging
+import math
+import time
+
+from flask import current_app as app
+
+from . import changes
+from .index import HostIndex
+from .serializer import HostSerializer
+from .shared_cache import SharedCacheStore
+from ..lru import LRUCache, SizedLRUCache
+from ..singleflight import SingleFlight
+from ..stats import get_stats
+from .. import settings
+
+
+# Returned by HostListCache.get when nothing is cached, as an empty host list is a valid hit.
+MISS = object()
+
+
+class CacheEntry(object):
+    """A cached host list along with its final response body.
+
+    The body is JSON encoded (and gzipped) once when the entry is built, so that cache hits
+    can be written to the response as is. The version is a hash of the hosts without their
+    last_check_in, see host_list_version. The hosts are indexed by tags for filtered reads,
+    see view.
+    """
+
+    def __init__(self, namespace, name, hosts, refresh_at=None, expires_at=None, indexed=True):
+        """
+        :param namespace: the field holding the name in the response, e.g. service
+        :param name: name the hosts are cached under
+        :param hosts: the cached hosts
+        :param refresh_at: epoch after which the entry should be refreshed in the background
+        :param expires_at: epoch after which the entry is dropped from the cache
+        :param indexed: whether to index the hosts, filtered views are not filtered further
+
+        :type namespace: str
+        :type name: str
+        :type hosts: list(HostRecord)
+        :type refresh_at: float
+        :type expires_at: float
+        :type indexed: bool
+        """
+        self.hosts = hosts
+        self.refresh_at = refresh_at
+        self.expires_at = expires_at
+        self.index = HostIndex(hosts) if indexed else None
+        self.body = HostSerializer.encode({
+            namespace: name,
+            'env': settings.value.APPLICATION_ENV,
+            'hosts': HostSerializer.serialize(hosts),
+        })
+        self.gzip_body = HostSerializer.compress(self.body)
+        self.version = host_list_version(namespace, name, hosts)
+
+
+def host_list_version(namespace, name, hosts):
+    """Returns the version of a host list, the same in every process for the same hosts.
+
+    Heartbeats only moving last_check_in forward, and the order of the hosts, do not change it.
+
+    :param namespace: the field holding the name in the response, e.g. service
+    :param name: name the hosts are cached under
+    :param hosts: the hosts
+
+    :type namespace: str
+    :type name: str
+    :type hosts: list(HostRecord)
+
+    :returns: hash of the hosts
+    :rtype: str
+    """
+    versioned = sorted(([host.service, host.ip_address, host.service_repo_name or '', host.port, host.revision,
+                         host.tags] for host in hosts), key=lambda versioned_host: versioned_host[:2])
+    payload = json.dumps([namespace, name, versioned], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class FlaskCacheStore(object):
+    """Keeps cache entries in the flask cache, which is private to each process."""
+
+    def get(self, key):
+        return app.cache.get(key)
+
+    def peek(self, key):
+        return app.cache.get(key)
+
+    def set(self, key, entry, timeout):
+        app.cache.set(key, entry, timeout)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        # Loads within a process are already coalesced by HostListCache.
+        yield True
+
+
+class MemoryCacheStore(object):
+    """Keeps cache entries in this process, within a memory budget.
+
+    Least recently used entries are evicted once the entries would take more than max_bytes.
+    The size of an entry is its encoded bodies plus its hosts, which are estimated to take
+    as much as the JSON body. Entries are not copied in and out of the store.
+
+    Filtered views of the entries are kept within the same budget, see get_view.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: memory budget of the entries
+        :type max_bytes: int
+        """
+        self.entries = SizedLRUCache(max_bytes, self._sizeof)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(value):
+        entry, _ = value
+        return 2 * len(entry.body) + len(entry.gzip_body)
+
+    def get(self, key):
+        statsd = get_stats('service.host')
+        if key in self.entries:
+            entry, expires_at = self.entries[key]
+            if expires_at > time.time():
+                self.hits += 1
+                statsd.incr('cache.memory.hit')
+                return entry
+            del self.entries[key]
+        self.misses += 1
+        statsd.incr('cache.memory.miss')
+        return None
+
+    def peek(self, key):
+        """Returns the entry stored under the given key, without counting a hit or a miss.
+
+        :param key: cache key
+        :type key: str
+
+        :returns: the stored entry, None if there is none or it expired
+        :rtype: CacheEntry
+        """
+        if key in self.entries.cache:
+            entry, expires_at = self.entries.cache[key]
+            if expires_at > time.time():
+                return entry
+        return None
+
+    def set(self, key, entry, timeout):
+        self._put(key, (entry, time.time() + timeout))
+
+    def get_view(self, key):
+        """Returns the filtered view stored under the given key.
+
+        :param key: view key, see HostListCache.view
+        :type key: tuple
+
+        :returns: the stored view, None if there is none or its entry expired
+        :rtype: CacheEntry
+        """
+        if key in self.entries:
+            view, expires_at = self.entries[key]
+            if expires_at > time.time():
+                return view
+            del self.entries[key]
+        return None
+
+    def set_view(self, key, view, expires_at):
+        """Stores a filtered view until its entry expires, evicting entries and views to fit it.
+
+        :param key: view key, see HostListCache.view
+        :param view: the filtered view
+        :param expires_at: epoch at which the filtered entry expires
+
+        :type key: tuple
+        :type view: CacheEntry
+        :type expires_at: float
+        """
+        self._put(key, (view, expires_at))
+
+    def _put(self, key, value):
+        evictions = self.entries.evictions
+        self.entries[key] = value
+        statsd = get_stats('service.host')
+        if self.entries.evictions > evictions:
+            statsd.incr('cache.memory.eviction', self.entries.evictions - evictions)
+        statsd.gauge('cache.memory.bytes', self.entries.size)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        # Loads within a process are already coalesced by HostListCache.
+        yield True
+
+
+class ViewCache(object):
+    """Keeps the last CACHE_FILTERED_VIEWS filtered views in this process, for stores keeping entries elsewhere."""
+
+    def __init__(self, capacity):
+        """
+        :param capacity: number of views kept
+        :type capacity: int
+        """
+        self.views = LRUCache(capacity)
+
+    def get_view(self, key):
+        if key in self.views:
+            return self.views[key]
+        return None
+
+    def set_view(self, key, view, expires_at):
+        self.views[key] = view
+
+
+class HostListCache(object):
+    """Caches host lists in a store under a key namespace.
+
+    Non-empty host lists are kept for CACHE_TTL seconds, empty ones for CACHE_NEGATIVE_TTL
+    seconds. Concurrent misses for the same name are coalesced into a single load, and
+    entries past CACHE_SOFT_TTL are refreshed in the background while still being served.
+    With a SharedCacheStore, loads are also coalesced across the processes of the node.
+
+    Writes made through this process are applied to the cached entries in batches, see apply.
+    With a change log, the changes between the entries replaced by this process are kept for
+    delta responses, see delta. With a change hub, watchers are notified whenever this process
+    replaces an entry with a new version.
+    """
+
+    def __init__(self, namespace, store, change_log=None, hub=None):
+        """
+        :param namespace: prefix of the cache keys, keeps lookups of different kinds apart.
+                          Also names the field of the response body holding the name.
+        :param store: keeps the entries, either MemoryCacheStore, FlaskCacheStore or SharedCacheStore
+        :param change_log: logs the changes of the entries, None to not log them
+        :param hub: notified of the names whose entry changes version, None to not notify
+
+        :type namespace: str
+        :type store: FlaskCacheStore
+        :type change_log: changes.ChangeLog
+        :type hub: changes.ChangeHub
+        """
+        self.namespace = namespace
+        self.store = store
+        self.change_log = change_log
+        self.hub = hub
+        self.flight = SingleFlight()
+        # Names whose stale entry is currently being refreshed in the background.
+        self.refreshing = set()
+        # (namespace, name, entry version, filters) -> filtered view of the entry, MemoryCacheStore
+        # keeps them within its memory budget.
+        if isinstance(store, MemoryCacheStore):
+            self.views = store
+        else:
+            self.views = ViewCache(settings.value.CACHE_FILTERED_VIEWS)
+        # name -> writes not applied to its entry yet, (service, ip_address) -> host, None if deleted.
+        self.pending = {}
+        # name -> writes applied during each running load of its hosts.
+        self.loading = {}
+
+    def _key(self, name):
+        return '%s:%s' % (self.namespace, name)
+
+    def get(self, name):
+        """Returns the cached entry for the given name.
+
+        Pending writes are applied to the entry first, unless another process holds its store lock.
+
+        :param name: name the hosts were cached under
+        :type name: str
+
+        :returns: the cached entry, MISS if there is none
+        :rtype: CacheEntry
+        """
+        if name in self.pending:
+            self._apply_pending(name, blocking=False)
+        return self._get(name)
+
+    def _get(self, name):
+        entry = self.store.get(self._key(name))
+        if entry is None:
+            return MISS
+        return entry
+
+    def set(self, name, hosts):
+        """Caches the given hosts.
+
+        :param name: name to cache the hosts under
+        :param hosts: hosts to cache
+
+        :type name: str
+        :type hosts: list(HostRecord)
+
+        :returns: the new entry
+        :rtype: CacheEntry
+        """
+        now = time.time()
+        if hosts:
+            expires_at = now + settings.value.CACHE_TTL
+            refresh_at = None
+            if settings.value.CACHE_SOFT_TTL:
+                refresh_at = now + settings.value.CACHE_SOFT_TTL
+        else:
+            expires_at = now + settings.value.CACHE_NEGATIVE_TTL
+            refresh_at = None
+        previous = MISS
+        if self.change_log is not None or self.hub is not None:
+            # Not a cache read, kept out of the hit and miss counts.
+            previous = self.store.peek(self._key(name))
+            if previous is None:
+                previous = MISS
+        # Writes still pending were stored before the hosts were read, or applied to them, see apply.
+        self.pending.pop(name, None)
+        return self._set(name, hosts, refresh_at, expires_at, previous)
+
+    def _set(self, name, hosts, refresh_at, expires_at, previous=MISS):
+        entry = CacheEntry(self.namespace, name, hosts, refresh_at, expires_at)
+        changed = previous is not MISS and previous.version != entry.version
+        if self.change_log is not None and changed:
+            self.change_log.record(name, previous, entry)
+        # Whole seconds, as some flask cache backends take no fractions. 0 would never expire.
+        timeout = max(int(math.ceil(expires_at - time.time())), 1)
+        self.store.set(self._key(name), entry, timeout)
+        if self.hub is not None and changed:
+            self.hub.notify(name)
+        return entry
+
+    def apply(self, name, hosts=(), deleted=()):
+        """Applies writes to the entry cached under the given name, when there is one.
+
+        Hosts replace the cached hosts with the same service and ip_address, or are added to the
+        entry. The version changes along with the hosts. The entry keeps its refresh and expiry
+        times, so that it still catches up with writes made through other discovery instances.
+
+        Writes are batched: they are applied by the next read of the entry, or once the current
+        greenlet yields, so that a burst of writes re-encodes the entry once rather than once per
+        write. Writes made while the hosts are being loaded are applied to the loaded hosts too,
+        as the load may have read the backend before them.
+
+        :param name: name the hosts are cached under
+        :param hosts: hosts as now stored
+        :param deleted: service and ip_address of each deleted host
+
+        :type name: str
+        :type hosts: list(HostRecord)
+        :type deleted: list(tuple)
+        """
+        writes = collections.OrderedDict(((host.service, host.ip_address), host) for host in hosts)
+        writes.update((key, None) for key in deleted)
+        for loaded_writes in self.loading.get(name, ()):
+            loaded_writes.update(writes)
+        pending = self.pending.get(name)
+        if pending is not None:
+            pending.update(writes)
+            return
+        self.pending[name] = writes
+        flask_app = app._get_current_object()
+
+        def apply_pending():
+            try:
+                with flask_app.app_context():
+                    self._apply_pending(name, writes)
+            except Exception:
+                logging.exception("Applying writes failed for %s %s" % (self.namespace, name))
+
+        gevent.spawn(apply_pending)
+
+    def _apply_pending(self, name, writes=None, blocking=True):
+        """Applies the pending writes to the entry cached under the given name.
+
+        :param name: name the hosts are cached under
+        :param writes: only apply the pending writes if they are still these ones
+        :param blocking: whether to wait for the store lock when another process holds it
+
+        :type name: str
+        :type writes: dict
+        :type blocking: bool
+        """
+        with self.store.lock(self._key(name), blocking) as acquired:
+            if not acquired or name not in self.pending:
+                return
+            if writes is not None and writes is not self.pending[name]:
+                # applied by a read meanwhile
+                return
+            writes = self.pending.pop(name)
+            entry = self._get(name)
+            if entry is MISS:
+                return
+            updated = _merge(entry.hosts, writes)
+            expires_at = entry.expires_at
+            refresh_at = entry.refresh_at
+            if not updated:
+                expires_at = min(expires_at, time.time() + settings.value.CACHE_NEGATIVE_TTL)
+                refresh_at = None
+            self._set(name, updated, refresh_at, expires_at, entry)
+
+    @contextlib.contextmanager
+    def _recording_writes(self, names):
+        """Records the writes applied to the given names meanwhile, see apply.
+
+        :returns: context manager yielding name -> writes
+        """
+        recorded = dict((name, collections.OrderedDict()) for name in names)
+        for name, writes in recorded.items():
+            self.loading.setdefault(name, []).append(writes)
+        try:
+            yield recorded
+        finally:
+            for name, writes in recorded.items():
+                loading = [other for other in self.loading[name] if other is not writes]
+                if loading:
+                    self.loading[name] = loading
+                else:
+                    del self.loading[name]
+
+    def get_or_load(self, name, load):
+        """Returns the cache entry for the given name, loading the hosts on a miss.
+
+        :param name: name the hosts are cached under
+        :param load: called with the name to fetch the hosts from the backend
+
+        :type name: str
+        :type load: callable
+
+        :returns: the entry cached under the given name
+        :rtype: CacheEntry
+        """
+        entry = self.get(name)
+        if entry is not MISS:
+            if self._is_stale(entry):
+                self._refresh_in_background(name, load)
+            return entry
+
+        entry, shared = self.flight.do(name, self._fill, name, load)
+        if shared:
+            get_stats('service.host').incr("cache.%s.coalesced.%s" % (self.namespace, name))
+        return entry
+
+    def get_or_load_many(self, names, load_many):
+        """Returns the cache entries for the given names, loading the missing ones with a single call.
+
+        Misses already being loaded are waited for rather than loaded again, as are misses
+        another process holds the store lock of.
+
+        :param names: names the hosts are cached under
+        :param load_many: called with a list of names to fetch their hosts from the backend,
+                          returns name -> hosts
+
+        :type names: list(str)
+        :type load_many: callable
+
+        :returns: name -> entry cached under that name
+        :rtype: dict
+        """
+        load = _load_one(load_many)
+        entries = {}
+        misses = []
+        for name in set(names):
+            entry = self.get(name)
+            if entry is MISS:
+                misses.append(name)
+                continue
+            if self._is_stale(entry):
+                self._refresh_in_background(name, load)
+            entries[name] = entry
+
+        if misses:
+            entries.update(self.flight.do_many(misses, self._fill_many, load_many))
+        return entries
+
+    def reload(self, name, load):
+        """Loads the hosts for the given name into the cache, whether cached or not.
+
+        :param name: name the hosts are cached under
+        :param load: called with the name to fetch the hosts from the backend
+
+        :type name: str
+        :type load: callable
+
+        :returns: the new entry cached under the given name
+        :rtype: CacheEntry
+        """
+        entry, _ = self.flight.do(name, self._fill, name, load, force=True)
+        return entry
+
+    def view(self, name, entry, filters):
+        """Returns a view of the given entry holding only the hosts matching the filters.
+
+        Views are built from the index of the entry and kept per entry version in this process,
+        within CACHE_MAX_BYTES with MemoryCacheStore, otherwise up to CACHE_FILTERED_VIEWS of them.
+        They share their hosts with the entry, and have their own encoded bodies and version.
+
+        :param name: name the hosts are cached under
+        :param entry: entry cached under that name
+        :param filters: (field, value) pairs, see index.HostIndex.select
+
+        :type name: str
+        :type entry: CacheEntry
+        :type filters: tuple(tuple)
+
+        :returns: the filtered view, the entry itself without filters
+        :rtype: CacheEntry
+        """
+        if not filters:
+            return entry
+        key = (self.namespace, name, entry.version, filters)
+        view = self.views.get_view(key)
+        if view is not None:
+            return view
+        hosts = entry.hosts
+        view = CacheEntry(self.namespace, name, [hosts[position] for position in entry.index.select(filters)],
+                          indexed=False)
+        self.views.set_view(key, view, entry.expires_at)
+        get_stats('service.host').incr("cache.%s.view.%s" % (self.namespace, name))
+        return view
+
+    def delta(self, name, since, entry):
+        """Returns the hosts changed between the given version and the given entry, see changes.ChangeLog.
+
+        :param name: name the hosts are cached under
+        :param since: version known to the caller
+        :param entry: the current entry
+
+        :type name: str
+        :type since: str
+        :type entry: CacheEntry
+
+        :returns: the changes, None when they are not known
+        :rtype: changes.Delta
+        """
+        if self.change_log is None:
+            return None
+        return self.change_log.delta(name, since, entry)
+
+    def _is_stale(self, entry):
+        return entry.refresh_at is not None and time.time() >= entry.refresh_at
+
+    def _fill(self, name, load, force=False, blocking=True):
+        """Loads the hosts for the given name into the cache, holding the store lock of the name.
+
+        Unless forced, the load is skipped when another process filled the entry while this
+        one was waiting for the lock, or when it is refreshing the entry and blocking is off.
+        """
+        with self.store.lock(self._key(name), blocking) as acquired:
+            if not acquired:
+                return self.get(name)
+            if not force:
+                entry = self._get(name)
+                if entry is not MISS and not self._is_stale(entry):
+                    return entry
+            with self._recording_writes([name]) as recorded:
+                hosts = load(name)
+            return self.set(name, _merge(hosts, recorded[name]))
+
+    def _fill_many(self, names, load_many):
+        """Loads the hosts for the given names into the cache, holding the store locks of the names.
+
+        Names whose lock is held by another process are waited for one by one.
+        """
+        load = _load_one(load_many)
+        entries = {}
+        with self._locked_many(names) as locked:
+            to_load = []
+            for name in locked:
+                entry = self._get(name)
+                if entry is not MISS and not self._is_stale(entry):
+                    entries[name] = entry
+                else:
+                    to_load.append(name)
+            if to_load:
+                with self._recording_writes(to_load) as recorded:
+                    hosts = load_many(to_load)
+                for name in to_load:
+                    entries[name] = self.set(name, _merge(hosts[name], recorded[name]))
+        for name in names:
+            if name not in entries:
+                entries[name] = self._fill(name, load)
+        return entries
+
+    @contextlib.contextmanager
+    def _locked_many(self, names):
+        """Takes the store locks of the given names that no other process holds.
+
+        :returns: context manager yielding the names locked
+        """
+        locks = []
+        locked = []
+        try:
+            for name in names:
+                lock = self.store.lock(self._key(name), blocking=False)
+                if lock.__enter__():
+                    locks.append(lock)
+                    locked.append(name)
+                else:
+                    lock.__exit__(None, None, None)
+            yield locked
+        finally:
+            for lock in locks:
+                lock.__exit__(None, None, None)
+
+    def _refresh_in_background(self, name, load):
+        """Spawns a greenlet refreshing the entry for the given name, unless one is running.
+
+        :param name: name the hosts are cached under
+        :param load: called with the name to fetch the hosts from the backend
+
+        :type name: str
+        :type load: callable
+        """
+        if name in self.refreshing:
+            return
+        self.refreshing.add(name)
+        flask_app = app._get_current_object()
+
+        def refresh():
+            try:
+                with flask_app.app_context():
+                    self.flight.do(name, self._fill, name, load, blocking=False)
+                get_stats('service.host').incr("cache.%s.refresh.%s" % (self.namespace, name))
+            except Exception:
+                logging.exception("Background refresh failed for %s %s" % (self.namespace, name))
+            finally:
+                self.refreshing.discard(name)
+
+        gevent.spawn(refresh)
+
+
+def _merge(hosts, writes):
+    """Returns the given hosts with the given writes applied.
+
+    :param hosts: the hosts
+    :param writes: (service, ip_address) -> host as now stored, None if deleted
+
+    :type hosts: list(HostRecord)
+    :type writes: dict
+
+    :returns: the hosts replaced by their writes, without the deleted ones, followed by the new hosts
+    :rtype: list(HostRecord)
+    """
+    if not writes:
+        return hosts
+    writes = collections.OrderedDict(writes)
+    merged = []
+    for host in hosts:
+        key = (host.service, host.ip_address)
+        if key in writes:
+            host = writes.pop(key)
+            if host is None:
+                continue
+        merged.append(host)
+    merged.extend(host for host in writes.values() if host is not None)
+    return merged
+
+
+def _load_one(load_many):
+    """Returns a loader of the hosts of a single name, out of a loader of the hosts of many names.
+
+    :param load_many: called with a list of names to fetch their hosts from the backend,
+                      returns name -> hosts
+    :type load_many: callable
+
+    :returns: called with a name to fetch its hosts from the backend
+    :rtype: callable
+    """
+    def load(name):
+        return load_many([name])[name]
+    return load
+
+
+def _store():
+    if settings.value.SHARED_CACHE_DIR:
+        return SharedCacheStore(settings.value.SHARED_CACHE_DIR)
+    if settings.value.CACHE_TYPE == 'simple':
+        return MemoryCacheStore(settings.value.CACHE_MAX_BYTES)
+    return FlaskCacheStore()
+
+
+store = _store()
+services = HostListCache('service', store,
+                         changes.ChangeLog(settings.value.CACHE_CHANGE_LOG_SIZE,
+                                           settings.value.CACHE_CHANGE_LOG_SERVICES),
+                         changes.hub)
+service_repo_names = HostListCache('service_repo_name', store)
@@ -0,0 +1,154 @@
+import collections
+
+from gevent.event import Event
+
+from ..lru import LRUCache
+
+
+# Hosts added, updated and removed between two versions of a host list.
+Delta = collections.namedtuple('Delta', ['added', 'updated', 'removed'])
+
+
+class ChangeHub(object):
+    """In-process notifications of host list changes, per service.
+
+    Watchers subscribe to a service and wait on the returned event, which is set by the
+    next notify for that service. Subscribe before reading the current state, so that a
+    change landing in between is not missed.
+    """
+
+    def __init__(self):
+        self.events = {}
+
+    def subscribe(self, service):
+        """Returns the event set by the next change to the given service.
+
+        :param service: name of a service
+        :type service: str
+
+        :returns: event set on the next change
+        :rtype: gevent.event.Event
+        """
+        event = self.events.get(service)
+        if event is None:
+            event = Event()
+            self.events[service] = event
+        return event
+
+    def notify(self, service):
+        """Wakes up everyone waiting for a change to the given service.
+
+        :param service: name of a service
+        :type service: str
+        """
+        event = self.events.pop(service, None)
+        if event is not None:
+            event.set()
+
+
+class ChangeLog(object):
+    """In-process log of the last changes of host lists, per name, for delta responses.
+
+    Every new version of a host list records the hosts added, updated and removed since the
+    previous version. Only the last size changes of the last capacity names are kept, older
+    versions get full host lists again. Changes of last_check_in alone are not recorded.
+    """
+
+    def __init__(self, size, capacity):
+        """
+        :param size: number of changes kept per name
+        :param capacity: number of names changes are kept for
+
+        :type size: int
+        :type capacity: int
+        """
+        self.size = size
+        self.logs = LRUCache(capacity)
+
+    def record(self, name, previous, entry):
+        """Records the changes from an entry to the entry replacing it.
+
+        :param name: name the hosts are cached under
+        :param previous: the replaced entry
+        :param entry: the new entry
+
+        :type name: str
+        :type previous: cache.CacheEntry
+        :type entry: cache.CacheEntry
+        """
+        previous_hosts = dict(((host.service, host.ip_address), host) for host in previous.hosts)
+        added = []
+        updated = []
+        for host in entry.hosts:
+            previous_host = previous_hosts.pop((host.service, host.ip_address), None)
+            if previous_host is None:
+                added.append(host)
+            elif _is_updated(previous_host, host):
+                updated.append(host)
+        log = self.logs[name] if name in self.logs else collections.deque(maxlen=self.size)
+        log.append((previous.version, entry.version, Delta(added, updated, list(previous_hosts.values()))))
+        self.logs[name] = log
+
+    def delta(self, name, since, entry):
+        """Returns the hosts changed between the given version and the given entry.
+
+        :param name: name the hosts are cached under
+        :param since: version known to the caller
+        :param entry: the current entry
+
+        :type name: str
+        :type since: str
+        :type entry: cache.CacheEntry
+
+        :returns: the changes, None when the version is no longer logged or the changes
+                  hold as many hosts as the entry
+        :rtype: Delta
+        """
+        if since == entry.version:
+            return Delta([], [], [])
+        if name not in self.logs:
+            return None
+        log = list(self.logs[name])
+        starts = [i for i, (from_version, _, _) in enumerate(log) if from_version == since]
+        if not starts:
+            return None
+
+        added = collections.OrderedDict()
+        updated = collections.OrderedDict()
+        removed = collections.OrderedDict()
+        version = since
+        for from_version, to_version, delta in log[starts[-1]:]:
+            if from_version != version:
+                # A version replaced without being logged, e.g. after the entry expired.
+                return None
+            version = to_version
+            for host in delta.added:
+                key = (host.service, host.ip_address)
+                if removed.pop(key, None) is not None:
+                    updated[key] = host
+                else:
+                    added[key] = host
+            for host in delta.updated:
+                key = (host.service, host.ip_address)
+                if key in added:
+                    added[key] = host
+                else:
+                    updated[key] = host
+            for host in delta.removed:
+                key = (host.service, host.ip_address)
+                if added.pop(key, None) is None:
+                    updated.pop(key, None)
+                    removed[key] = host
+        if version != entry.version or len(added) + len(updated) >= len(entry.hosts):
+            return None
+        return Delta(list(added.values()), list(updated.values()), list(removed.values()))
+
+
+def _is_updated(previous_host, host):
+    return (previous_host.service_repo_name != host.service_repo_name or
+            previous_host.port != host.port or
+            previous_host.revision != host.revision or
+            previous_host.tags != host.tags)
+
+
+hub = ChangeHub()
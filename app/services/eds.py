@@ -0,0 +1,104 @@
+import collections
+
+from ..models.record import CANARY_VALUES
+
+
+# Type of the resources served by the Envoy v2 endpoint discovery service.
+CLUSTER_LOAD_ASSIGNMENT = 'type.googleapis.com/envoy.api.v2.ClusterLoadAssignment'
+
+
+class EdsSerializer(object):
+    """Builds Envoy v2 EDS resources out of hosts, in the proto3 JSON mapping of the REST xDS API."""
+
+    @staticmethod
+    def cluster_load_assignment(service, hosts):
+        """Converts the hosts of a service to a ClusterLoadAssignment
+
+        Hosts are grouped into localities by their region and az tags. The load_balancing_weight
+        tag becomes the endpoint weight, at least 1 as Envoy rejects lower weights, and the canary
+        tag the envoy.lb canary metadata.
+
+        :param service: the service, used as cluster name
+        :param hosts: hosts of the service
+
+        :type service: str
+        :type hosts: list(HostRecord)
+
+        :returns: the ClusterLoadAssignment
+        :rtype: dict
+        """
+
+        localities = collections.OrderedDict()
+        for host in sorted(hosts, key=lambda host: (host.tags.get('region') or '', host.tags.get('az') or '',
+                                                    host.ip_address)):
+            locality = (host.tags.get('region') or '', host.tags.get('az') or '')
+            localities.setdefault(locality, []).append(EdsSerializer.lb_endpoint(host))
+
+        endpoints = []
+        for (region, zone), lb_endpoints in localities.items():
+            locality = {}
+            if region:
+                locality['region'] = region
+            if zone:
+                locality['zone'] = zone
+            endpoints.append({'locality': locality, 'lb_endpoints': lb_endpoints})
+        return {
+            '@type': CLUSTER_LOAD_ASSIGNMENT,
+            'cluster_name': service,
+            'endpoints': endpoints,
+        }
+
+    @staticmethod
+    def lb_endpoint(host):
+        """Converts a host to an LbEndpoint
+
+        :param host: the host
+        :type host: HostRecord
+
+        :returns: the LbEndpoint
+        :rtype: dict
+        """
+
+        lb_endpoint = {
+            'endpoint': {
+                'address': {
+                    'socket_address': {'address': host.ip_address, 'port_value': host.port},
+                },
+            },
+        }
+        weight = host.tags.get('load_balancing_weight')
+        if weight is not None:
+            try:
+                lb_endpoint['load_balancing_weight'] = max(int(weight), 1)
+            except (TypeError, ValueError):
+                pass
+        if host.tags.get('canary') in CANARY_VALUES:
+            lb_endpoint['metadata'] = {'filter_metadata': {'envoy.lb': {'canary': True}}}
+        return lb_endpoint
+
+    @staticmethod
+    def discovery_response(services, entries, version):
+        """Builds the DiscoveryResponse carrying the ClusterLoadAssignments of the given services
+
+        The version doubles as nonce, so that a NACK tells which version was rejected whichever
+        discovery process served it.
+
+        :param services: the requested services, in response order
+        :param entries: service -> cache entry for that service
+        :param version: version of the entries, see HostService.entries_version
+
+        :type services: list(str)
+        :type entries: dict
+        :type version: str
+
+        :returns: the DiscoveryResponse
+        :rtype: dict
+        """
+
+        return {
+            'version_info': version,
+            'resources': [EdsSerializer.cluster_load_assignment(service, entries[service].hosts)
+                          for service in services],
+            'type_url': CLUSTER_LOAD_ASSIGNMENT,
+            'nonce': version,
+        }
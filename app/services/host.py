@@ -1,19 +1,36 @@
+import collections
 import datetime
+import gevent
+import hashlib
 import logging
 import pytz
 import socket
+import time
 
-from flask import current_app as app
 from flask import request
 
+from . import cache
+from . import changes
 from . import query
+from ..models.record import HostRecord
 from ..stats import get_stats
 from .. import settings
 
 
+# Error of the registrations of update_many whose host could not be stored, as opposed to invalid ones.
+STORE_FAILED = "Failed to store the host"
+# Number of hosts update_many stores per backend batch_put, the most a DynamoDB BatchWriteItem takes.
+BATCH_PUT_SIZE = 25
+
+
 class HostService():
     """Provides methods for querying for hosts"""
 
+    # Whether expired hosts are deleted from the backend by a Sweeper, reads delete them otherwise.
+    swept = False
+    # (service, ip_address) of the expired hosts being deleted in the background after a read.
+    deleting = set()
+
     def __init__(self, query_backend=query.DynamoQueryBackend()):
         """
         Initialize HostService against a given query backend.
@@ -23,60 +40,302 @@ class HostService():
         """
         self.query_backend = query_backend
 
-    def _sweep_expired_hosts(self, hosts):
+    def _filter_expired_hosts(self, hosts):
         """Filters out any hosts which have expired.
 
-        :param hosts: a list of host dictionaries to check for expiration
-        :type hosts: list(dict)
+        Expired hosts are deleted from the backend in the background, unless a Sweeper runs, see swept.
+
+        :param hosts: a list of hosts to check for expiration
+        :type hosts: list(HostRecord)
 
-        :returns: filtered list of host dictionaries
-        :rtype: list(dict)
+        :returns: filtered list of hosts
+        :rtype: list(HostRecord)
         """
-        _hosts = []
+        live_hosts = []
+        expired = []
         for host in hosts:
             if self._is_expired(host):
-                statsd = get_stats('service.host')
-                self.query_backend.delete(host['service'], host['ip_address'])
-                statsd.incr("sweep.%s" % host['service'])
+                expired.append(host)
             else:
-                _hosts.append(host)
-        return _hosts
+                live_hosts.append(host)
+        if expired and not self.swept:
+            self._delete_expired_in_background(expired)
+        return live_hosts
+
+    def _delete_expired_in_background(self, hosts):
+        """Spawns a greenlet deleting the given expired hosts, off the read path, see _delete_expired.
+
+        Hosts already being deleted are skipped, so that concurrent reads do not delete them again.
+
+        :param hosts: the expired hosts
+        :type hosts: list(HostRecord)
+        """
+        hosts = [host for host in hosts if (host.service, host.ip_address) not in self.deleting]
+        if not hosts:
+            return
+        keys = set((host.service, host.ip_address) for host in hosts)
+        HostService.deleting.update(keys)
+
+        def delete():
+            try:
+                self._delete_expired(hosts)
+            except Exception:
+                logging.exception("Deleting expired hosts failed")
+            finally:
+                HostService.deleting.difference_update(keys)
+
+        gevent.spawn(delete)
+
+    def _delete_expired(self, hosts):
+        """Deletes the given expired hosts, but not the ones which checked in again since they were read.
+
+        :param hosts: the expired hosts
+        :type hosts: list(HostRecord)
+
+        :returns: the hosts deleted
+        :rtype: list(HostRecord)
+        """
+        statsd = get_stats('service.host')
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.value.HOST_TTL)
+        deleted = self.query_backend.delete_expired(hosts, cutoff)
+        for service in set(host.service for host in deleted):
+            changes.hub.notify(service)
+        for host in deleted:
+            statsd.incr("sweep.%s" % host.service)
+        return deleted
+
+    def sweep_expired_hosts(self, batch_size, max_rate):
+        """Deletes the expired hosts of every service from the backend.
+
+        :param batch_size: number of hosts deleted per backend call
+        :param max_rate: maximum number of hosts deleted per second
+
+        :type batch_size: int
+        :type max_rate: float
+
+        :returns: number of hosts deleted
+        :rtype: int
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.value.HOST_TTL)
+        expired = [host for host in self.query_backend.scan(cutoff) if self._is_expired(host)]
+        swept = 0
+        for start in range(0, len(expired), batch_size):
+            batch = expired[start:start + batch_size]
+            deleted = self._delete_expired(batch)
+            self._update_cache([(host, None) for host in deleted])
+            swept += len(deleted)
+            gevent.sleep(len(batch) / float(max_rate))
+        return swept
 
     def list(self, service):
         """Returns a json list of hosts for that service.
 
-        Caches host lists per service with a TTL.
+        Caches host lists per service with a TTL, see cache.HostListCache.
 
         :param service: name of a service
 
         :type service: str
 
         :returns: all of the hosts associated with the given service
-        :rtype: list(dict)
+        :rtype: list(HostRecord)
+        """
+        return self.list_entry(service).hosts
+
+    def list_entry(self, service, filters=()):
+        """Returns the cache entry holding the hosts of that service and their encoded response.
+
+        :param service: name of a service
+        :param filters: (field, value) pairs the hosts must match, see index.HostIndex.select
+
+        :type service: str
+        :type filters: tuple(tuple)
+
+        :returns: cache entry for the given service, or its view holding the matching hosts
+        :rtype: cache.CacheEntry
+        """
+        return cache.services.view(service, cache.services.get_or_load(service, self._query), filters)
+
+    def list_delta(self, service, since):
+        """Returns the cache entry of that service, along with the changes of its hosts since the given version.
+
+        :param service: name of a service
+        :param since: version of the host list known to the caller
+
+        :type service: str
+        :type since: str
+
+        :returns: cache entry for the given service, and the changes since that version, None when
+                  they are not known and the full host list should be returned
+        :rtype: tuple(cache.CacheEntry, changes.Delta)
+        """
+        entry = self.list_entry(service)
+        return entry, cache.services.delta(service, since, entry)
+
+    def list_entries(self, services):
+        """Returns the cache entries of many services, the ones missing from the cache are loaded concurrently.
+
+        :param services: names of services
+
+        :type services: list(str)
+
+        :returns: service -> cache entry for that service
+        :rtype: dict
+        """
+        return cache.services.get_or_load_many(services, self._query_many)
+
+    def warm_cache(self):
+        """Loads the non expired hosts of every service into the cache, with a single backend scan.
+
+        Hosts are cached both by service and by service_repo_name.
+
+        :returns: number of services loaded
+        :rtype: int
         """
-        cached_hosts = app.cache.get(service)
-        if cached_hosts:
-            return cached_hosts
+        services = collections.defaultdict(list)
+        service_repo_names = collections.defaultdict(list)
+        for host in self._filter_expired_hosts(self.query_backend.scan()):
+            services[host.service].append(host)
+            if host.service_repo_name:
+                service_repo_names[host.service_repo_name].append(host)
+        for service, hosts in services.items():
+            cache.services.set(service, hosts)
+        for service_repo_name, hosts in service_repo_names.items():
+            cache.service_repo_names.set(service_repo_name, hosts)
+        return len(services)
+
+    def watch(self, service, version, timeout):
+        """Waits until the hosts of that service differ from the given version.
+
+        Changes are only seen as they happen through this process, see changes.ChangeHub.
+        Each change forces a reload of the cached host list. On timeout, the cached host list
+        is read again, as it may have changed through other processes or refreshes.
+
+        :param service: name of a service
+        :param version: version of the host list known to the caller
+        :param timeout: maximum number of seconds to wait for
 
-        hosts = self._sweep_expired_hosts(self.query_backend.query(service))
-        app.cache.set(service, hosts, settings.value.CACHE_TTL)
-        return hosts
+        :type service: str
+        :type version: str
+        :type timeout: float
+
+        :returns: cache entry for the given service, with the given version when it did not change
+        :rtype: cache.CacheEntry
+        """
+        deadline = time.time() + timeout
+        event = changes.hub.subscribe(service)
+        entry = self.list_entry(service)
+        while entry.version == version:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not event.wait(remaining):
+                return self.list_entry(service)
+            event = changes.hub.subscribe(service)
+            entry = cache.services.reload(service, self._query)
+        return entry
+
+    def watch_many(self, services, version, timeout):
+        """Waits until the hosts of any of those services differ from the given version.
+
+        Like watch, but for the combined version of many services, see entries_version.
+
+        :param services: names of services
+        :param version: combined version of the host lists known to the caller
+        :param timeout: maximum number of seconds to wait for
+
+        :type services: list(str)
+        :type version: str
+        :type timeout: float
+
+        :returns: service -> cache entry for that service, with the given version when none changed
+        :rtype: dict
+        """
+        deadline = time.time() + timeout
+        events = dict((service, changes.hub.subscribe(service)) for service in services)
+        entries = self.list_entries(services)
+        while self.entries_version(entries) == version:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not gevent.wait(list(events.values()), remaining, count=1):
+                return self.list_entries(services)
+            for service, event in list(events.items()):
+                if event.is_set():
+                    events[service] = changes.hub.subscribe(service)
+                    entries[service] = cache.services.reload(service, self._query)
+        return entries
+
+    @staticmethod
+    def entries_version(entries):
+        """Returns the combined version of the host lists of many services.
+
+        :param entries: service -> cache entry for that service
+        :type entries: dict
+
+        :returns: hash of the versions of every entry
+        :rtype: str
+        """
+        versions = ''.join('%s:%s\n' % (service, entries[service].version) for service in sorted(entries))
+        return hashlib.sha1(versions.encode('utf-8')).hexdigest()
 
     def list_by_service_repo_name(self, service_repo_name):
         """Returns a json list of hosts for that service_repo_name.
 
-        Note! Currently we don't cache calls that lookup via service_repo_name since the only
-        use is low rate and check.py. If we ever want caching on this call, we have to use
-        a separate cache from above or prepend a prefix since otherwise it will stomp.
+        Cached separately from the per service host lists, see cache.HostListCache.
+
+        :param service_repo_name: service_repo_name to find entries associated with
+
+        :type service_repo_name: str
+
+        :returns: all of the hosts associated with the given service_repo_name
+        :rtype: list(HostRecord)
+        """
+        return self.list_entry_by_service_repo_name(service_repo_name).hosts
+
+    def list_entry_by_service_repo_name(self, service_repo_name):
+        """Returns the cache entry holding the hosts of that service_repo_name and their encoded response.
+
+        :param service_repo_name: service_repo_name to find entries associated with
+
+        :type service_repo_name: str
+
+        :returns: cache entry for the given service_repo_name
+        :rtype: cache.CacheEntry
+        """
+        return cache.service_repo_names.get_or_load(service_repo_name, self._query_secondary_index)
+
+    def _query(self, service):
+        """Queries the backend for the non expired hosts of a service.
+
+        :param service: name of a service
+
+        :type service: str
+
+        :returns: all of the hosts associated with the given service
+        :rtype: list(HostRecord)
+        """
+        return self._filter_expired_hosts(self.query_backend.query(service))
+
+    def _query_many(self, services):
+        """Queries the backend for the non expired hosts of many services at once.
+
+        :param services: names of services
+
+        :type services: list(str)
+
+        :returns: service -> all of the hosts associated with that service
+        :rtype: dict
+        """
+        hosts = self.query_backend.query_many(services)
+        return dict((service, self._filter_expired_hosts(hosts[service])) for service in services)
+
+    def _query_secondary_index(self, service_repo_name):
+        """Queries the backend for the non expired hosts of a service_repo_name.
 
         :param service_repo_name: service_repo_name to find entries associated with
 
         :type service_repo_name: str
 
         :returns: all of the hosts associated with the given service_repo_name
-        :rtype: list(dict)
+        :rtype: list(HostRecord)
         """
-        return self._sweep_expired_hosts(self.query_backend.query_secondary_index(service_repo_name))
+        return self._filter_expired_hosts(self.query_backend.query_secondary_index(service_repo_name))
 
     def update(self, service, ip_address, service_repo_name, port, revision, last_check_in, tags):
         """Updates the service registration entry for one host.
@@ -101,59 +360,137 @@ class HostService():
         :rtype: bool
         """
 
-        if not service:
-            logging.error("Update: Missing required parameter - service")
+        error = self._validate(service, ip_address, port, revision, last_check_in, tags)
+        if error is not None:
+            logging.error("Update: %s" % error)
             return False
+
+        self._create_or_update_host(service, ip_address, service_repo_name, int(port), revision, last_check_in, tags)
+        return True
+
+    def update_many(self, registrations):
+        """Updates the service registration entries of many hosts with a single batch write.
+
+        Each registration is validated like by update, invalid ones are skipped. The stored hosts
+        are read with a single batch get, so that tags are merged like by update. When a host is
+        registered more than once, the last registration wins. Hosts are stored BATCH_PUT_SIZE at
+        a time, the registrations of a batch that failed get STORE_FAILED.
+
+        :param registrations: dicts holding the parameters of update for each host
+
+        :type registrations: list(dict)
+
+        :returns: for each registration, None if it was stored, otherwise why it was not
+        :rtype: list(str)
+        """
+
+        errors = []
+        keys = []
+        hosts = collections.OrderedDict()
+        for registration in registrations:
+            service = registration.get('service')
+            ip_address = registration.get('ip_address')
+            port = registration.get('port')
+            revision = registration.get('revision')
+            last_check_in = registration.get('last_check_in')
+            tags = registration.get('tags')
+            error = self._validate(service, ip_address, port, revision, last_check_in, tags)
+            if error is not None:
+                logging.error("Update: %s" % error)
+            else:
+                hosts[(service, ip_address)] = HostRecord(service, ip_address, registration.get('service_repo_name'),
+                                                          int(port), revision, last_check_in, tags)
+            errors.append(error)
+            keys.append((service, ip_address))
+        if not hosts:
+            return errors
+
+        stored_hosts = dict(((host.service, host.ip_address), host)
+                            for host in self.query_backend.batch_get(list(hosts.keys())))
+        to_put = []
+        writes = []
+        for key, host in hosts.items():
+            stored_host = stored_hosts.get(key)
+            is_changed = self._is_changed(stored_host, host)
+            if stored_host is not None:
+                tags = dict(stored_host.tags)
+                tags.update(host.tags)
+                host = host.replace(tags=tags)
+            to_put.append(host)
+            if is_changed:
+                writes.append((stored_host, host))
+
+        failed = set()
+        for start in range(0, len(to_put), BATCH_PUT_SIZE):
+            batch = to_put[start:start + BATCH_PUT_SIZE]
+            if not self.query_backend.batch_put(batch):
+                failed.update((host.service, host.ip_address) for host in batch)
+        writes = [(stored_host, host) for stored_host, host in writes if (host.service, host.ip_address) not in failed]
+        self._update_cache(writes)
+        for service in set(host.service for _, host in writes):
+            changes.hub.notify(service)
+        return [STORE_FAILED if error is None and key in failed else error for error, key in zip(errors, keys)]
+
+    def _validate(self, service, ip_address, port, revision, last_check_in, tags):
+        """Checks the parameters of a host registration.
+
+        :returns: why the registration is invalid, None if it is valid
+        :rtype: str
+        """
+
+        if not service:
+            return "Missing required parameter - service"
         if not ip_address:
-            logging.error(
-                "Update: Missing required parameter - ip_address. url={} params={}".format(
-                    request.url, request.form
-                )
-            )
-            return False
+            return "Missing required parameter - ip_address. url={} params={}".format(request.url, request.form)
         if not port:
-            logging.error("Update: Missing required parameter - port")
-            return False
+            return "Missing required parameter - port"
         if not revision:
-            logging.error("Update: Missing required parameter - revision")
-            return False
+            return "Missing required parameter - revision"
         if not last_check_in:
-            logging.error("Update: Missing required parameter - last_check_in")
-            return False
+            return "Missing required parameter - last_check_in"
+
+        return self._validate_fields(ip_address, port, last_check_in) or self._validate_tags(tags)
+
+    def _validate_fields(self, ip_address, port, last_check_in):
+        """Checks the format of the ip_address, port and last_check_in of a host registration.
+
+        :returns: why the registration is invalid, None if it is valid
+        :rtype: str
+        """
 
         if (type(last_check_in).__name__ != 'datetime'):
-            return False
+            return "Invalid last_check_in"
 
-        # validate that port is a positive number
+        # validate that port is a positive 16 bit number
         try:
             port = int(port)
-        except ValueError:
-            logging.error("Update: Invalid port")
-            return False
-        if port <= 0:
-            logging.error("Update: Invalid port")
-            return False
+        except (TypeError, ValueError):
+            return "Invalid port"
+        if not 0 < port <= 65535:
+            return "Invalid port"
 
         if not self._is_valid_ip(ip_address):
-            logging.error("Update: Invalid ip address")
-            return False
+            return "Invalid ip address"
 
-        # TODO eventually we should be able to have this be pluggable -- non-amazon backends
-        # won't care
-        if 'az' not in tags:
-            logging.error("Update: Missing required tag - az")
-            return False
+        return None
 
-        if 'instance_id' not in tags:
-            logging.error("Update: Missing required tag - instance_id")
-            return False
+    def _validate_tags(self, tags):
+        """Checks the tags of a host registration.
 
-        if 'region' not in tags:
-            logging.error("Update: Missing required tag - region")
-            return False
+        :returns: why the registration is invalid, None if it is valid
+        :rtype: str
+        """
 
-        self._create_or_update_host(service, ip_address, service_repo_name, port, revision, last_check_in, tags)
-        return True
+        if not isinstance(tags, dict):
+            return "Invalid tags"
+
+        # TODO eventually we should be able to have this be pluggable -- non-amazon backends
+        # won't care
+        for tag in ('az', 'instance_id', 'region'):
+            if tag not in tags:
+                return "Missing required tag - {}".format(tag)
+
+        return None
 
     def set_tag(self, service, ip_address, tag_name, tag_value):
         """Set a tag on the associated service/ip_address entry.
@@ -176,8 +513,10 @@ class HostService():
         host = self.query_backend.get(service, ip_address)
         if host is None:
             return False
-        host['tags'][tag_name] = tag_value
-        self.query_backend.put(host)
+        tagged_host = host.with_tags({tag_name: tag_value})
+        self.query_backend.put(tagged_host)
+        self._update_cache([(host, tagged_host)])
+        changes.hub.notify(service)
         return True
 
     def set_tag_all(self, service, tag_name, tag_value):
@@ -201,12 +540,18 @@ class HostService():
         :rtype: bool
         """
 
-        to_put = []
+        writes = []
         for host in self.query_backend.query(service):
-            if host['tags'].get(tag_name) != tag_value:
-                host['tags'][tag_name] = tag_value
-                to_put.append(host)
-        return self.query_backend.batch_put(to_put)
+            if host.tags.get(tag_name) != tag_value:
+                writes.append((host, host.with_tags({tag_name: tag_value})))
+        to_put = [tagged_host for _, tagged_host in writes]
+        success = self.query_backend.batch_put(to_put)
+        if success:
+            # Partially written tags are picked up once the cached entries expire.
+            self._update_cache(writes)
+        if to_put:
+            changes.hub.notify(service)
+        return success
 
     def delete(self, service, ip_address):
         """Attempts to delete the host with the given service and ip_address.
@@ -233,22 +578,33 @@ class HostService():
             logging.error("Delete: Invalid ip address")
             return False
 
-        return self.query_backend.delete(service, ip_address)
+        # The cached host tells the service_repo_name whose cached entry the host is removed from.
+        deleted_host = None
+        entry = cache.services.get(service)
+        if entry is not cache.MISS:
+            deleted_host = next((host for host in entry.hosts if host.ip_address == ip_address), None)
+
+        if not self.query_backend.delete(service, ip_address):
+            return False
+        if deleted_host is not None:
+            self._update_cache([(deleted_host, None)])
+        changes.hub.notify(service)
+        return True
 
     def _is_expired(self, host):
         """Check if the given host is considered to be expired.
 
         Expiration is based on the value of HOST_TTL.
 
-        :param host: the host dictionary with check in info
+        :param host: the host with check in info
 
-        :type: list(dict)
+        :type: HostRecord
 
         :returns: True if host entry expired, False otherwise
         :rtype: bool
         """
 
-        last_check_in = host['last_check_in']
+        last_check_in = host.last_check_in
         now = pytz.utc.localize(datetime.datetime.utcnow())
 
         if not last_check_in.tzinfo:
@@ -259,7 +615,7 @@ class HostService():
         if time_elapsed > settings.value.HOST_TTL:
             logging.info(
                 "Expiring host %s for service %s because %d seconds have elapsed since last_checkin"
-                % (host['tags']['instance_id'], host['service'], time_elapsed)
+                % (host.tags.get('instance_id'), host.service, time_elapsed)
                 )
             return True
         else:
@@ -288,24 +644,69 @@ class HostService():
         :returns: True on success, False on failure
         :rtype: bool
         """
-        host = self.query_backend.get(service, ip_address)
-        if host is None:
-            host = {
-                'service': service,
-                'ip_address': ip_address,
-                'service_repo_name': service_repo_name,
-                'port': port,
-                'revision': revision,
-                'last_check_in': last_check_in,
-                'tags': tags
-            }
-        else:
-            host['service_repo_name'] = service_repo_name
-            host['port'] = port
-            host['revision'] = revision
-            host['last_check_in'] = last_check_in
-            host['tags'].update(tags)
-        return self.query_backend.put(host)
+        host = HostRecord(service, ip_address, service_repo_name, port, revision, last_check_in, tags)
+        stored_host = self.query_backend.upsert(host)
+        if self._is_changed(stored_host, host):
+            if stored_host is not None:
+                _tags = dict(stored_host.tags)
+                _tags.update(host.tags)
+                host = host.replace(tags=_tags)
+            self._update_cache([(stored_host, host)])
+            changes.hub.notify(service)
+        return True
+
+    def _update_cache(self, writes):
+        """Applies writes to the cached host lists of their services and service_repo_names.
+
+        Heartbeats that only move last_check_in forward are not applied, the cached hosts are
+        refreshed along with their entries.
+
+        :param writes: pairs of the host as previously stored and the host as now stored, either
+                       being None when the host was created or deleted
+
+        :type writes: list(tuple)
+        """
+        services = collections.defaultdict(lambda: ([], []))
+        service_repo_names = collections.defaultdict(lambda: ([], []))
+        for stored_host, host in writes:
+            if host is not None:
+                services[host.service][0].append(host)
+                if host.service_repo_name:
+                    service_repo_names[host.service_repo_name][0].append(host)
+            if stored_host is None:
+                continue
+            key = (stored_host.service, stored_host.ip_address)
+            if host is None:
+                services[stored_host.service][1].append(key)
+            if stored_host.service_repo_name and (host is None or
+                                                  host.service_repo_name != stored_host.service_repo_name):
+                service_repo_names[stored_host.service_repo_name][1].append(key)
+
+        for service, (hosts, deleted) in services.items():
+            cache.services.apply(service, hosts, deleted)
+        for service_repo_name, (hosts, deleted) in service_repo_names.items():
+            cache.service_repo_names.apply(service_repo_name, hosts, deleted)
+
+    def _is_changed(self, stored_host, host):
+        """Returns whether storing the given host changes the host list of its service.
+
+        A heartbeat only moving last_check_in forward does not.
+
+        :param stored_host: the host as currently stored, None if it is not
+        :param host: the host about to be stored, with only its new tags
+
+        :type stored_host: HostRecord
+        :type host: HostRecord
+
+        :rtype: bool
+        """
+
+        # Backends may store an empty service_repo_name as None.
+        return (stored_host is None or
+                (stored_host.service_repo_name or None) != (host.service_repo_name or None) or
+                stored_host.port != host.port or
+                stored_host.revision != host.revision or
+                any(stored_host.tags.get(name) != value for name, value in host.tags.items()))
 
     def _is_valid_ip(self, ip):
         """
@@ -0,0 +1,83 @@
+import bisect
+
+from ..models.record import CANARY_VALUES
+
+
+# Fields hosts can be filtered on by equality.
+FILTER_FIELDS = ('az', 'region', 'canary', 'revision')
+
+# Weight of hosts without a valid load_balancing_weight tag, as assumed by Envoy.
+DEFAULT_WEIGHT = 1
+
+
+def host_weight(host):
+    """Returns the load balancing weight of a host.
+
+    :param host: the host
+    :type host: HostRecord
+
+    :returns: the load_balancing_weight tag, DEFAULT_WEIGHT if missing or invalid
+    :rtype: int
+    """
+    try:
+        return int(host.tags['load_balancing_weight'])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_WEIGHT
+
+
+def _field_value(host, field):
+    if field == 'canary':
+        return host.tags.get('canary') in CANARY_VALUES
+    if field == 'revision':
+        return host.revision
+    return host.tags.get(field)
+
+
+class HostIndex(object):
+    """Positions of the hosts of a host list, by az, region, canary and revision, and by weight.
+
+    Filtering a host list through its index only touches the positions of matching hosts, the
+    hosts themselves are shared with the list.
+    """
+
+    def __init__(self, hosts):
+        """
+        :param hosts: the indexed host list
+        :type hosts: list(HostRecord)
+        """
+        self.size = len(hosts)
+        # (field, value) -> positions of the hosts with that value, in list order
+        self.positions = {}
+        weights = []
+        for position, host in enumerate(hosts):
+            for field in FILTER_FIELDS:
+                self.positions.setdefault((field, _field_value(host, field)), []).append(position)
+            weights.append((host_weight(host), position))
+        weights.sort()
+        self.weights = [weight for weight, _ in weights]
+        self.weight_positions = [position for _, position in weights]
+
+    def select(self, filters):
+        """Returns the positions of the hosts matching every given filter.
+
+        :param filters: (field, value) pairs, field being one of FILTER_FIELDS or min_weight
+        :type filters: tuple(tuple)
+
+        :returns: positions of the matching hosts, in list order
+        :rtype: list(int)
+        """
+        selected = None
+        for field, value in filters:
+            if field == 'min_weight':
+                positions = self.weight_positions[bisect.bisect_left(self.weights, value):]
+            else:
+                positions = self.positions.get((field, value), ())
+            if selected is None:
+                selected = set(positions)
+            else:
+                selected.intersection_update(positions)
+            if not selected:
+                return []
+        if selected is None:
+            return list(range(self.size))
+        return sorted(selected)
@@ -1,11 +1,39 @@
 import abc
+import atexit
+import collections
+import contextlib
+import datetime
+import errno
+import fcntl
+import gevent
+import gevent.pool
+import itertools
+import json
 import logging
+import mmap
 import os
 import pickle
+import pytz
+import socket
+import struct
 import tempfile
 
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+from pynamodb.constants import ALL_OLD, ATTRIBUTES
+from pynamodb.exceptions import DeleteError, PynamoDBException
+
+from .. import settings
+from ..lru import LRUCache
 from ..stats import get_stats
 from ..models.host import Host
+from ..models.record import HostRecord
+
+
+# Bounds the backend queries run concurrently by query_many, across all backends and requests. Sized
+# after the connection pool of CustomPynamoSession, so that queries never wait for a connection.
+query_pool = gevent.pool.Pool(settings.value.CONNECTION_POOL_SIZE)
 
 
 class QueryBackend(object):
@@ -18,7 +46,7 @@ class QueryBackend(object):
 
     @abc.abstractmethod
     def query(self, service):
-        """Returns a generator of host dicts for the given service.
+        """Returns a generator of host records for the given service.
 
         Note that this will NOT deal with how timing out entries -- that is
         a concern of the caller.
@@ -28,7 +56,7 @@ class QueryBackend(object):
         :type service: str
 
         :returns: hosts associated with this service
-        :rtype: list(dict)
+        :rtype: list(HostRecord)
         """
 
         pass
@@ -42,7 +70,7 @@ class QueryBackend(object):
         :type service_repo_name: str
 
         :returns: hosts associated with this service_repo_name
-        :rtype: list(dict)
+        :rtype: list(HostRecord)
         """
 
         pass
@@ -58,7 +86,7 @@ class QueryBackend(object):
         :type ip_address: str
 
         :returns: a single host if one exists, None otherwise
-        :rtype: dict
+        :rtype: HostRecord
         """
 
         pass
@@ -69,7 +97,7 @@ class QueryBackend(object):
 
         :param host: host entry to store
 
-        :type host: dict
+        :type host: HostRecord
 
         :returns: True if put successful, False otherwise
         :rtype: bool
@@ -93,6 +121,83 @@ class QueryBackend(object):
 
         pass
 
+    def query_many(self, services):
+        """Returns the hosts of many services, querying them concurrently.
+
+        At most CONNECTION_POOL_SIZE queries run at the same time, see query_pool. Backends
+        that do not block on I/O should override this to query serially.
+
+        :param services: services of the hosts to retrieve
+
+        :type services: list(str)
+
+        :returns: service -> hosts associated with this service
+        :rtype: dict
+        """
+
+        services = list(set(services))
+        hosts = query_pool.map(lambda service: list(self.query(service)), services)
+        return dict(zip(services, hosts))
+
+    def upsert(self, host):
+        """Stores the given host, merging its tags into the ones of the stored host if any.
+
+        Backends should override this if they can update a host without reading it first.
+
+        :param host: host entry to store
+
+        :type host: HostRecord
+
+        :returns: the host as stored before the upsert, None if it did not exist
+        :rtype: HostRecord
+        """
+
+        stored_host = self.get(host.service, host.ip_address)
+        if stored_host is not None:
+            tags = dict(stored_host.tags)
+            tags.update(host.tags)
+            host = host.replace(tags=tags)
+        self.put(host)
+        return stored_host
+
+    def scan(self, checked_in_before=None):
+        """Returns a generator of the host records of every service.
+
+        :param checked_in_before: backends may skip hosts that checked in at or after this
+                                  time. It is only a hint, callers need to check the hosts.
+
+        :type checked_in_before: datetime
+
+        :returns: hosts of every service
+        :rtype: list(HostRecord)
+        """
+
+        raise NotImplementedError("{} does not support scanning".format(type(self).__name__))
+
+    def delete_expired(self, hosts, checked_in_before):
+        """Deletes the given hosts, unless they checked in again since they were read.
+
+        Backends should override this if they can delete conditionally, the default implementation
+        reads every host back first and is thus only safe for backends that do not block on I/O.
+
+        :param hosts: expired hosts to delete
+        :param checked_in_before: hosts are only deleted if they last checked in before this time
+
+        :type hosts: list(HostRecord)
+        :type checked_in_before: datetime
+
+        :returns: the hosts deleted
+        :rtype: list(HostRecord)
+        """
+
+        deleted = []
+        for host in hosts:
+            stored_host = self.get(host.service, host.ip_address)
+            if stored_host is not None and _utc(stored_host.last_check_in) < _utc(checked_in_before) \
+                    and self.delete(host.service, host.ip_address):
+                deleted.append(host)
+        return deleted
+
     def batch_put(self, hosts):
         '''Batch write interface for backends which support more efficient batch storing methods.
 
@@ -100,20 +205,77 @@ class QueryBackend(object):
         the backend, but is not a semantic enforced by this API. If this fails, it is possible that
         some values have been partially written. This needs to be handled by the caller.
 
-        :param hosts: list of host dicts to write
+        :param hosts: list of host records to write
 
-        :type hosts: list(dict)
+        :type hosts: list(HostRecord)
 
         :returns: True if all writes successful, False if 1 or more fail
         :rtype: bool
         '''
-        return all(map(self.store, hosts))
+        return all([self.put(host) for host in hosts])
+
+    def batch_get(self, keys):
+        '''Batch read interface for backends which support more efficient batch reading methods.
+
+        :param keys: service/ip_address pairs of the hosts to get
+
+        :type keys: list(tuple(str, str))
+
+        :returns: the hosts found, in no particular order
+        :rtype: list(HostRecord)
+        '''
+        hosts = [self.get(service, ip_address) for service, ip_address in keys]
+        return [host for host in hosts if host is not None]
+
+
+def _utc(timestamp):
+    """Returns the given timestamp as a timezone aware UTC datetime, naive ones being UTC."""
+    if timestamp.tzinfo:
+        return timestamp.astimezone(pytz.utc)
+    return pytz.utc.localize(timestamp)
 
 
 # TODO need to factor out the statsd dep
 class MemoryQueryBackend(QueryBackend):
     def __init__(self):
+        # service -> ip_address -> HostRecord, records are immutable so they are handed out as is.
         self.data = {}
+        # service_repo_name -> set of (service, ip_address), kept up to date by put and delete.
+        self.repo_index = {}
+
+    def load(self, data):
+        """Replaces the stored hosts with the given data and rebuilds the index.
+
+        Hosts stored as dicts without service and ip_address, by earlier versions, are converted
+        to records.
+
+        :param data: service -> ip_address -> host, as found in self.data
+        :type data: dict
+        """
+
+        self.data = data
+        self.repo_index = {}
+        for service, ip_map in data.items():
+            for ip_address, host in ip_map.items():
+                if isinstance(host, dict):
+                    host = HostRecord.from_dict(dict(host, service=service, ip_address=ip_address))
+                    ip_map[ip_address] = host
+                self._index(service, ip_address, host.service_repo_name)
+
+    def _index(self, service, ip_address, service_repo_name):
+        keys = self.repo_index.get(service_repo_name)
+        if keys is None:
+            keys = set()
+            self.repo_index[service_repo_name] = keys
+        keys.add((service, ip_address))
+
+    def _unindex(self, service, ip_address, service_repo_name):
+        keys = self.repo_index.get(service_repo_name)
+        if keys is None:
+            return
+        keys.discard((service, ip_address))
+        if len(keys) == 0:
+            del self.repo_index[service_repo_name]
 
     def _list_all(self):
         """A generator over every host that has been stored."""
@@ -127,17 +289,20 @@ class MemoryQueryBackend(QueryBackend):
         if ip_map is None:
             return
 
-        for ip_address, host_dict in ip_map.items():
-            _host = host_dict.copy()
-            _host['service'] = service
-            _host['ip_address'] = ip_address
-            yield _host
+        for host in ip_map.values():
+            yield host
+
+    def query_many(self, services):
+        return dict((service, list(self.query(service))) for service in services)
+
+    def scan(self, checked_in_before=None):
+        return self._list_all()
 
-    # TODO this can certainly be made faster, but I don't know if that's
-    # really necessary...
     def query_secondary_index(self, service_repo_name):
-        for host in self._list_all():
-            if host['service_repo_name'] == service_repo_name:
+        # Copy the keys, the index may change while the caller consumes the generator.
+        for service, ip_address in list(self.repo_index.get(service_repo_name, ())):
+            host = self.get(service, ip_address)
+            if host is not None:
                 yield host
 
     def get(self, service, ip_address):
@@ -145,29 +310,22 @@ class MemoryQueryBackend(QueryBackend):
         if ip_map is None:
             return None
 
-        host_dict = ip_map.get(ip_address)
-        if host_dict is None:
-            return None
-
-        host = host_dict.copy()
-        host['service'] = service
-        host['ip_address'] = ip_address
-        return host
+        return ip_map.get(ip_address)
 
     def put(self, host):
-        service = host['service']
-        ip_address = host['ip_address']
+        service = host.service
+        ip_address = host.ip_address
 
         ip_map = self.data.get(service)
         if ip_map is None:
             ip_map = {}
             self.data[service] = ip_map
 
-        host_dict = host.copy()
-        del host_dict['service']
-        del host_dict['ip_address']
-
-        ip_map[ip_address] = host_dict
+        stored_host = ip_map.get(ip_address)
+        if stored_host is not None:
+            self._unindex(service, ip_address, stored_host.service_repo_name)
+        ip_map[ip_address] = host
+        self._index(service, ip_address, host.service_repo_name)
         return True
 
     def delete(self, service, ip_address):
@@ -175,69 +333,935 @@ class MemoryQueryBackend(QueryBackend):
         if ip_map is None:
             return False
 
-        host_dict = ip_map.get(ip_address)
-        if host_dict is None:
+        host = ip_map.get(ip_address)
+        if host is None:
             return False
 
         del ip_map[ip_address]
+        self._unindex(service, ip_address, host.service_repo_name)
         if len(ip_map) == 0:
             del self.data[service]
         return True
 
 
+class CoalescingQueryBackend(QueryBackend):
+    """Skips writing heartbeats which would only move last_check_in forward.
+
+    Wraps another backend and remembers the last host state it upserted per service/ip_address.
+    An upsert carrying the same service_repo_name, port, revision and tags is only written
+    through once the persisted last_check_in gets older than max_age seconds, which should stay
+    well below HOST_TTL so that hosts never look expired to other discovery instances.
+
+    Changes made through other discovery instances are not seen until the next write through.
+    """
+
+    def __init__(self, backend, max_age, capacity):
+        """
+        :param backend: the backend to write through to
+        :param max_age: seconds after which a heartbeat is persisted even if nothing changed
+        :param capacity: number of hosts to remember the persisted state of
+
+        :type backend: QueryBackend
+        :type max_age: float
+        :type capacity: int
+        """
+        self.backend = backend
+        self.max_age = max_age
+        self.persisted = LRUCache(capacity)
+        self.written = 0
+        self.skipped = 0
+
+    def _forget(self, service, ip_address):
+        if (service, ip_address) in self.persisted:
+            del self.persisted[(service, ip_address)]
+
+    def _is_heartbeat(self, persisted_host, host):
+        """Returns whether the host only differs from the persisted one by a recent last_check_in."""
+
+        age = (host.last_check_in - persisted_host.last_check_in).total_seconds()
+        return (age < self.max_age and
+                persisted_host.service_repo_name == host.service_repo_name and
+                persisted_host.port == host.port and
+                persisted_host.revision == host.revision and
+                all(persisted_host.tags.get(name) == value for name, value in host.tags.items()))
+
+    def query(self, service):
+        return self.backend.query(service)
+
+    def query_many(self, services):
+        return self.backend.query_many(services)
+
+    def query_secondary_index(self, service_repo_name):
+        return self.backend.query_secondary_index(service_repo_name)
+
+    def scan(self, checked_in_before=None):
+        return self.backend.scan(checked_in_before)
+
+    def get(self, service, ip_address):
+        return self.backend.get(service, ip_address)
+
+    def put(self, host):
+        self._forget(host.service, host.ip_address)
+        return self.backend.put(host)
+
+    def batch_put(self, hosts):
+        for host in hosts:
+            self._forget(host.service, host.ip_address)
+        return self.backend.batch_put(hosts)
+
+    def batch_get(self, keys):
+        return self.backend.batch_get(keys)
+
+    def upsert(self, host):
+        statsd = get_stats('service.host')
+        key = (host.service, host.ip_address)
+        if key in self.persisted:
+            persisted_host = self.persisted[key]
+            if self._is_heartbeat(persisted_host, host):
+                self.skipped += 1
+                statsd.incr("heartbeat.skip.%s" % host.service)
+                return persisted_host
+
+        stored_host = self.backend.upsert(host)
+        persisted_host = host
+        if stored_host is not None:
+            tags = dict(stored_host.tags)
+            tags.update(host.tags)
+            persisted_host = host.replace(tags=tags)
+        self.persisted[key] = persisted_host
+        self.written += 1
+        statsd.incr("heartbeat.write.%s" % host.service)
+        return stored_host
+
+    def delete(self, service, ip_address):
+        self._forget(service, ip_address)
+        return self.backend.delete(service, ip_address)
+
+    def delete_expired(self, hosts, checked_in_before):
+        for host in hosts:
+            self._forget(host.service, host.ip_address)
+        return self.backend.delete_expired(hosts, checked_in_before)
+
+
+class PluginQueryBackend(QueryBackend):
+    """Adapts a plugin backend to HostRecords, plugins keep taking and returning host dicts.
+
+    Hosts returned by the plugin are converted with HostRecord.from_dict, records it already
+    returns are passed through. Hosts are written to it as dicts, see HostRecord.to_dict.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: the plugin backend
+        :type backend: QueryBackend
+        """
+        self.backend = backend
+
+    def query(self, service):
+        return _records(self.backend.query(service))
+
+    def query_secondary_index(self, service_repo_name):
+        return _records(self.backend.query_secondary_index(service_repo_name))
+
+    def scan(self, checked_in_before=None):
+        return _records(self.backend.scan(checked_in_before))
+
+    def get(self, service, ip_address):
+        return _record(self.backend.get(service, ip_address))
+
+    def put(self, host):
+        return self.backend.put(host.to_dict())
+
+    def batch_put(self, hosts):
+        return self.backend.batch_put([host.to_dict() for host in hosts])
+
+    def delete(self, service, ip_address):
+        return self.backend.delete(service, ip_address)
+
+
 class LocalFileQueryBackend(QueryBackend):
-    def __init__(self, file=tempfile.NamedTemporaryFile().name):
+    """Keeps hosts in memory, persisted to a snapshot file plus an append-only journal.
+
+    Every mutation appends a record to the journal (<file>.log) instead of rewriting all the
+    data. The journal is fsynced every fsync_every records, and compacted into a new snapshot
+    every snapshot_every records. Snapshots are written to a temporary file renamed over the
+    previous one, so a crash never leaves a partial snapshot behind. On startup the snapshot is
+    loaded and the journal replayed on top of it, a record truncated by a crash is cut off.
+    """
+
+    def __init__(self, file=tempfile.NamedTemporaryFile().name, fsync_every=None, snapshot_every=None):
+        """
+        :param file: path of the snapshot file, the journal is kept next to it
+        :param fsync_every: number of journal records between fsyncs, defaults to LOCAL_FILE_FSYNC_EVERY
+        :param snapshot_every: number of journal records between snapshots, defaults to
+                               LOCAL_FILE_SNAPSHOT_EVERY
+
+        :type file: str
+        :type fsync_every: int
+        :type snapshot_every: int
+        """
         self.backend = MemoryQueryBackend()
         self.file = file
+        self.journal_file = file + '.log'
+        self.fsync_every = fsync_every or settings.value.LOCAL_FILE_FSYNC_EVERY
+        self.snapshot_every = snapshot_every or settings.value.LOCAL_FILE_SNAPSHOT_EVERY
         if os.path.isfile(self.file) and os.stat(self.file).st_size > 0:
             with open(self.file, 'rb') as f:
-                self.backend.data = pickle.load(f)
+                self.backend.load(pickle.load(f))
+        self.journaled = self._replay()
+        self.unsynced = 0
+        self.journal = open(self.journal_file, 'ab')
+
+    def _replay(self):
+        """Applies the journal records to the loaded snapshot.
 
-    def _save(self):
-        """Saves the data information to local file."""
-        with open(self.file, 'wb') as f:
-            pickle.dump(self.backend.data, f)
+        A record truncated by a crash is cut off the journal, so that new records are not appended
+        after it.
+
+        :returns: number of records replayed
+        :rtype: int
+        """
+        if not os.path.isfile(self.journal_file):
+            return 0
+        replayed = 0
+        with open(self.journal_file, 'rb+') as f:
+            end = 0
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                    break
+                if record[0] == 'put':
+                    host = record[1]
+                    if isinstance(host, dict):
+                        host = HostRecord.from_dict(host)
+                    self.backend.put(host)
+                else:
+                    self.backend.delete(record[1], record[2])
+                replayed += 1
+                end = f.tell()
+            if end < os.fstat(f.fileno()).st_size:
+                logging.error("Ignoring truncated record at the end of {}".format(self.journal_file))
+                f.truncate(end)
+        return replayed
+
+    def _append(self, record):
+        """Appends a record to the journal, compacting it into a snapshot when due."""
+        pickle.dump(record, self.journal, pickle.HIGHEST_PROTOCOL)
+        self.journal.flush()
+        self.journaled += 1
+        self.unsynced += 1
+        if self.journaled >= self.snapshot_every:
+            self.snapshot()
+        elif self.unsynced >= self.fsync_every:
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+
+    def snapshot(self):
+        """Writes all the data to a new snapshot and empties the journal."""
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self.backend.data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_file, self.file)
+        # Replaying the old journal over the new snapshot would still end up in the same state,
+        # so crashing before the journal is truncated is fine.
+        self.journal.close()
+        self.journal = open(self.journal_file, 'wb')
+        self.journaled = 0
+        self.unsynced = 0
 
     def query(self, service):
         return self.backend.query(service)
 
+    def query_many(self, services):
+        return self.backend.query_many(services)
+
     def query_secondary_index(self, service_repo_name):
         return self.backend.query_secondary_index(service_repo_name)
 
+    def scan(self, checked_in_before=None):
+        return self.backend.scan(checked_in_before)
+
     def get(self, service, ip_address):
         return self.backend.get(service, ip_address)
 
     def put(self, host):
-        try:
-            return self.backend.put(host)
-        finally:
-            self._save()
+        success = self.backend.put(host)
+        self._append(('put', host))
+        return success
+
+    def upsert(self, host):
+        stored_host = self.backend.upsert(host)
+        self._append(('put', self.backend.get(host.service, host.ip_address)))
+        return stored_host
 
     def delete(self, service, ip_address):
+        if not self.backend.delete(service, ip_address):
+            return False
+        self._append(('delete', service, ip_address))
+        return True
+
+
+class MappedFileQueryBackend(QueryBackend):
+    """Keeps hosts in compact memory-mapped files, shared by every process opening them.
+
+    Strings (services, repos, revisions and tags as JSON) are stored in <file>.strings.<generation>,
+    an append-only list of length prefixed strings identified by their offset. <file> holds a
+    header with the number of records and the generation, followed by fixed size host records
+    referencing those strings, with the ip packed to 4 bytes and last_check_in as epoch microseconds.
+    Both files are mapped, the strings of a host are decoded from the mapping when it is read.
+
+    Each process keeps hash indexes of the record slots per service and per service_repo_name,
+    and catches up with records appended by other processes when it reads. Other strings are
+    not indexed: a write keeps the strings of the record it replaces when they did not change,
+    and appends new ones otherwise. Records are updated in place unless their service_repo_name
+    changes, in which case the old record is marked dead and a new one appended, so that the
+    indexes of other processes stay valid. Writes are serialized across processes with an
+    exclusive flock on <file>.lock, reads take it shared so that they never see a record being
+    updated. The lock is polled rather than waited on, so that other greenlets keep running.
+    Dead records and the strings no live record uses are dropped by compact, which writes new
+    files of the next generation; other processes reopen them when they notice.
+    """
+
+    HEADER = struct.Struct('<4sII')
+    ALIVE = struct.Struct('<B')
+    # alive, service, service_repo_name, revision, tags, ip_address, port, last_check_in
+    RECORD = struct.Struct('<BIIII4sHq')
+    LENGTH = struct.Struct('<I')
+    MAGIC = b'DSCH'
+    NONE = 0xFFFFFFFF
+    INITIAL_CAPACITY = 1024
+    # Size the strings file may grow to before it is compacted, at least.
+    MIN_STRINGS_COMPACT_SIZE = 1 << 20
+    LOCK_POLL_INTERVAL = 0.001
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, file):
+        """
+        :param file: path of the records file, the strings and lock files are kept next to it
+        :type file: str
+        """
+        self.file = file
+        self.lock_file = open(file + '.lock', 'ab')
+        with self._locked():
+            with open(self.file, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(self.HEADER.pack(self.MAGIC, 0, 0))
+                    f.write(b'\0' * (self.RECORD.size * self.INITIAL_CAPACITY))
+            self._open()
+
+    def _open(self):
+        """Opens the records file and maps its strings file. Must be called locked."""
+        self.records_file = open(self.file, 'rb+')
+        self.inode = os.fstat(self.records_file.fileno()).st_ino
+        self.map = mmap.mmap(self.records_file.fileno(), 0)
+        magic, _, generation = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError("{} is not a host records file".format(self.file))
+        self.generation = generation
+        self.strings_file = self._strings_file(generation)
+        self.strings_map = None
+        self.strings_size = os.path.getsize(self.strings_file) if os.path.isfile(self.strings_file) else 0
+        # string id -> service or service_repo_name, and the other way around.
+        self.names = {}
+        self.name_ids = {}
+        self.services = {}
+        self.repos = {}
+        self.indexed = 0
+        self.dead = 0
+        self._refresh()
+        self.opened_strings_size = self.strings_size
+
+    def _close(self):
+        if self.strings_map is not None:
+            self.strings_map.close()
+        self.map.close()
+        self.records_file.close()
+
+    @contextlib.contextmanager
+    def _locked(self, operation=fcntl.LOCK_EX):
+        while True:
+            try:
+                fcntl.flock(self.lock_file.fileno(), operation | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            gevent.sleep(self.LOCK_POLL_INTERVAL)
         try:
-            return self.backend.delete(service, ip_address)
+            yield
         finally:
-            self._save()
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _strings_file(self, generation):
+        return '{}.strings.{}'.format(self.file, generation)
+
+    def _count(self):
+        return self.HEADER.unpack_from(self.map, 0)[1]
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.RECORD.size
+
+    def _is_alive(self, slot):
+        return self.ALIVE.unpack_from(self.map, self._offset(slot))[0] == 1
+
+    def _string(self, string_id):
+        """Returns the string stored at the given offset of the strings file. Must be called locked."""
+        if string_id == self.NONE:
+            return None
+        if self.strings_map is None or string_id + self.LENGTH.size > len(self.strings_map):
+            # appended by another process
+            self._map_strings()
+        start = string_id + self.LENGTH.size
+        end = start + self.LENGTH.unpack_from(self.strings_map, string_id)[0]
+        if end > len(self.strings_map):
+            self._map_strings()
+        return self.strings_map[start:end].decode('utf-8')
+
+    def _map_strings(self):
+        if self.strings_map is not None:
+            self.strings_map.close()
+        with open(self.strings_file, 'rb') as f:
+            self.strings_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _name(self, string_id):
+        """Returns the service or service_repo_name stored under the given id. Must be called locked."""
+        if string_id == self.NONE:
+            return None
+        name = self.names.get(string_id)
+        if name is None:
+            name = self._string(string_id)
+            self.names[string_id] = name
+            self.name_ids[name] = string_id
+        return name
+
+    def _refresh(self):
+        """Catches up with records written by other processes. Must be called locked."""
+        if os.stat(self.file).st_ino != self.inode:
+            # compacted by another process
+            self._close()
+            self._open()
+            return
+        count = self._count()
+        if count == self.indexed:
+            return
+        if self._offset(count) > len(self.map):
+            self.map.close()
+            self.map = mmap.mmap(self.records_file.fileno(), 0)
+        for slot in range(self.indexed, count):
+            self._index(slot)
+        self.indexed = count
+
+    def _intern(self, value, string_id=NONE):
+        """Returns the id of the given string, appending it unless string_id holds it. Must be called locked."""
+        if value is None:
+            return self.NONE
+        if string_id != self.NONE and self._string(string_id) == value:
+            return string_id
+        encoded = value.encode('utf-8')
+        with open(self.strings_file, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            string_id = f.tell()
+            f.write(self.LENGTH.pack(len(encoded)) + encoded)
+        self.strings_size = string_id + self.LENGTH.size + len(encoded)
+        return string_id
+
+    def _intern_name(self, name, string_id=NONE):
+        """Returns the id of the given service or service_repo_name, see _intern. Must be called locked."""
+        if name is None:
+            return self.NONE
+        if string_id != self.NONE and self._name(string_id) == name:
+            return string_id
+        if name in self.name_ids:
+            return self.name_ids[name]
+        string_id = self._intern(name)
+        self.names[string_id] = name
+        self.name_ids[name] = string_id
+        return string_id
+
+    def _index(self, slot):
+        alive, service_id, repo_id, _, _, ip, _, _ = self.RECORD.unpack_from(self.map, self._offset(slot))
+        if not alive:
+            self.dead += 1
+            return
+        self.services.setdefault(self._name(service_id), {})[ip] = slot
+        if repo_id != self.NONE:
+            self.repos.setdefault(self._name(repo_id), set()).add(slot)
+
+    def _unindex(self, slot):
+        _, service_id, repo_id, _, _, ip, _, _ = self.RECORD.unpack_from(self.map, self._offset(slot))
+        slots = self.services.get(self._name(service_id), {})
+        if slots.get(ip) == slot:
+            del slots[ip]
+        self.repos.get(self._name(repo_id), set()).discard(slot)
+
+    def _slot(self, service, ip_address):
+        slot = self.services.get(service, {}).get(socket.inet_aton(ip_address))
+        if slot is None or not self._is_alive(slot):
+            return None
+        return slot
+
+    def _read(self, slot):
+        """Returns the host stored in the given slot, None if it is dead."""
+        alive, service_id, repo_id, revision_id, tags_id, ip, port, check_in = self.RECORD.unpack_from(
+            self.map, self._offset(slot))
+        if not alive:
+            return None
+        return HostRecord(self._name(service_id),
+                          socket.inet_ntoa(ip),
+                          self._name(repo_id),
+                          port,
+                          self._string(revision_id),
+                          self.EPOCH + datetime.timedelta(microseconds=check_in),
+                          json.loads(self._string(tags_id)))
+
+    def _pack(self, host, previous=None):
+        """Returns the record fields of the given host, storing its new strings. Must be called locked.
+
+        :param host: host to pack
+        :param previous: fields of the record the host replaces, if any
+
+        :type host: HostRecord
+        :type previous: tuple
+        """
+        if previous is None:
+            previous = (0,) + (self.NONE,) * 4
+        last_check_in = host.last_check_in
+        if last_check_in.tzinfo:
+            last_check_in = last_check_in.astimezone(pytz.utc).replace(tzinfo=None)
+        delta = last_check_in - self.EPOCH
+        return (1,
+                self._intern_name(host.service, previous[1]),
+                self._intern_name(host.service_repo_name or None, previous[2]),
+                self._intern(host.revision, previous[3]),
+                self._intern(json.dumps(host.tags, sort_keys=True), previous[4]),
+                socket.inet_aton(host.ip_address),
+                host.port,
+                (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds)
+
+    def _append(self, record):
+        """Appends a record and indexes it. Must be called locked and refreshed."""
+        slot = self._count()
+        if self._offset(slot + 1) > len(self.map):
+            self.map.close()
+            self.records_file.truncate(self._offset(2 * slot))
+            self.map = mmap.mmap(self.records_file.fileno(), 0)
+        self.RECORD.pack_into(self.map, self._offset(slot), *record)
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, slot + 1, self.generation)
+        self._index(slot)
+        self.indexed = slot + 1
+
+    def _kill(self, slot):
+        self._unindex(slot)
+        self.ALIVE.pack_into(self.map, self._offset(slot), 0)
+        self.dead += 1
+
+    def _read_slots(self, slots):
+        """Returns the hosts stored in the given slots, skipping dead ones. Must be called locked."""
+        hosts = []
+        for slot in slots:
+            host = self._read(slot)
+            if host is not None:
+                hosts.append(host)
+        return hosts
+
+    def query(self, service):
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+            return self._read_slots(list(self.services.get(service, {}).values()))
+
+    def query_many(self, services):
+        return dict((service, self.query(service)) for service in services)
+
+    def query_secondary_index(self, service_repo_name):
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+            hosts = self._read_slots(list(self.repos.get(service_repo_name, ())))
+        return [host for host in hosts if host.service_repo_name == service_repo_name]
+
+    def scan(self, checked_in_before=None):
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+            return self._read_slots(range(self.indexed))
+
+    def get(self, service, ip_address):
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+            slot = self._slot(service, ip_address)
+            if slot is None:
+                return None
+            return self._read(slot)
+
+    def put(self, host):
+        with self._locked():
+            self._refresh()
+            slot = self._slot(host.service, host.ip_address)
+            previous = None if slot is None else self.RECORD.unpack_from(self.map, self._offset(slot))
+            record = self._pack(host, previous)
+            if previous is not None and previous[2] == record[2]:
+                self.RECORD.pack_into(self.map, self._offset(slot), *record)
+            else:
+                if slot is not None:
+                    self._kill(slot)
+                self._append(record)
+        self._compact_if_due()
+        return True
+
+    def delete(self, service, ip_address):
+        with self._locked():
+            self._refresh()
+            slot = self._slot(service, ip_address)
+            if slot is None:
+                return False
+            self._kill(slot)
+        return True
+
+    def delete_expired(self, hosts, checked_in_before):
+        deleted = []
+        with self._locked():
+            self._refresh()
+            for host in hosts:
+                slot = self._slot(host.service, host.ip_address)
+                if slot is None:
+                    continue
+                stored_host = self._read(slot)
+                if stored_host is not None and _utc(stored_host.last_check_in) < _utc(checked_in_before):
+                    self._kill(slot)
+                    deleted.append(host)
+        self._compact_if_due()
+        return deleted
+
+    def _compact_if_due(self):
+        """Compacts once most records are dead, or once the strings file doubled since it was opened.
+
+        Replaced revisions and tags leave unused strings behind even when no record dies.
+        """
+        if (self.dead > self.INITIAL_CAPACITY and self.dead > self.indexed - self.dead) or \
+                self.strings_size > max(self.MIN_STRINGS_COMPACT_SIZE, 2 * self.opened_strings_size):
+            self.compact()
+
+    def compact(self):
+        """Rewrites the records file without dead records, and the strings file without the strings they used.
+
+        The new files are of the next generation, the records file is renamed over the previous one
+        last, so that a crash leaves either generation consistent.
+        """
+        with self._locked():
+            self._refresh()
+            generation = self.generation + 1
+            # old string id -> new string id, and string -> new string id, as processes may
+            # have appended the same string
+            string_ids = {self.NONE: self.NONE}
+            new_ids = {}
+            strings = []
+            strings_size = 0
+            live = []
+            for slot in range(self.indexed):
+                record = list(self.RECORD.unpack_from(self.map, self._offset(slot)))
+                if not record[0]:
+                    continue
+                for field in range(1, 5):
+                    if record[field] not in string_ids:
+                        value = self._string(record[field])
+                        if value not in new_ids:
+                            encoded = value.encode('utf-8')
+                            strings.append(self.LENGTH.pack(len(encoded)) + encoded)
+                            new_ids[value] = strings_size
+                            strings_size += self.LENGTH.size + len(encoded)
+                        string_ids[record[field]] = new_ids[value]
+                    record[field] = string_ids[record[field]]
+                live.append(self.RECORD.pack(*record))
+            capacity = max(self.INITIAL_CAPACITY, 2 * len(live))
+            with open(self._strings_file(generation), 'wb') as f:
+                f.write(b''.join(strings))
+                f.flush()
+                os.fsync(f.fileno())
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, len(live), generation))
+                f.write(b''.join(live))
+                f.write(b'\0' * (self.RECORD.size * (capacity - len(live))))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_file, self.file)
+            if os.path.isfile(self.strings_file):
+                os.remove(self.strings_file)
+            self._close()
+            self._open()
+
+
+class WriteBuffer(object):
+    """Buffers host writes and flushes them in batches from a background greenlet.
+
+    Pending hosts are deduplicated per service/ip_address, the latest write wins. They are
+    flushed every interval seconds, or as soon as batch_size of them are pending. Once
+    max_pending hosts are pending, the writer flushes them itself, so that a slow backend
+    slows down writers rather than growing the buffer. If that flush fails, writers write their
+    host themselves until the buffer can be flushed again, failing like unbuffered writes do.
+    Pending hosts are flushed at exit.
+
+    Hosts being flushed stay visible to get and overlay until they are written, flushes run one
+    at a time.
+    """
+
+    def __init__(self, write, interval, batch_size, max_pending):
+        """
+        :param write: called with a list of hosts to persist them
+        :param interval: maximum number of seconds a host stays pending
+        :param batch_size: number of pending hosts triggering a flush
+        :param max_pending: number of pending hosts at which writers flush themselves
+
+        :type write: callable
+        :type interval: float
+        :type batch_size: int
+        :type max_pending: int
+        """
+        self.write = write
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        # Hosts written by the running flush, if any.
+        self.in_flight = {}
+        self.flush_lock = Semaphore()
+        self.flush_requested = Event()
+        self.greenlet = None
+
+    def get(self, service, ip_address):
+        """Returns the pending host for the given service/ip_address, None if not pending."""
+
+        key = (service, ip_address)
+        host = self.pending.get(key)
+        if host is None:
+            return self.in_flight.get(key)
+        return host
+
+    def add(self, host):
+        """Adds the given host to the pending writes, replacing any pending write for it.
+
+        :param host: host entry to write
+        :type host: HostRecord
+        """
+        key = (host.service, host.ip_address)
+        if key not in self.pending and len(self.pending) >= self.max_pending and not self.flush():
+            # The backend keeps failing, write through rather than growing the buffer.
+            self.write([host])
+            get_stats('service.host').incr("write_behind.write_through")
+            return
+        self.pending.pop(key, None)
+        self.pending[key] = host
+        if self.greenlet is None:
+            self.start()
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+        elif len(self.pending) >= self.batch_size:
+            self.flush_requested.set()
+
+    def discard(self, service, ip_address):
+        """Drops the pending write for the given service/ip_address.
+
+        If the host is being flushed, waits for the flush to complete, so that a delete following
+        the discard is not undone by the write. The host is not put back if the flush fails.
+
+        :returns: True if a write was pending, False otherwise
+        :rtype: bool
+        """
+        key = (service, ip_address)
+        was_pending = self.pending.pop(key, None) is not None
+        if self.in_flight.pop(key, None) is not None:
+            with self.flush_lock:
+                return True
+        return was_pending
+
+    def overlay(self, hosts, match):
+        """Generates the given stored hosts with pending writes applied.
+
+        :param hosts: hosts read from the backend
+        :param match: tells whether a pending host belongs to the result
+
+        :type hosts: list(HostRecord)
+        :type match: callable
+
+        :returns: the hosts, pending versions replacing stored ones, followed by pending new hosts
+        :rtype: generator(HostRecord)
+        """
+        pending = collections.OrderedDict(
+            (key, host) for key, host in self.in_flight.items() if match(host))
+        for key, host in self.pending.items():
+            if match(host):
+                pending[key] = host
+        for host in hosts:
+            pending_host = pending.pop((host.service, host.ip_address), None)
+            yield host if pending_host is None else pending_host
+        for host in pending.values():
+            yield host
+
+    def flush(self):
+        """Writes every pending host.
+
+        Hosts are put back into the buffer if the write fails, unless written again or discarded
+        meanwhile. Waits for the running flush to complete first, if any.
+
+        :returns: True if all pending hosts were written, False otherwise
+        :rtype: bool
+        """
+        with self.flush_lock:
+            if not self.pending:
+                return True
+            self.in_flight = self.pending
+            self.pending = collections.OrderedDict()
+            hosts = list(self.in_flight.values())
+            statsd = get_stats('service.host')
+            try:
+                self.write(hosts)
+            except Exception:
+                logging.exception("Failed to flush %d buffered hosts" % len(hosts))
+                for key, host in self.in_flight.items():
+                    if key not in self.pending:
+                        self.pending[key] = host
+                statsd.incr("write_behind.failure")
+                return False
+            finally:
+                self.in_flight = {}
+            statsd.incr("write_behind.flush")
+            statsd.incr("write_behind.hosts", len(hosts))
+            return True
+
+    def start(self):
+        """Starts flushing in a background greenlet."""
+        self.greenlet = gevent.spawn(self._run)
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.flush_requested.wait(self.interval)
+            self.flush_requested.clear()
+            self.flush()
+
+
+def _record(host):
+    if isinstance(host, dict):
+        return HostRecord.from_dict(host)
+    return host
+
+
+def _records(hosts):
+    return [_record(host) for host in hosts]
+
+
+def _is_conditional_check_failure(error):
+    """Whether the given pynamo error was caused by the condition of the write not holding."""
+    cause = getattr(error, 'cause', None)
+    response = getattr(cause, 'response', None) or {}
+    return response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
 
 
 class DynamoQueryBackend(QueryBackend):
+    def __init__(self, write_buffer=None, scan_segments=1):
+        """
+        :param write_buffer: buffers puts and upserts to write them with BatchWriteItem. Reads see
+                             buffered writes of this process, but not those of other processes.
+        :param scan_segments: number of segments of the table scanned in parallel by scan
+
+        :type write_buffer: WriteBuffer
+        :type scan_segments: int
+        """
+        self.write_buffer = write_buffer
+        self.scan_segments = scan_segments
+
     def query(self, service):
-        return self._read_cursor(Host.query(service))
+        hosts = self._read_cursor(Host.query(service))
+        if self.write_buffer is None:
+            return hosts
+        return self.write_buffer.overlay(hosts, lambda host: host.service == service)
 
     def query_secondary_index(self, service_repo_name):
-        return self._read_cursor(Host.service_repo_name_index.query(service_repo_name))
+        hosts = self._read_cursor(Host.service_repo_name_index.query(service_repo_name))
+        if self.write_buffer is None:
+            return hosts
+        return self.write_buffer.overlay(hosts, lambda host: host.service_repo_name == service_repo_name)
+
+    def scan(self, checked_in_before=None):
+        """
+        With more than one scan segment, the segments are scanned in parallel through the query
+        pool and the hosts are only returned once every segment is read.
+        """
+
+        filters = {}
+        if checked_in_before is not None:
+            filters['last_check_in__lt'] = checked_in_before
+        if self.scan_segments > 1:
+            def scan_segment(segment):
+                return list(self._read_cursor(Host.scan(segment=segment, total_segments=self.scan_segments, **filters)))
+            hosts = itertools.chain.from_iterable(query_pool.map(scan_segment, range(self.scan_segments)))
+        else:
+            hosts = self._read_cursor(Host.scan(**filters))
+        if self.write_buffer is None:
+            return hosts
+        return self.write_buffer.overlay(hosts, lambda host: True)
 
     def get(self, service, ip_address):
+        if self.write_buffer is not None:
+            host = self.write_buffer.get(service, ip_address)
+            if host is not None:
+                return host
         try:
             host = Host.get(service, ip_address)
             if host is None:
                 return None
-            return self._pynamo_host_to_dict(host)
+            return self._pynamo_host_to_record(host)
         except Host.DoesNotExist:
             return None
 
     def put(self, host):
-        self._dict_to_pynamo_host(host).save()
+        if self.write_buffer is not None:
+            self.write_buffer.add(host)
+            return True
+        self._record_to_pynamo_host(host).save()
+
+    def upsert(self, host):
+        """
+        Updates the host attributes in place with a single UpdateItem, getting the previously
+        stored host back. The same UpdateItem sets the tags of a new host, so that it is never stored
+        without them. Tags are stored as a JSON document so they can't be merged by DynamoDB, for an
+        existing host a second UpdateItem writes the merged tags, but only when they actually changed.
+
+        With a write buffer, the merged host is buffered instead. This needs to read the stored
+        host, unless it is still pending.
+        """
+
+        if self.write_buffer is not None:
+            return super(DynamoQueryBackend, self).upsert(host)
+
+        actions = [
+            Host.port.set(host.port),
+            Host.revision.set(host.revision),
+            Host.last_check_in.set(host.last_check_in),
+            Host.tags.set(Host.tags | dict(host.tags)),
+        ]
+        # pynamo does not store empty strings.
+        if host.service_repo_name:
+            actions.append(Host.service_repo_name.set(host.service_repo_name))
+        else:
+            actions.append(Host.service_repo_name.remove())
+
+        connection = Host._get_connection()
+        response = connection.update_item(host.service, host.ip_address, actions=actions,
+                                          return_values=ALL_OLD)
+
+        stored_host = None
+        tags = {}
+        if response.get(ATTRIBUTES):
+            stored_host = self._pynamo_host_to_record(Host.from_raw_data(response[ATTRIBUTES]))
+            tags.update(stored_host.tags)
+        tags.update(host.tags)
+        if stored_host is not None and tags != stored_host.tags:
+            connection.update_item(host.service, host.ip_address, actions=[Host.tags.set(tags)])
+        return stored_host
 
     def batch_put(self, hosts):
         """
@@ -254,12 +1278,67 @@ class DynamoQueryBackend(QueryBackend):
         short and the next host update will return things to normal.
         """
 
-        # TODO need to look at the exceptions dynamo can throw here, catch, return False
-        with Host.batch_write() as batch:
+        if self.write_buffer is not None:
             for host in hosts:
-                batch.save(self._dict_to_pynamo_host(host))
+                self.write_buffer.add(host)
+            return True
+        try:
+            self.write_hosts(hosts)
+        except PynamoDBException:
+            logging.exception("Failed to store %d hosts" % len(hosts))
+            return False
         return True
 
+    def batch_get(self, keys):
+        """Gets the given hosts with BatchGetItem, hosts pending in the write buffer excepted."""
+
+        hosts = []
+        to_get = []
+        for service, ip_address in keys:
+            host = None
+            if self.write_buffer is not None:
+                host = self.write_buffer.get(service, ip_address)
+            if host is None:
+                to_get.append((service, ip_address))
+            else:
+                hosts.append(host)
+        if to_get:
+            hosts.extend(self._read_cursor(Host.batch_get(to_get)))
+        return hosts
+
+    def write_hosts(self, hosts):
+        """Puts the given hosts with BatchWriteItem, 25 at a time.
+
+        :param hosts: list of host records to write
+
+        :type hosts: list(HostRecord)
+        """
+
+        with Host.batch_write() as batch:
+            for host in hosts:
+                batch.save(self._record_to_pynamo_host(host))
+
+    def delete_expired(self, hosts, checked_in_before):
+        """
+        Each host is deleted with a DeleteItem conditional on its last_check_in, hosts pending in
+        the write buffer checked in again and are left alone.
+        """
+
+        statsd = get_stats('service.host')
+        deleted = []
+        for host in hosts:
+            if self.write_buffer is not None and self.write_buffer.get(host.service, host.ip_address) is not None:
+                continue
+            try:
+                Host(host.service, host.ip_address).delete(condition=Host.last_check_in < checked_in_before)
+            except DeleteError as e:
+                if _is_conditional_check_failure(e):
+                    continue
+                raise
+            statsd.incr("delete.%s" % host.service)
+            deleted.append(host)
+        return deleted
+
     def delete(self, service, ip_address):
         """
         Technically we should not have several entries for the given service and ip address.
@@ -267,9 +1346,13 @@ class DynamoQueryBackend(QueryBackend):
         one registered service/ip.
         """
 
+        was_pending = self.write_buffer is not None and self.write_buffer.discard(service, ip_address)
         statsd = get_stats('service.host')
         hosts = list(self._read_cursor(Host.query(service, ip_address__eq=ip_address)))
         if len(hosts) == 0:
+            if was_pending:
+                statsd.incr("delete.%s" % service)
+                return True
             logging.error(
                 "Delete called for nonexistent host: service={} ip={}".format(service, ip_address)
             )
@@ -281,7 +1364,7 @@ class DynamoQueryBackend(QueryBackend):
             )
             return False
         else:
-            self._dict_to_pynamo_host(hosts[0]).delete()
+            self._record_to_pynamo_host(hosts[0]).delete()
             statsd.incr("delete.%s" % service)
             return True
 
@@ -293,50 +1376,46 @@ class DynamoQueryBackend(QueryBackend):
         :type cursor: TODO dig it up, some pynamo nonsense
 
         :returns: generator based on the cursor
-        :retype: generator(dict)
+        :retype: generator(HostRecord)
         """
 
         for host in cursor:
-            yield self._pynamo_host_to_dict(host)
+            yield self._pynamo_host_to_record(host)
 
-    def _pynamo_host_to_dict(self, host):
-        """Converts a pynamo host into a dict.
+    def _pynamo_host_to_record(self, host):
+        """Converts a pynamo host into a host record.
 
         :param host: pynamo host
 
         :type host: Host
 
-        :returns: dictionary with host info
-        :rtype: dict
+        :returns: the host record
+        :rtype: HostRecord
         """
 
-        _host = {}
-        _host['service'] = host.service
-        _host['ip_address'] = host.ip_address
-        _host['service_repo_name'] = host.service_repo_name
-        _host['port'] = host.port
-        _host['revision'] = host.revision
-        _host['last_check_in'] = host.last_check_in
-        _host['tags'] = host.tags
-        return _host
-
-    def _dict_to_pynamo_host(self, host):
-        """Converts a dict to a pynamo host.
+        return HostRecord(host.service,
+                          host.ip_address,
+                          host.service_repo_name,
+                          host.port,
+                          host.revision,
+                          host.last_check_in,
+                          host.tags)
 
-        Note that if any keys are missing, there will be an error.
+    def _record_to_pynamo_host(self, host):
+        """Converts a host record to a pynamo host.
 
-        :param host: dict with host info
+        :param host: the host record
 
-        :type host: dict
+        :type host: HostRecord
 
         :returns: pynamo Host
         :rtype: Host
         """
 
-        return Host(service=host['service'],
-                    ip_address=host['ip_address'],
-                    service_repo_name=host['service_repo_name'],
-                    port=host['port'],
-                    revision=host['revision'],
-                    last_check_in=host['last_check_in'],
-                    tags=host['tags'])
+        return Host(service=host.service,
+                    ip_address=host.ip_address,
+                    service_repo_name=host.service_repo_name,
+                    port=host.port,
+                    revision=host.revision,
+                    last_check_in=host.last_check_in,
+                    tags=dict(host.tags))
@@ -0,0 +1,51 @@
+import json
+import zlib
+
+
+class HostSerializer(object):
+
+    @staticmethod
+    def serialize(hosts):
+        """Converts host records to serializable dictionaries
+
+        :param hosts: list of host records
+        :type hosts: list(HostRecord)
+
+        :returns: list of host info dictionaries
+        :rtype: list of dict
+        """
+
+        _hosts = []
+        for host in hosts:
+            _host = host.to_dict()
+            _host['last_check_in'] = str(_host['last_check_in'])
+            _hosts.append(_host)
+        return _hosts
+
+    @staticmethod
+    def encode(payload):
+        """Encodes a response payload to a JSON body
+
+        :param payload: the response payload, hosts already serialized
+        :type payload: dict
+
+        :returns: the JSON encoded payload
+        :rtype: bytes
+        """
+
+        return json.dumps(payload).encode('utf-8')
+
+    @staticmethod
+    def compress(body):
+        """Gzips an encoded body, for clients sending Accept-Encoding: gzip
+
+        :param body: the encoded body
+        :type body: bytes
+
+        :returns: the gzipped body
+        :rtype: bytes
+        """
+
+        # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,310 @@
+import contextlib
+import errno
+import fcntl
+import gevent
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import time
+
+from .index import HostIndex
+from ..lru import LRUCache
+
+# Magic, expires at, refresh at (0 for none), then the lengths of the version, body and gzipped body.
+HEADER = struct.Struct('<4sddIII')
+MAGIC = b'DSCE'
+
+# Seconds between two attempts at taking a refresh lock held by another process.
+LOCK_POLL_INTERVAL = 0.01
+
+# Seconds between two removals of expired entries by a process writing entries.
+EVICTION_INTERVAL = 60
+
+# Seconds after which a temporary entry file is considered left behind by a crashed process.
+STALE_TMP_AGE = 60
+
+# Number of entries each process keeps mapped, so that reading an unchanged entry again neither
+# maps it nor unpickles its hosts again.
+MAPPED_ENTRIES = 1024
+
+
+class MappedCacheEntry(object):
+    """A cache entry read from a file of a SharedCacheStore.
+
+    The file is mapped rather than read, the encoded bodies are memoryviews over the mapping
+    rather than copies, and the hosts are only unpickled and indexed when asked for. The mapping
+    stays valid after the file is replaced by a newer entry or removed.
+    """
+
+    def __init__(self, map, file_id=None):
+        """
+        :param map: mapping of an entry file
+        :param file_id: device and inode of the entry file, tells whether it was replaced since
+
+        :type map: mmap.mmap
+        :type file_id: tuple(int, int)
+        """
+        _, self.expires_at, refresh_at, version_size, body_size, gzip_size = HEADER.unpack_from(map, 0)
+        self.map = map
+        self.view = memoryview(map)
+        self.file_id = file_id
+        self.refresh_at = refresh_at or None
+        offset = HEADER.size
+        self.version = map[offset:offset + version_size].decode('ascii')
+        offset += version_size
+        self.body_range = (offset, offset + body_size)
+        offset += body_size
+        self.gzip_body_range = (offset, offset + gzip_size)
+        self.hosts_offset = offset + gzip_size
+        self._hosts = None
+        self._index = None
+
+    @property
+    def body(self):
+        return self.view[self.body_range[0]:self.body_range[1]]
+
+    @property
+    def gzip_body(self):
+        return self.view[self.gzip_body_range[0]:self.gzip_body_range[1]]
+
+    @property
+    def hosts(self):
+        if self._hosts is None:
+            self._hosts = pickle.loads(self.map[self.hosts_offset:])
+        return self._hosts
+
+    @property
+    def index(self):
+        # Not stored in the file, rebuilt by the processes reading the entry with filters.
+        if self._index is None:
+            self._index = HostIndex(self.hosts)
+        return self._index
+
+
+class SharedCacheStore(object):
+    """Keeps cache entries in files of a directory shared by every discovery process of a node.
+
+    Each entry is written to a temporary file renamed over the previous one, so readers never
+    see a partial entry. The directory should be on a tmpfs such as /dev/shm, where entries
+    are only ever held in memory.
+
+    Refreshes of an entry are serialized across processes with an flock on <entry>.lock, so
+    only one process loads a given key at a time.
+
+    Writers remove the expired entries and their lock files every EVICTION_INTERVAL seconds,
+    see evict_expired.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory holding the entry files, created if missing
+        :type directory: str
+        """
+        self.directory = directory
+        self.next_eviction = time.time() + EVICTION_INTERVAL
+        # path -> entry last mapped from that path.
+        self.mapped = LRUCache(MAPPED_ENTRIES)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Returns the entry stored under the given key.
+
+        :param key: cache key
+        :type key: str
+
+        :returns: the stored entry, None if there is none or it expired
+        :rtype: MappedCacheEntry
+        """
+        path = self._path(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            stat = os.fstat(fd)
+            file_id = (stat.st_dev, stat.st_ino)
+            entry = self.mapped[path] if path in self.mapped else None
+            if entry is None or entry.file_id != file_id:
+                if stat.st_size < HEADER.size:
+                    return None
+                map = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+                if map[:len(MAGIC)] != MAGIC:
+                    return None
+                entry = MappedCacheEntry(map, file_id)
+                self.mapped[path] = entry
+        finally:
+            os.close(fd)
+        if entry.expires_at <= time.time():
+            return None
+        return entry
+
+    def peek(self, key):
+        """Returns the entry stored under the given key, like get as no hits or misses are counted.
+
+        :param key: cache key
+        :type key: str
+
+        :returns: the stored entry, None if there is none or it expired
+        :rtype: MappedCacheEntry
+        """
+        return self.get(key)
+
+    def set(self, key, entry, timeout):
+        """Stores the given entry under the given key.
+
+        :param key: cache key
+        :param entry: entry to store
+        :param timeout: seconds after which the entry expires
+
+        :type key: str
+        :type entry: cache.CacheEntry
+        :type timeout: float
+        """
+        path = self._path(key)
+        version = entry.version.encode('ascii')
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, time.time() + timeout, entry.refresh_at or 0,
+                                len(version), len(entry.body), len(entry.gzip_body)))
+            f.write(version)
+            f.write(entry.body)
+            f.write(entry.gzip_body)
+            pickle.dump(entry.hosts, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        if time.time() >= self.next_eviction:
+            self.next_eviction = time.time() + EVICTION_INTERVAL
+            self.evict_expired()
+
+    def evict_expired(self):
+        """Removes the expired entries, lock files without entry and temporary files left behind.
+
+        Entries and lock files are only removed while holding the lock, so that no refresh is
+        running for them.
+
+        :returns: number of entries removed
+        :rtype: int
+        """
+        now = time.time()
+        evicted = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                if self._mtime(path) < now - STALE_TMP_AGE:
+                    _remove(path)
+            elif name.endswith('.lock'):
+                if not os.path.exists(path[:-len('.lock')]):
+                    self._evict(path[:-len('.lock')], now)
+            elif _is_expired(self._expires_at(path), now):
+                evicted += self._evict(path, now)
+        return evicted
+
+    def _evict(self, path, now):
+        with self._locked(path + '.lock', blocking=False) as acquired:
+            if not acquired:
+                return 0
+            # the entry may have been refreshed meanwhile
+            evicted = _is_expired(self._expires_at(path), now)
+            if evicted:
+                _remove(path)
+            if evicted or not os.path.exists(path):
+                _remove(path + '.lock')
+            return int(evicted)
+
+    def _expires_at(self, path):
+        """Returns when the entry stored in the given file expires, 0 if it is invalid, None if missing."""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            return 0
+        return HEADER.unpack(header)[1]
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return time.time()
+            raise
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """Holds the refresh lock of the given key, shared by every process using the directory.
+
+        The lock is polled rather than waited on, so that other greenlets keep running.
+
+        :param key: cache key
+        :param blocking: whether to wait for the lock when another process holds it
+
+        :type key: str
+        :type blocking: bool
+
+        :returns: context manager yielding whether the lock was taken
+        """
+        with self._locked(self._path(key) + '.lock', blocking) as acquired:
+            yield acquired
+
+    @contextlib.contextmanager
+    def _locked(self, lock_path, blocking):
+        while True:
+            lock_file = open(lock_path, 'a')
+            acquired = self._acquire(lock_file, blocking)
+            if not acquired or _is_same_file(lock_file, lock_path):
+                break
+            # removed by evict_expired while waiting for it, lock the new file instead
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _acquire(self, lock_file, blocking):
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if not blocking:
+                return False
+            gevent.sleep(LOCK_POLL_INTERVAL)
+
+
+def _is_same_file(opened_file, path):
+    try:
+        return os.stat(path).st_ino == os.fstat(opened_file.fileno()).st_ino
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _is_expired(expires_at, now):
+    return expires_at is not None and expires_at <= now
@@ -0,0 +1,72 @@
+import gevent
+import logging
+
+from .host import HostService
+from .. import settings
+
+
+class Sweeper(object):
+    """Periodically deletes expired hosts from the backend, off the request path.
+
+    Reads already filter out expired hosts, the sweeper only garbage collects them. While it runs,
+    reads of this process stop deleting expired hosts, see HostService.swept. Backends that do not
+    support scanning are left to reads.
+    """
+
+    def __init__(self, query_backend, interval=None, batch_size=None, max_rate=None):
+        """
+        :param query_backend: backend to sweep
+        :param interval: seconds between sweeps, defaults to SWEEP_INTERVAL
+        :param batch_size: hosts deleted per backend call, defaults to SWEEP_BATCH_SIZE
+        :param max_rate: maximum hosts deleted per second, defaults to SWEEP_MAX_RATE
+
+        :type query_backend: query.QueryBackend
+        :type interval: float
+        :type batch_size: int
+        :type max_rate: float
+        """
+        self.host_service = HostService(query_backend)
+        self.interval = interval or settings.value.SWEEP_INTERVAL
+        self.batch_size = batch_size or settings.value.SWEEP_BATCH_SIZE
+        self.max_rate = max_rate or settings.value.SWEEP_MAX_RATE
+        self.greenlet = None
+
+    def start(self, flask_app):
+        """Starts sweeping in a background greenlet.
+
+        :param flask_app: app whose cached host lists are updated with the deleted hosts
+        :type flask_app: flask.Flask
+        """
+        if self.greenlet is None:
+            HostService.swept = True
+            self.greenlet = gevent.spawn(self._run, flask_app)
+
+    def stop(self):
+        """Stops the background greenlet, if running."""
+        if self.greenlet is not None:
+            HostService.swept = False
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def sweep(self):
+        """Runs a single sweep.
+
+        :returns: number of hosts deleted
+        :rtype: int
+        """
+        return self.host_service.sweep_expired_hosts(self.batch_size, self.max_rate)
+
+    def _run(self, flask_app):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                with flask_app.app_context():
+                    swept = self.sweep()
+                logging.info("Swept %d expired hosts" % swept)
+            except NotImplementedError:
+                logging.warning("The backend does not support scanning, expired hosts are deleted on read instead")
+                HostService.swept = False
+                self.greenlet = None
+                return
+            except Exception:
+                logging.exception("Sweeping expired hosts failed")
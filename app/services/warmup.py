@@ -0,0 +1,61 @@
+import gevent
+import logging
+import time
+
+from .host import HostService
+from ..stats import get_stats
+
+
+class Warmer(object):
+    """Loads the host lists of every service into the cache on startup, with a single backend scan.
+
+    The flask app reports itself as not ready until the cache is warm, so that /healthcheck keeps
+    the process out of the load balancer rather than sending its first requests to the backend.
+    """
+
+    def __init__(self, query_backend):
+        """
+        :param query_backend: backend to load the hosts from
+        :type query_backend: query.QueryBackend
+        """
+        self.host_service = HostService(query_backend)
+        self.greenlet = None
+        # Seconds the last warm-up took and number of services it loaded.
+        self.duration = None
+        self.services = None
+
+    def start(self, flask_app):
+        """Warms the cache up in a background greenlet, the app is not ready until it is done.
+
+        The app is made ready again even when the warm-up fails, host lists are then loaded on demand.
+
+        :param flask_app: app whose cache is warmed up
+        :type flask_app: flask.Flask
+        """
+        if self.greenlet is None:
+            flask_app.ready = False
+            self.greenlet = gevent.spawn(self._run, flask_app)
+
+    def warm(self):
+        """Runs a single warm-up.
+
+        :returns: number of services loaded
+        :rtype: int
+        """
+        start = time.time()
+        self.services = self.host_service.warm_cache()
+        self.duration = time.time() - start
+        logging.info("Warmed up the cache with %d services in %.3f seconds" % (self.services, self.duration))
+        statsd = get_stats('service.host')
+        statsd.timing('warmup.duration', int(self.duration * 1000))
+        statsd.gauge('warmup.services', self.services)
+        return self.services
+
+    def _run(self, flask_app):
+        try:
+            with flask_app.app_context():
+                self.warm()
+        except Exception:
+            logging.exception("Warming up the cache failed")
+        finally:
+            flask_app.ready = True
@@ -13,18 +13,75 @@ defaults = {
     'DYNAMODB_TABLE_HOSTS': '',
     # Used only for development in case of DynamoDB backend running locally.
     'DYNAMODB_URL': '',
+    # Only applied when DynamoDB backend is used. Buffer host writes for up to this many seconds
+    # and write them with BatchWriteItem, 0 writes every host within its request.
+    'DYNAMODB_WRITE_BEHIND_INTERVAL': 0.0,
+    # Number of buffered host writes triggering a batch write before the interval is over.
+    'DYNAMODB_WRITE_BEHIND_BATCH_SIZE': 100,
+    # Number of buffered host writes at which registrations write the buffer themselves.
+    'DYNAMODB_WRITE_BEHIND_MAX_PENDING': 5000,
+    # Only applied when DynamoDB backend is used. Number of segments of the hosts table scanned
+    # in parallel, by the cache warm-up and the sweeper.
+    'DYNAMODB_SCAN_SEGMENTS': 1,
     # Only applied when DynamoDB backend is used. Create sample DynamoDB table for testing.
     'DYNAMODB_CREATE_TABLES_IN_APP': '',
     # Sweep host (remove from discovery service and backend storage)
     # if the last heartbeat was not performed in last HOST_TTL seconds.
     'HOST_TTL': 600,  # 10 minutes.
+    # Skip persisting heartbeats that only move last_check_in forward, as long as the stored
+    # last_check_in is younger than this fraction of HOST_TTL. 0 persists every heartbeat.
+    'HEARTBEAT_WRITE_FRACTION': 0.0,
+    # Number of hosts whose last persisted state is tracked to coalesce heartbeats.
+    'HEARTBEAT_TRACKED_HOSTS': 100000,
+    # Expired hosts are deleted from backend storage by a background sweeper every
+    # SWEEP_INTERVAL seconds, in every process. 0 disables the sweeper, expired hosts
+    # are then deleted in the background after being read.
+    'SWEEP_INTERVAL': 0,
+    # Number of expired hosts deleted per backend call by the sweeper.
+    'SWEEP_BATCH_SIZE': 25,
+    # Maximum number of expired hosts deleted per second by the sweeper.
+    'SWEEP_MAX_RATE': 50,
     # Keep data cached in discovery service during CACHE_TTL seconds,
     # otherwise call backend storage for data.
     'CACHE_TTL': 30,  # 30 seconds.
-    # Supported values: DynamoDB, InMemory, InFile.
+    # Serve cached data older than CACHE_SOFT_TTL seconds while refreshing it in the
+    # background; CACHE_TTL is then the hard expiry. 0 disables background refreshes.
+    'CACHE_SOFT_TTL': 0,
+    # Load the host lists of every service into the cache on startup, /healthcheck fails until
+    # they are loaded.
+    'CACHE_WARMUP': False,
+    # Number of filtered views of cached host lists kept per process, e.g. the hosts of an az. With the
+    # simple cache type, views are bounded by CACHE_MAX_BYTES instead.
+    'CACHE_FILTERED_VIEWS': 1000,
+    # Number of changes of the host list of a service kept for delta responses, per process.
+    'CACHE_CHANGE_LOG_SIZE': 20,
+    # Number of services whose host list changes are kept, per process.
+    'CACHE_CHANGE_LOG_SERVICES': 10000,
+    # Keep empty host lists (e.g. unknown services) cached during CACHE_NEGATIVE_TTL seconds.
+    'CACHE_NEGATIVE_TTL': 10,  # 10 seconds.
+    # Longest time in seconds a watch request is held open waiting for host list changes.
+    'WATCH_TIMEOUT': 60,  # 1 minute.
+    # Longest time in seconds an EDS request acknowledging the current version is held open
+    # waiting for host list changes, 0 answers right away.
+    'EDS_WATCH_TIMEOUT': 0,
+    # Only applied when InFile backend is used. Number of journal records between fsyncs.
+    'LOCAL_FILE_FSYNC_EVERY': 100,
+    # Only applied when InFile backend is used. Number of journal records between snapshots.
+    'LOCAL_FILE_SNAPSHOT_EVERY': 10000,
+    # Only applied when MappedFile backend is used. Path of the host records file, shared by
+    # every discovery process on the box.
+    'MAPPED_FILE': '/tmp/discovery_hosts',
+    # Supported values: DynamoDB, InMemory, InFile, MappedFile.
     'BACKEND_STORAGE': 'DynamoDB',
-    # Flask cache type, null means no caching.
+    # Flask cache type, null means no caching. Host lists are cached by MemoryCacheStore rather
+    # than the flask cache with simple.
     'CACHE_TYPE': 'null',
+    # Memory budget in bytes of the host lists cached by each process with the simple cache type.
+    'CACHE_MAX_BYTES': 256 * 1024 * 1024,  # 256 MiB.
+    # Directory of a host list cache shared by every discovery process of the node, preferably
+    # on a tmpfs. Replaces the per process flask cache of host lists when set.
+    'SHARED_CACHE_DIR': '',
+    # Size of the DynamoDB connection pool, also bounds the backend queries run concurrently by query_many.
     'CONNECTION_POOL_SIZE': 100
 }
 
@@ -34,6 +91,8 @@ for name, value in defaults.items():
         values[name] = bool(getenv(name, value))
     elif isinstance(value, int):
         values[name] = int(getenv(name, value))
+    elif isinstance(value, float):
+        values[name] = float(getenv(name, value))
     elif isinstance(value, str):
         values[name] = getenv(name, value)
 
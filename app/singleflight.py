@@ -0,0 +1,90 @@
+"Request coalescing"
+from gevent.event import AsyncResult
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls for the same key into a single call.
+
+    The first greenlet to ask for a key runs the function; every other greenlet
+    asking for that key while the call is in flight waits for and shares its result
+    (or its exception).
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    def do(self, key, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) unless a call for key is already in flight.
+
+        :param key: identifies calls that can share a result
+        :param fn: the function to call
+
+        :type key: hashable
+        :type fn: callable
+
+        :returns: the result of the call, and whether it was shared with another caller
+        :rtype: tuple(object, bool)
+        """
+
+        call = self.calls.get(key)
+        if call is not None:
+            return call.get(), True
+
+        call = AsyncResult()
+        self.calls[key] = call
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as ex:
+            call.set_exception(ex)
+            raise
+        else:
+            call.set(result)
+            return result, False
+        finally:
+            del self.calls[key]
+
+    def do_many(self, keys, fn, *args, **kwargs):
+        """Runs fn(keys, *args, **kwargs) with the keys that have no call in flight.
+
+        The results of the keys already in flight are waited for and shared instead.
+
+        :param keys: identify calls that can share a result
+        :param fn: the function to call, returning a dict holding the result of each key
+
+        :type keys: list(hashable)
+        :type fn: callable
+
+        :returns: key -> result of the call for that key
+        :rtype: dict
+        """
+
+        shared = {}
+        own = []
+        for key in set(keys):
+            call = self.calls.get(key)
+            if call is not None:
+                shared[key] = call
+            else:
+                call = AsyncResult()
+                self.calls[key] = call
+                own.append(key)
+
+        try:
+            results = fn(own, *args, **kwargs) if own else {}
+            for key in own:
+                self.calls[key].set(results[key])
+        except Exception as ex:
+            for key in own:
+                if not self.calls[key].ready():
+                    self.calls[key].set_exception(ex)
+            raise
+        finally:
+            for key in own:
+                del self.calls[key]
+
+        for key, call in shared.items():
+            results[key] = call.get()
+        return results
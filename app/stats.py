@@ -1,10 +1,108 @@
+import atexit
 import os
 
+import gevent
 import statsd
 
 
+class Metrics(object):
+    """Process-wide statsd client, buffering metrics and sending them in batches.
+
+    Metrics are added to a single pipeline, which is sent once it holds batch_size metrics or
+    flush_interval seconds after the first metric it got, packed into as few UDP packets as
+    they fit in. Emitting a metric thus neither opens a socket nor sends a packet.
+    """
+
+    def __init__(self, client, flush_interval, batch_size):
+        """
+        :param client: client sending the metrics
+        :param flush_interval: longest time in seconds a metric is buffered, 0 sends every metric
+        :param batch_size: number of buffered metrics sent right away
+
+        :type client: statsd.StatsClient
+        :type flush_interval: float
+        :type batch_size: int
+        """
+        self.client = client
+        self.pipeline = client.pipeline()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = 0
+        self.flusher = None
+
+    def added(self):
+        """Counts a metric added to the pipeline, sending it when due."""
+        self.pending += 1
+        if self.pending >= self.batch_size or not self.flush_interval:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = gevent.spawn_later(self.flush_interval, self._flush_later)
+
+    def flush(self):
+        """Sends the buffered metrics."""
+        self.pending = 0
+        self.pipeline.send()
+
+    def _flush_later(self):
+        self.flusher = None
+        self.flush()
+
+
+class Stats(object):
+    """Emits metrics under a prefix, through the process-wide Metrics."""
+
+    def __init__(self, metrics, prefix):
+        """
+        :param metrics: buffers and sends the metrics
+        :param prefix: prepended to the name of every metric
+
+        :type metrics: Metrics
+        :type prefix: str
+        """
+        self.metrics = metrics
+        self.prefix = prefix + '.' if prefix else ''
+
+    def incr(self, stat, count=1, rate=1):
+        self.metrics.pipeline.incr(self.prefix + stat, count, rate)
+        self.metrics.added()
+
+    def decr(self, stat, count=1, rate=1):
+        self.metrics.pipeline.decr(self.prefix + stat, count, rate)
+        self.metrics.added()
+
+    def timing(self, stat, delta, rate=1):
+        self.metrics.pipeline.timing(self.prefix + stat, delta, rate)
+        self.metrics.added()
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        self.metrics.pipeline.gauge(self.prefix + stat, value, rate, delta)
+        self.metrics.added()
+
+    def set(self, stat, value, rate=1):
+        self.metrics.pipeline.set(self.prefix + stat, value, rate)
+        self.metrics.added()
+
+
+metrics = Metrics(
+    statsd.StatsClient(os.environ.get('STATSD_HOST', 'localhost'), int(os.environ.get('STATSD_PORT', 8125))),
+    flush_interval=float(os.environ.get('STATSD_FLUSH_INTERVAL', 1)),
+    batch_size=int(os.environ.get('STATSD_BATCH_SIZE', 100)))
+atexit.register(metrics.flush)
+
+# prefix -> Stats, shared by every caller.
+_stats = {}
+
+
 def get_stats(prefix):
-    host = os.environ.get('STATSD_HOST', 'localhost')
-    port = int(os.environ.get('STATSD_PORT', 8125))
-    stats = statsd.StatsClient(host, port, prefix=prefix)
+    """Returns the metrics facade for the given prefix, shared by the whole process.
+
+    :param prefix: prepended to the name of every metric
+    :type prefix: str
+
+    :returns: the facade
+    :rtype: Stats
+    """
+    stats = _stats.get(prefix)
+    if stats is None:
+        stats = _stats[prefix] = Stats(metrics, prefix)
     return stats
@@ -1,9 +1,16 @@
+import gzip
+import io
+import json
 import unittest
 from flask import Flask
 from flask.ext.cache import Cache
 import discovery
 from discovery.app.models import Host
-from discovery.app.resources.api import RepoRegistration, Registration, BackendSelector
+from discovery.app.models.record import HostRecord
+from discovery.app.services import cache
+from discovery.app.services.host import STORE_FAILED
+from discovery.app.resources.api import (RepoRegistration, Registration, RegistrationBatch, BackendSelector,
+                                         EndpointDiscovery)
 from mock import patch, Mock
 
 
@@ -35,16 +42,17 @@ class ApiResourceTestCase(unittest.TestCase):
 
     def test_get_no_hosts(self):
         registration = Registration()
-        response, response_code = registration.get('foo')
+        with self.app.test_request_context():
+            response = registration.get('foo')
         expected = {
             "hosts": [],
             "service": "foo",
             "env": "development"
         }
-        assert response_code == 200
-        assert response == expected
+        assert response.status_code == 200
+        assert json.loads(response.data.decode('utf-8')) == expected
 
-    @patch('discovery.app.services.host.HostService.list')
+    @patch('discovery.app.services.host.HostService._query')
     def test_get_with_hosts(self, get_hosts):
         expected_hosts = [
             {
@@ -72,30 +80,132 @@ class ApiResourceTestCase(unittest.TestCase):
                 }
             },
         ]
-        get_hosts.return_value = expected_hosts
+        get_hosts.return_value = [HostRecord.from_dict(host) for host in expected_hosts]
         registration = Registration()
         registration._get_param = Mock(side_effect=self.generate_valid_params)
-        response, response_code = registration.get('foo')
+        with self.app.test_request_context():
+            response = registration.get('foo')
         expected = {
             "hosts": expected_hosts,
             "service": "foo",
             "env": "development"
         }
-        assert response_code == 200
-        assert response == expected
+        assert response.status_code == 200
+        assert json.loads(response.data.decode('utf-8')) == expected
+
+    @patch('discovery.app.services.host.HostService._query')
+    def test_get_gzipped(self, get_hosts):
+        get_hosts.return_value = []
+        registration = Registration()
+        with self.app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = registration.get('foo')
+        expected = {
+            "hosts": [],
+            "service": "foo",
+            "env": "development"
+        }
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        body = gzip.GzipFile(fileobj=io.BytesIO(response.data)).read()
+        assert json.loads(body.decode('utf-8')) == expected
+
+    @patch('discovery.app.services.host.HostService._query')
+    def test_get_filtered(self, get_hosts):
+        get_hosts.return_value = [
+            HostRecord('foo', '10.10.10.10', None, 10, 'blah', 'timestamp', {'az': 'a', 'load_balancing_weight': 50}),
+            HostRecord('foo', '10.10.10.11', None, 10, 'blah', 'timestamp', {'az': 'b'}),
+            HostRecord('foo', '10.10.10.12', None, 10, 'blah', 'timestamp', {'az': 'a', 'canary': True}),
+        ]
+        registration = Registration()
+        with self.app.test_request_context('/?az=a&canary=false'):
+            response = registration.get('foo')
+        hosts = json.loads(response.data.decode('utf-8'))['hosts']
+        assert [host['ip_address'] for host in hosts] == ['10.10.10.10']
+
+        with self.app.test_request_context('/?min_weight=2'):
+            filtered = registration.get('foo')
+        with self.app.test_request_context('/'):
+            unfiltered = registration.get('foo')
+        assert [host['ip_address'] for host in json.loads(filtered.data.decode('utf-8'))['hosts']] == ['10.10.10.10']
+        assert len(json.loads(unfiltered.data.decode('utf-8'))['hosts']) == 3
+        assert filtered.get_etag() != unfiltered.get_etag()
+        assert get_hosts.call_count == 1
+
+    @patch('discovery.app.services.host.HostService._query')
+    def test_get_delta(self, get_hosts):
+        hosts = [HostRecord('foo', '10.10.10.1%d' % i, None, 10, 'blah', 'timestamp', {}) for i in range(5)]
+        get_hosts.return_value = hosts
+        registration = Registration()
+        with self.app.test_request_context('/'):
+            version, _ = registration.get('foo').get_etag()
+        cache.services.set('foo', hosts[1:] + [HostRecord('foo', '10.10.10.20', None, 10, 'blah', 'timestamp', {})])
+
+        with self.app.test_request_context('/?since=%s' % version):
+            response = registration.get('foo')
+        delta = json.loads(response.data.decode('utf-8'))
+        assert delta['since'] == version
+        assert delta['version'] == response.get_etag()[0]
+        assert [host['ip_address'] for host in delta['added']] == ['10.10.10.20']
+        assert delta['updated'] == []
+        assert delta['removed'] == ['10.10.10.10']
+
+        # unknown versions get the full host list
+        with self.app.test_request_context('/?since=unknown'):
+            response = registration.get('foo')
+        assert len(json.loads(response.data.decode('utf-8'))['hosts']) == 5
+
+    def test_get_invalid_filter(self):
+        with self.app.test_request_context('/?canary=maybe'):
+            response, response_code = Registration().get('foo')
+        assert response_code == 400
+
+        with self.app.test_request_context('/?min_weight=heavy'):
+            response, response_code = Registration().get('foo')
+        assert response_code == 400
+
+    @patch('discovery.app.services.host.HostService._query')
+    def test_get_not_modified(self, get_hosts):
+        get_hosts.return_value = []
+        registration = Registration()
+        with self.app.test_request_context():
+            response = registration.get('foo')
+        etag, _ = response.get_etag()
+        assert etag
+
+        with self.app.test_request_context(headers={'If-None-Match': 'W/"%s"' % etag}):
+            response = registration.get('foo')
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.get_etag() == (etag, True)
+
+        with self.app.test_request_context(headers={'If-None-Match': 'W/"stale"'}):
+            response = registration.get('foo')
+        assert response.status_code == 200
+
+    @patch('discovery.app.services.host.HostService._query_secondary_index')
+    def test_get_service_repo_name_not_modified(self, get_hosts):
+        get_hosts.return_value = []
+        registration = RepoRegistration()
+        with self.app.test_request_context():
+            etag, _ = registration.get('bar').get_etag()
+
+        with self.app.test_request_context(headers={'If-None-Match': 'W/"%s"' % etag}):
+            response = registration.get('bar')
+        assert response.status_code == 304
 
     def test_get_service_repo_name_no_hosts(self):
         registration = RepoRegistration()
-        response, response_code = registration.get('foo')
+        with self.app.test_request_context():
+            response = registration.get('foo')
         expected = {
             "hosts": [],
             "service_repo_name": "foo",
             "env": "development"
         }
-        assert response_code == 200
-        assert response == expected
+        assert response.status_code == 200
+        assert json.loads(response.data.decode('utf-8')) == expected
 
-    @patch('discovery.app.services.host.HostService.list_by_service_repo_name')
+    @patch('discovery.app.services.host.HostService._query_secondary_index')
     def test_get_service_repo_name_with_hosts(self, get_hosts):
         expected_hosts = [
             {
@@ -124,17 +234,18 @@ class ApiResourceTestCase(unittest.TestCase):
             },
         ]
         service_repo_name = 'bar'
-        get_hosts.return_value = expected_hosts
+        get_hosts.return_value = [HostRecord.from_dict(host) for host in expected_hosts]
         registration = RepoRegistration()
         registration._get_param = Mock(side_effect=self.generate_valid_params)
-        response, response_code = registration.get(service_repo_name)
+        with self.app.test_request_context():
+            response = registration.get(service_repo_name)
         expected = {
             "hosts": expected_hosts,
             "service_repo_name": service_repo_name,
             "env": "development"
         }
-        assert response_code == 200
-        assert response == expected
+        assert response.status_code == 200
+        assert json.loads(response.data.decode('utf-8')) == expected
 
     @patch('discovery.app.resources.api.Registration._get_param')
     def test_post_invalid_params(self, get_param):
@@ -155,6 +266,89 @@ class ApiResourceTestCase(unittest.TestCase):
         assert response_code == 200
         assert response == expected
 
+    @patch('discovery.app.services.host.HostService._query_many')
+    def test_get_batch(self, get_hosts):
+        get_hosts.side_effect = lambda services: dict(
+            (service, [HostRecord(service, '10.10.10.10', None, 10, 'blah', 'timestamp', {})]) for service in services)
+        with self.app.test_request_context('/?service=foo&service=bar'):
+            response = RegistrationBatch().get()
+        services = json.loads(response.data.decode('utf-8'))['services']
+
+        assert response.status_code == 200
+        assert sorted(services.keys()) == ['bar', 'foo']
+        assert services['foo']['registration']['service'] == 'foo'
+        assert services['foo']['registration']['hosts'][0]['ip_address'] == '10.10.10.10'
+
+        # services whose version the client has are left out
+        with self.app.test_request_context('/?service=foo&service=bar&version.foo=%s' % services['foo']['version']):
+            response = RegistrationBatch().get()
+        assert list(json.loads(response.data.decode('utf-8'))['services'].keys()) == ['bar']
+        assert get_hosts.call_count == 1
+
+    def test_get_batch_without_services(self):
+        with self.app.test_request_context('/'):
+            response, response_code = RegistrationBatch().get()
+
+        assert response_code == 400
+
+    @patch('discovery.app.services.host.HostService._query_many')
+    def test_eds(self, get_hosts):
+        get_hosts.side_effect = lambda services: dict(
+            (service, [HostRecord(service, '10.10.10.10', None, 10, 'blah', 'timestamp', {'az': 'a', 'region': 'r'})])
+            for service in services)
+        body = json.dumps({'node': {'id': 'envoy'}, 'resource_names': ['foo', 'bar']})
+        with self.app.test_request_context('/', method='POST', data=body):
+            response, response_code = EndpointDiscovery().post()
+
+        assert response_code == 200
+        assert response['nonce'] == response['version_info']
+        assert [resource['cluster_name'] for resource in response['resources']] == ['foo', 'bar']
+        assert response['resources'][0]['endpoints'][0]['locality'] == {'region': 'r', 'zone': 'a'}
+
+        # rejecting the current version gets it back once the hosts change, or after EDS_WATCH_TIMEOUT
+        body = json.dumps({'resource_names': ['foo', 'bar'], 'version_info': '',
+                           'response_nonce': response['nonce'], 'error_detail': {'message': 'bad'}})
+        with self.app.test_request_context('/', method='POST', data=body):
+            nack_response, response_code = EndpointDiscovery().post()
+        assert response_code == 200
+        assert nack_response['version_info'] == response['version_info']
+
+    def test_eds_without_resource_names(self):
+        with self.app.test_request_context('/', method='POST', data=json.dumps({'resource_names': []})):
+            response, response_code = EndpointDiscovery().post()
+
+        assert response_code == 400
+
+    @patch('discovery.app.services.host.HostService.update_many')
+    def test_post_batch(self, update_many):
+        update_many.return_value = [None, 'Invalid port', STORE_FAILED]
+        body = json.dumps([
+            {'service': 'foo', 'ip': '10.10.10.10', 'port': 1000, 'revision': 'abc',
+             'tags': {'az': 'foo', 'instance_id': 'bar', 'region': 'baz'}},
+            {'service': 'bar', 'ip': '10.10.10.11', 'port': 'x', 'revision': 'abc'},
+            {'service': 'foo', 'ip': '10.10.10.12', 'port': 1000, 'revision': 'abc',
+             'tags': {'az': 'foo', 'instance_id': 'bar', 'region': 'baz'}},
+        ])
+        with self.app.test_request_context(method='POST', data=body, content_type='application/json'):
+            response, response_code = RegistrationBatch().post()
+
+        assert response_code == 200
+        assert response == {'results': [
+            {'service': 'foo', 'ip': '10.10.10.10', 'status': 200},
+            {'service': 'bar', 'ip': '10.10.10.11', 'status': 400, 'error': 'Invalid port'},
+            {'service': 'foo', 'ip': '10.10.10.12', 'status': 503, 'error': STORE_FAILED},
+        ]}
+        params = update_many.call_args[0][0]
+        assert [(p['service'], p['ip_address'], p['port']) for p in params] == [
+            ('foo', '10.10.10.10', 1000), ('bar', '10.10.10.11', 'x'), ('foo', '10.10.10.12', 1000)]
+        assert params[1]['tags'] == {}
+
+    def test_post_batch_invalid_body(self):
+        with self.app.test_request_context(method='POST', data='{"service": "foo"}'):
+            response, response_code = RegistrationBatch().post()
+
+        assert response_code == 400
+
     def test_delete_nonexistent_host(self):
         registration = Registration()
         response, response_code = registration.delete('foo', '1.1.1.1')
@@ -240,7 +434,9 @@ class BackendSelectorTestCase(unittest.TestCase):
         mock_assemble_location.return_value = 'plugins.HBase.app.services.query'
         mock_assemble_class_name.return_value = 'HBaseQueryBackend'
         mock_plugins_exist.return_value = True
-        BackendSelector().select()
+        backend = BackendSelector().select()
         mock_get_query_plugin.assert_called_with(
             mock_assemble_location.return_value, mock_assemble_class_name.return_value,
         )
+        self.assertTrue(isinstance(backend, discovery.app.services.query.PluginQueryBackend))
+        self.assertEqual(mock_get_query_plugin.return_value, backend.backend)
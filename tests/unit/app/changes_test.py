@@ -0,0 +1,90 @@
+import collections
+import unittest
+from datetime import datetime
+
+import gevent
+from discovery.app.models.record import HostRecord
+from discovery.app.services.changes import ChangeHub, ChangeLog
+
+
+Entry = collections.namedtuple('Entry', ['version', 'hosts'])
+
+
+class ChangeHubTestCase(unittest.TestCase):
+    def test_notify_wakes_up_subscribers(self):
+        hub = ChangeHub()
+        greenlets = [gevent.spawn(hub.subscribe('foo').wait, 1) for _ in range(3)]
+        other = gevent.spawn(hub.subscribe('bar').wait, 0.05)
+        gevent.sleep(0)
+
+        hub.notify('foo')
+        gevent.joinall(greenlets + [other])
+
+        assert [g.value for g in greenlets] == [True] * 3
+        assert other.value is False
+
+    def test_subscribe_after_notify_waits_for_next_change(self):
+        hub = ChangeHub()
+        first = hub.subscribe('foo')
+        hub.notify('foo')
+        second = hub.subscribe('foo')
+
+        assert first.is_set()
+        assert not second.is_set()
+        assert second.wait(0.01) is False
+
+    def test_notify_without_subscribers(self):
+        hub = ChangeHub()
+        hub.notify('foo')
+        assert hub.events == {}
+
+
+class ChangeLogTestCase(unittest.TestCase):
+    def _host(self, ip_address, revision='abc123'):
+        return HostRecord('foo', ip_address, 'bar', 80, revision, datetime.utcnow(), {'az': 'a'})
+
+    def setUp(self):
+        self.log = ChangeLog(size=3, capacity=10)
+        self.v1 = Entry('v1', [self._host('10.10.10.%d' % i) for i in range(10)])
+        self.v2 = Entry('v2', self.v1.hosts[1:] + [self._host('10.10.10.20')])
+        self.v3 = Entry('v3', [self._host('10.10.10.1', 'def456')] + self.v2.hosts[1:])
+        self.log.record('foo', self.v1, self.v2)
+        self.log.record('foo', self.v2, self.v3)
+
+    def test_delta(self):
+        delta = self.log.delta('foo', 'v2', self.v3)
+        assert delta.added == []
+        assert delta.updated == [self.v3.hosts[0]]
+        assert delta.removed == []
+
+    def test_delta_merges_changes(self):
+        delta = self.log.delta('foo', 'v1', self.v3)
+        assert [host.ip_address for host in delta.added] == ['10.10.10.20']
+        assert [(host.ip_address, host.revision) for host in delta.updated] == [('10.10.10.1', 'def456')]
+        assert [host.ip_address for host in delta.removed] == ['10.10.10.0']
+
+        v4 = Entry('v4', self.v3.hosts[:-1])
+        self.log.record('foo', self.v3, v4)
+        delta = self.log.delta('foo', 'v1', v4)
+        assert delta.added == []
+        assert [host.ip_address for host in delta.removed] == ['10.10.10.0']
+
+    def test_delta_ignores_last_check_in(self):
+        v4 = Entry('v4', [host.replace(last_check_in=datetime.utcnow()) for host in self.v3.hosts])
+        self.log.record('foo', self.v3, v4)
+        assert self.log.delta('foo', 'v3', v4) == ([], [], [])
+
+    def test_delta_unknown(self):
+        assert self.log.delta('foo', 'v3', self.v3) == ([], [], [])
+        assert self.log.delta('foo', 'v0', self.v3) is None
+        assert self.log.delta('bar', 'v1', self.v3) is None
+        # a version replaced without being logged breaks the chain
+        assert self.log.delta('foo', 'v1', Entry('v5', self.v3.hosts)) is None
+
+    def test_delta_falls_out_of_log(self):
+        entries = [self.v3]
+        for i in range(4, 6):
+            entries.append(Entry('v%d' % i, entries[-1].hosts[:-1]))
+            self.log.record('foo', entries[-2], entries[-1])
+        assert self.log.delta('foo', 'v1', entries[-1]) is None
+        assert self.log.delta('foo', 'v3', entries[-1]) is not None
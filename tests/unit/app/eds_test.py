@@ -0,0 +1,44 @@
+import unittest
+from datetime import datetime
+
+from discovery.app.models.record import HostRecord
+from discovery.app.services.eds import CLUSTER_LOAD_ASSIGNMENT, EdsSerializer
+
+
+class EdsSerializerTestCase(unittest.TestCase):
+    def _host(self, ip_address, az, **tags):
+        tags.update({'az': az, 'instance_id': 'bar', 'region': 'us-east-1'})
+        return HostRecord('foo', ip_address, 'bar', 80, 'abc123', datetime(2018, 1, 1, 12, 0, 0), tags)
+
+    def test_cluster_load_assignment_groups_hosts_by_locality(self):
+        hosts = [
+            self._host('10.10.10.12', 'us-east-1b'),
+            self._host('10.10.10.11', 'us-east-1a', load_balancing_weight=20, canary=True),
+            self._host('10.10.10.10', 'us-east-1a'),
+        ]
+        assignment = EdsSerializer.cluster_load_assignment('foo', hosts)
+
+        assert assignment['@type'] == CLUSTER_LOAD_ASSIGNMENT
+        assert assignment['cluster_name'] == 'foo'
+        assert [endpoints['locality'] for endpoints in assignment['endpoints']] == [
+            {'region': 'us-east-1', 'zone': 'us-east-1a'},
+            {'region': 'us-east-1', 'zone': 'us-east-1b'},
+        ]
+        assert assignment['endpoints'][0]['lb_endpoints'] == [
+            {'endpoint': {'address': {'socket_address': {'address': '10.10.10.10', 'port_value': 80}}}},
+            {'endpoint': {'address': {'socket_address': {'address': '10.10.10.11', 'port_value': 80}}},
+             'load_balancing_weight': 20,
+             'metadata': {'filter_metadata': {'envoy.lb': {'canary': True}}}},
+        ]
+
+    def test_lb_endpoint_ignores_invalid_weight_and_canary(self):
+        lb_endpoint = EdsSerializer.lb_endpoint(self._host('10.10.10.10', 'us-east-1a',
+                                                           load_balancing_weight='x', canary=False))
+        assert 'load_balancing_weight' not in lb_endpoint
+        assert 'metadata' not in lb_endpoint
+
+    def test_lb_endpoint_weight_is_at_least_1(self):
+        for weight in (0, -5, '0'):
+            lb_endpoint = EdsSerializer.lb_endpoint(self._host('10.10.10.10', 'us-east-1a',
+                                                               load_balancing_weight=weight))
+            assert lb_endpoint['load_balancing_weight'] == 1
@@ -1,10 +1,19 @@
 import unittest
+import gevent
 from mock import patch, Mock
 from flask import Flask
 from flask.ext.cache import Cache
 from datetime import datetime, timedelta
 import os
+import shutil
+import tempfile
+from discovery.app.models.record import HostRecord
+from discovery.app.services import cache
+from discovery.app.services import changes
 from discovery.app.services import host
+from discovery.app.services import query as query_backends
+from discovery.app.services.shared_cache import SharedCacheStore
+from discovery.app.services.sweeper import Sweeper
 
 
 # TODO should also have a class that tests the HostService semantics without
@@ -24,6 +33,10 @@ class DynamoHostServiceTestCase(unittest.TestCase):
     def _generate_valid_tags(self):
         return {'az': 'foo', 'instance_id': 'bar', 'region': 'baz'}
 
+    def _host_record(self, ip_address='10.10.10.10', **fields):
+        host = HostRecord('foo', ip_address, 'bar', 80, 'abc123', datetime.utcnow(), self._generate_valid_tags())
+        return host.replace(**fields)
+
     def _mock_host(self):
         return Mock(spec=['service', 'ip_address', 'service_repo_name', 'port',
                           'revision', 'last_check_in', 'tags', 'save'])
@@ -31,11 +44,9 @@ class DynamoHostServiceTestCase(unittest.TestCase):
     def _new_host_service(self):
         return host.HostService()
 
-    @patch('discovery.app.models.host.Host.get')
-    @patch('discovery.app.models.host.Host.save')
-    def test_update_succeeds(self, save, get):
-        save.return_value = Mock(spec=bool)
-        get.return_value = self._mock_host()
+    @patch('discovery.app.services.query.DynamoQueryBackend.upsert')
+    def test_update_succeeds(self, upsert):
+        upsert.return_value = None
         host = self._new_host_service()
         success = host.update(
             service='foo',
@@ -47,12 +58,11 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             tags=self._generate_valid_tags()
         )
         assert success is True
+        upsert.assert_called_once()
 
-    @patch('discovery.app.models.host.Host.get')
-    @patch('discovery.app.models.host.Host.save')
-    def test_service_repo_name_optional(self, save, get):
-        save.return_value = Mock(spec=bool)
-        get.return_value = None
+    @patch('discovery.app.services.query.DynamoQueryBackend.upsert')
+    def test_service_repo_name_optional(self, upsert):
+        upsert.return_value = None
         host = self._new_host_service()
         success = host.update(
             service='foo',
@@ -64,6 +74,7 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             tags=self._generate_valid_tags()
         )
         assert success is True
+        assert upsert.call_args[0][0].service_repo_name is None
 
     @patch('discovery.app.models.host.Host.get')
     @patch('discovery.app.models.host.Host.save')
@@ -122,6 +133,17 @@ class DynamoHostServiceTestCase(unittest.TestCase):
         )
         assert success is False
 
+        success = host.update(
+            service='foo',
+            ip_address='10.10.10.10',
+            service_repo_name='bar',
+            port=65536,
+            revision='abc123',
+            last_check_in=datetime.utcnow(),
+            tags=tags
+        )
+        assert success is False
+
     @patch('discovery.app.models.host.Host.get')
     @patch('discovery.app.models.host.Host.save')
     def test_update_invalid_last_check_in(self, save, get):
@@ -190,7 +212,7 @@ class DynamoHostServiceTestCase(unittest.TestCase):
         query.return_value = []
         expired.return_value = False
         host = self._new_host_service()
-        hosts = host.list(service)
+        hosts = [h.to_dict() for h in host.list(service)]
         expected = []
         assert hosts == expected
 
@@ -215,7 +237,7 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             host2
         ]
         host = self._new_host_service()
-        hosts = host.list(service)
+        hosts = [h.to_dict() for h in host.list(service)]
         expected = [
             {
                 'service': host1.service,
@@ -272,7 +294,7 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             host2
         ]
         host = self._new_host_service()
-        hosts = host.list_by_service_repo_name(service)
+        hosts = [h.to_dict() for h in host.list_by_service_repo_name(service)]
         expected = [
             {
                 'service': host1.service,
@@ -296,8 +318,8 @@ class DynamoHostServiceTestCase(unittest.TestCase):
         assert hosts == expected
 
     @patch('discovery.app.services.query.Host.get')
-    @patch('discovery.app.services.query.Host.save')
-    def test_set_tag(self, save, get):
+    @patch('discovery.app.services.query.DynamoQueryBackend.put')
+    def test_set_tag(self, put, get):
         host = self._mock_host()
         host.tags = {}
 
@@ -310,8 +332,8 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             tag_value='value'
         )
 
-        assert host.tags == {'tagname': 'value'}
-        save.assert_called_once()
+        put.assert_called_once()
+        assert put.call_args[0][0].tags == {'tagname': 'value'}
 
     @patch('discovery.app.services.query.Host.batch_write')
     @patch('discovery.app.services.query.Host.query')
@@ -329,15 +351,310 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             tag_value='value'
         )
 
-        assert host1.tags == {'tagname': 'value'}
-        assert host2.tags == {'tagname': 'value'}
         batch_write.assert_called_once()
+        saved = batch_write.return_value.__enter__.return_value.save.call_args_list
+        assert [call[0][0].tags for call in saved] == [{'tagname': 'value'}] * 2
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_list_coalesces_concurrent_misses(self, query):
+        def slow_query(service):
+            gevent.sleep(0.01)
+            return []
+        query.side_effect = slow_query
+
+        def list_hosts():
+            with self.app.app_context():
+                return self._new_host_service().list('foo')
+
+        greenlets = [gevent.spawn(list_hosts) for _ in range(5)]
+        gevent.joinall(greenlets)
+
+        assert query.call_count == 1
+        assert [g.value for g in greenlets] == [[]] * 5
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_list_serves_stale_hosts_while_refreshing(self, query):
+        stale_host = self._host_record()
+        # an entry past its soft expiry but not yet evicted by CACHE_TTL
+        self.app.cache.set('service:foo', cache.CacheEntry('service', 'foo', [stale_host], refresh_at=0), 30)
+        query.return_value = []
+
+        hosts = self._new_host_service().list('foo')
+        assert hosts == [stale_host]
+        assert query.call_count == 0
+
+        gevent.sleep(0.01)
+        assert query.call_count == 1
+        assert cache.services.get('foo').hosts == []
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_list_entries_loads_misses_concurrently(self, query):
+        calls = []
+
+        def slow_query(service):
+            calls.append('start')
+            gevent.sleep(0.01)
+            calls.append('end')
+            return [self._host_record(service=service)]
+        query.side_effect = slow_query
+        host = self._new_host_service()
+        cached = host.list_entry('foo')
+        del calls[:]
+
+        entries = host.list_entries(['foo', 'bar', 'baz', 'bar'])
+        assert sorted(entries.keys()) == ['bar', 'baz', 'foo']
+        assert entries['foo'].version == cached.version
+        assert [h.service for h in entries['bar'].hosts] == ['bar']
+        # both misses are queried at the same time
+        assert calls == ['start', 'start', 'end', 'end']
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_list_caches_empty_host_lists(self, query):
+        query.return_value = []
+        host = self._new_host_service()
+
+        assert host.list('foo') == []
+        assert host.list('foo') == []
+        assert query.call_count == 1
+
+    def test_shared_cache_loads_once_across_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        host = self._host_record()
+        load = Mock(return_value=[host])
+        # each worker has its own cache over the same directory
+        worker1 = cache.HostListCache('service', SharedCacheStore(directory))
+        worker2 = cache.HostListCache('service', SharedCacheStore(directory))
+
+        entry = worker1.get_or_load('foo', load)
+        assert worker2.get_or_load('foo', load).version == entry.version
+        assert worker2.get('foo').hosts == [host]
+        assert load.call_count == 1
+
+        # a worker missing while another one loads waits for its entry
+        with worker1.store.lock('service:bar'):
+            waiter = gevent.spawn(worker2.get_or_load, 'bar', load)
+            gevent.sleep(0.02)
+            worker1.set('bar', [])
+        assert waiter.get(timeout=1).hosts == []
+        assert load.call_count == 1
+
+    def test_version_ignores_last_check_in_and_order(self):
+        hosts = [self._host_record('10.10.10.10'), self._host_record('10.10.10.11')]
+        entry = cache.CacheEntry('service', 'foo', hosts)
+        heartbeats = [host.replace(last_check_in=datetime.utcnow() + timedelta(seconds=30)) for host in hosts]
+
+        assert cache.CacheEntry('service', 'foo', list(reversed(heartbeats))).version == entry.version
+        assert cache.CacheEntry('service', 'foo', [hosts[0].with_tags({'canary': True}), hosts[1]]).version != \
+            entry.version
+        assert cache.CacheEntry('service', 'foo', hosts[:1]).version != entry.version
+
+    def test_memory_cache_store(self):
+        host = self._host_record()
+        store = cache.MemoryCacheStore(max_bytes=10000)
+        services = cache.HostListCache('service', store)
+        load = Mock(side_effect=lambda service: [host.replace(service=service)])
+
+        entry = services.get_or_load('foo', load)
+        assert services.get_or_load('foo', load) is entry
+        assert store.hits == 1
+        assert store.misses > 0
+
+        # entries are evicted least recently used first once over budget
+        services.get_or_load('bar', load)
+        # room for two entries only, entries sizes vary by a few bytes of gzip
+        store.entries.max_size = store.entries.size + 100
+        services.get('foo')
+        services.get_or_load('baz', load)
+        assert services.get('bar') is cache.MISS
+        assert services.get('foo') is entry
+        assert store.entries.evictions == 1
+        assert store.entries.size <= store.entries.max_size
+
+        # and expire after their TTL
+        store.set('service:foo', entry, -1)
+        assert services.get('foo') is cache.MISS
+        assert 'service:foo' not in store.entries
+
+    def test_memory_cache_store_keeps_views_within_budget(self):
+        store = cache.MemoryCacheStore(max_bytes=100000)
+        services = cache.HostListCache('service', store, changes.ChangeLog(10, 10))
+        entry = services.set('foo', [self._host_record('10.10.10.10', tags={'az': 'us-east-1a'}),
+                                     self._host_record('10.10.10.11', tags={'az': 'us-east-1b'})])
+
+        view = services.view('foo', entry, (('az', 'us-east-1a'),))
+        assert [h.ip_address for h in view.hosts] == ['10.10.10.10']
+        assert services.view('foo', entry, (('az', 'us-east-1a'),)) is view
+        assert store.entries.size == store._sizeof((entry, 0)) + store._sizeof((view, 0))
+
+        # views are evicted least recently used first along with entries once over budget
+        services.get('foo')
+        store.entries.max_size = store.entries.size
+        services.set('bar', [self._host_record('10.10.10.12', service='bar')])
+        assert ('service', 'foo', entry.version, (('az', 'us-east-1a'),)) not in store.entries
+        assert store.entries.size <= store.entries.max_size
+
+        # replacing an entry reads the previous one without counting a cache hit or miss
+        hits, misses = store.hits, store.misses
+        services.set('bar', [self._host_record('10.10.10.13', service='bar')])
+        assert (store.hits, store.misses) == (hits, misses)
+        assert services.delta('bar', services.get('bar').version, services.get('bar')) == changes.Delta([], [], [])
+
+    def test_writes_are_applied_in_batches(self):
+        services = cache.HostListCache('service', cache.MemoryCacheStore(max_bytes=100000))
+        services.set('foo', [self._host_record('10.10.10.10'), self._host_record('10.10.10.11')])
+
+        with patch.object(services, '_set', wraps=services._set) as _set:
+            services.apply('foo', [self._host_record('10.10.10.12')])
+            services.apply('foo', [self._host_record('10.10.10.10', revision='def456')])
+            services.apply('foo', deleted=[('foo', '10.10.10.11')])
+            assert [(h.ip_address, h.revision) for h in services.get('foo').hosts] == \
+                [('10.10.10.10', 'def456'), ('10.10.10.12', 'abc123')]
+            gevent.sleep(0)
+            assert _set.call_count == 1
+
+            # without a read, the writes are applied once the greenlet yields
+            services.apply('foo', [self._host_record('10.10.10.13')])
+            gevent.sleep(0)
+            assert _set.call_count == 2
+            assert 'foo' not in services.pending
+
+    def test_writes_during_load_are_not_overwritten(self):
+        services = cache.HostListCache('service', cache.MemoryCacheStore(max_bytes=100000))
+        services.set('foo', [self._host_record('10.10.10.10')])
+
+        def load(service):
+            stale = [self._host_record('10.10.10.10'), self._host_record('10.10.10.11')]
+            # the write lands while the backend is being read
+            services.apply('foo', [self._host_record('10.10.10.12')], deleted=[('foo', '10.10.10.11')])
+            gevent.sleep(0.01)
+            return stale
+
+        entry = services.reload('foo', load)
+        gevent.sleep(0.01)
+        assert [h.ip_address for h in entry.hosts] == ['10.10.10.10', '10.10.10.12']
+        assert [h.ip_address for h in services.get('foo').hosts] == ['10.10.10.10', '10.10.10.12']
+        assert services.loading == {}
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query_secondary_index')
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_list_by_service_repo_name_is_cached_separately(self, query, query_secondary_index):
+        service_host = self._host_record()
+        query.return_value = [service_host]
+        query_secondary_index.return_value = []
+        host = self._new_host_service()
+
+        with patch.object(host, '_is_expired', return_value=False):
+            assert host.list('foo') == [service_host]
+            assert host.list_by_service_repo_name('foo') == []
+            assert host.list_by_service_repo_name('foo') == []
+        assert query_secondary_index.call_count == 1
+        assert cache.services.get('foo').hosts == [service_host]
+        assert cache.service_repo_names.get('foo').hosts == []
+        assert cache.service_repo_names.get('bar') is cache.MISS
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_watch_times_out_without_changes(self, query):
+        query.return_value = []
+        host = self._new_host_service()
+        version = host.list_entry('foo').version
+
+        entry = host.watch('foo', version, 0.01)
+        assert entry.version == version
+        assert query.call_count == 1
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    @patch('discovery.app.services.host.HostService._is_expired')
+    def test_watch_returns_on_change(self, expired, query):
+        expired.return_value = False
+        query.return_value = []
+        host = self._new_host_service()
+        version = host.list_entry('foo').version
+
+        def watch():
+            with self.app.app_context():
+                return self._new_host_service().watch('foo', version, 1)
+        watcher = gevent.spawn(watch)
+        gevent.sleep(0)
+
+        new_host = self._host_record()
+        query.return_value = [new_host]
+        changes.hub.notify('foo')
+        watcher.join(1)
+
+        assert watcher.value.version != version
+        assert watcher.value.hosts == [new_host]
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    @patch('discovery.app.services.host.HostService._is_expired')
+    def test_watch_many_returns_on_change(self, expired, query):
+        expired.return_value = False
+        query.return_value = []
+        host = self._new_host_service()
+        version = host.entries_version(host.list_entries(['foo', 'bar']))
+        assert host.entries_version(host.watch_many(['foo', 'bar'], version, 0.01)) == version
+
+        def watch():
+            with self.app.app_context():
+                return self._new_host_service().watch_many(['foo', 'bar'], version, 1)
+        watcher = gevent.spawn(watch)
+        gevent.sleep(0)
+
+        new_host = self._host_record(service='bar')
+        query.return_value = [new_host]
+        changes.hub.notify('bar')
+        watcher.join(1)
+
+        assert host.entries_version(watcher.value) != version
+        assert watcher.value['bar'].hosts == [new_host]
+        assert watcher.value['foo'].hosts == []
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_watch_sees_changes_made_without_notification(self, query):
+        query.return_value = []
+        host = self._new_host_service()
+        version = host.list_entry('foo').version
+        new_host = self._host_record()
+
+        # e.g. written by another process sharing the cache store
+        def change():
+            with self.app.app_context():
+                cache.services.store.set('service:foo', cache.CacheEntry('service', 'foo', [new_host]), 30)
+        gevent.spawn_later(0.01, change)
+
+        assert host.watch('foo', version, 0.05).hosts == [new_host]
+        entries = host.watch_many(['foo'], host.entries_version({'foo': cache.CacheEntry('service', 'foo', [])}), 0.01)
+        assert entries['foo'].hosts == [new_host]
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.query')
+    def test_cache_changes_notify_watchers(self, query):
+        query.return_value = []
+        self._new_host_service().list_entry('foo')
+        event = changes.hub.subscribe('foo')
+
+        cache.services.set('foo', [])
+        assert not event.is_set()
+        cache.services.set('foo', [self._host_record()])
+        assert event.is_set()
+
+    @patch('discovery.app.services.query.DynamoQueryBackend.upsert')
+    def test_update_notifies_only_on_change(self, upsert):
+        host = self._new_host_service()
+
+        upsert.return_value = self._host_record()
+        event = changes.hub.subscribe('foo')
+        host.update('foo', '10.10.10.10', 'bar', 80, 'abc123', datetime.utcnow(), self._generate_valid_tags())
+        assert not event.is_set()
+
+        host.update('foo', '10.10.10.10', 'bar', 80, 'def456', datetime.utcnow(), self._generate_valid_tags())
+        assert event.is_set()
 
     def noop(self):
         pass
 
+    @patch('discovery.app.services.query.DynamoQueryBackend.delete_expired')
     @patch('discovery.app.models.host.Host.query')
-    def test_sweeper(self, query):
+    def test_sweeper(self, query, delete_expired):
         # have query return hosts, some of which are expired
         # verify that the expired hosts are not returned
         service = 'foo'
@@ -365,7 +682,7 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             host1,
             host2
         ]
-        hosts = host.list(service)
+        hosts = [h.to_dict() for h in host.list(service)]
         expected = [
             {
                 'service': host2.service,
@@ -378,20 +695,201 @@ class DynamoHostServiceTestCase(unittest.TestCase):
             }
         ]
         assert hosts == expected
+        # deleted off the read path
+        assert not delete_expired.called
+        delete_expired.return_value = []
+        gevent.sleep(0)
+        assert [h.ip_address for h in delete_expired.call_args[0][0]] == [host1.ip_address]
+
+    def test_update_many(self):
+        backend = query_backends.MemoryQueryBackend()
+        backend.put(self._host_record('10.10.10.10', tags=dict(self._generate_valid_tags(), load_balancing_weight=5)))
+        host_service = host.HostService(backend)
+        event = changes.hub.subscribe('foo')
+
+        registration = {
+            'service': 'foo',
+            'ip_address': '10.10.10.10',
+            'service_repo_name': 'bar',
+            'port': 80,
+            'revision': 'abc123',
+            'last_check_in': datetime.utcnow(),
+            'tags': self._generate_valid_tags()
+        }
+        with self.app.test_request_context():
+            errors = host_service.update_many([
+                registration,
+                dict(registration, ip_address='10.10.10.11', port='80'),
+                dict(registration, ip_address='10.10.10.12', port=-1),
+                dict(registration, ip_address='10.10.10.13', tags={'az': 'foo'}),
+            ])
+
+        assert errors == [None, None, 'Invalid port', 'Missing required tag - instance_id']
+        assert sorted(h.ip_address for h in backend.query('foo')) == ['10.10.10.10', '10.10.10.11']
+        assert backend.get('foo', '10.10.10.10').tags['load_balancing_weight'] == 5
+        assert backend.get('foo', '10.10.10.11').port == 80
+        assert event.is_set()
+
+    def test_update_many_reports_failed_batches(self):
+        backend = query_backends.MemoryQueryBackend()
+        host_service = host.HostService(backend)
+        registrations = [{
+            'service': 'foo',
+            'ip_address': '10.10.10.%d' % i,
+            'service_repo_name': 'bar',
+            'port': 80,
+            'revision': 'abc123',
+            'last_check_in': datetime.utcnow(),
+            'tags': self._generate_valid_tags()
+        } for i in range(host.BATCH_PUT_SIZE + 1)]
+
+        with patch.object(backend, 'batch_put', side_effect=[False, True]) as batch_put:
+            errors = host_service.update_many([dict(registrations[0], port=-1)] + registrations)
+
+        assert errors == ['Invalid port'] + [host.STORE_FAILED] * host.BATCH_PUT_SIZE + [None]
+        assert [len(call[0][0]) for call in batch_put.call_args_list] == [host.BATCH_PUT_SIZE, 1]
+
+    def test_update_many_heartbeats_do_not_notify(self):
+        backend = query_backends.MemoryQueryBackend()
+        backend.put(self._host_record())
+        host_service = host.HostService(backend)
+        event = changes.hub.subscribe('foo')
+
+        errors = host_service.update_many([{
+            'service': 'foo',
+            'ip_address': '10.10.10.10',
+            'service_repo_name': 'bar',
+            'port': 80,
+            'revision': 'abc123',
+            'last_check_in': datetime.utcnow(),
+            'tags': self._generate_valid_tags()
+        }])
+
+        assert errors == [None]
+        assert not event.is_set()
+
+    @patch.object(host.HostService, 'swept', True)
+    def test_sweep_expired_hosts(self):
+        backend = query_backends.MemoryQueryBackend()
+        for i, last_check_in in enumerate([datetime.utcnow() - timedelta(days=1),
+                                           datetime.utcnow() - timedelta(days=1),
+                                           datetime.utcnow()]):
+            backend.put(self._host_record('10.10.10.1%d' % i, last_check_in=last_check_in))
+        host_service = host.HostService(backend)
+        event = changes.hub.subscribe('foo')
+
+        assert host_service.list('foo')[0].ip_address == '10.10.10.12'
+        assert len(list(backend.query('foo'))) == 3
+
+        assert host_service.sweep_expired_hosts(batch_size=1, max_rate=1000) == 2
+        assert [h.ip_address for h in backend.query('foo')] == ['10.10.10.12']
+        assert event.is_set()
+
+    def test_expired_hosts_are_deleted_on_read_without_sweeper(self):
+        backend = query_backends.MemoryQueryBackend()
+        backend.put(self._host_record('10.10.10.10', last_check_in=datetime.utcnow() - timedelta(days=1)))
+        backend.put(self._host_record('10.10.10.11'))
+        host_service = host.HostService(backend)
+
+        with patch.object(host_service, '_delete_expired', wraps=host_service._delete_expired) as delete_expired:
+            assert [h.ip_address for h in host_service.list('foo')] == ['10.10.10.11']
+            assert len(list(backend.query('foo'))) == 2
+            # concurrent reads leave the hosts being deleted alone
+            host_service._filter_expired_hosts(list(backend.query('foo')))
+            gevent.sleep(0)
+            assert delete_expired.call_count == 1
+        assert [h.ip_address for h in backend.query('foo')] == ['10.10.10.11']
+        assert host.HostService.deleting == set()
+
+    def test_sweeper_falls_back_to_deleting_on_read(self):
+        backend = Mock(spec=query_backends.QueryBackend)
+        backend.scan.side_effect = NotImplementedError
+        sweeper = Sweeper(backend, interval=0.01)
+
+        sweeper.start(self.app)
+        assert host.HostService.swept
+        gevent.sleep(0.05)
+        assert not host.HostService.swept
+        assert sweeper.greenlet is None
+
+    def test_sweeper_runs_outside_an_app_context(self):
+        backend = query_backends.MemoryQueryBackend()
+        for i in range(10):
+            backend.put(self._host_record('10.10.10.%d' % i, last_check_in=datetime.utcnow() - timedelta(days=1)))
+        backend.put(self._host_record('10.10.10.10'))
+        host_service = host.HostService(backend)
+        with patch.object(host.HostService, 'swept', True):
+            assert len(host_service.list('foo')) == 1
+        sweeper = Sweeper(backend, interval=0.05, batch_size=2, max_rate=1000)
+
+        self.app_context.pop()
+        try:
+            # a single sweep
+            sweeper.start(self.app)
+            gevent.sleep(0.08)
+            sweeper.stop()
+        finally:
+            self.app_context.push()
+
+        assert [h.ip_address for h in backend.query('foo')] == ['10.10.10.10']
+        assert [h.ip_address for h in cache.services.get('foo').hosts] == ['10.10.10.10']
+
+    def test_writes_are_applied_to_cached_entries(self):
+        backend = query_backends.MemoryQueryBackend()
+        backend.put(self._host_record('10.10.10.10'))
+        host_service = host.HostService(backend)
+        version = host_service.list_entry('foo').version
+        host_service.list_entry_by_service_repo_name('bar')
+
+        with patch.object(backend, 'query') as query, \
+                patch.object(backend, 'query_secondary_index') as query_secondary_index:
+            host_service.update('foo', '10.10.10.11', 'bar', 80, 'abc123', datetime.utcnow(),
+                                self._generate_valid_tags())
+            entry = host_service.list_entry('foo')
+            assert entry.version != version
+            assert [h.ip_address for h in entry.hosts] == ['10.10.10.10', '10.10.10.11']
+            assert [h.ip_address for h in host_service.list_by_service_repo_name('bar')] == \
+                ['10.10.10.10', '10.10.10.11']
+
+            backend.put(backend.get('foo', '10.10.10.10').with_tags({'weight': '5'}))
+            host_service.update('foo', '10.10.10.10', 'baz', 80, 'def456', datetime.utcnow(),
+                                dict(self._generate_valid_tags(), az='qux'))
+            assert [(h.revision, h.tags['az'], h.tags.get('weight')) for h in host_service.list('foo')] == \
+                [('def456', 'qux', '5'), ('abc123', 'foo', None)]
+            assert [h.ip_address for h in host_service.list_by_service_repo_name('bar')] == ['10.10.10.11']
+            assert cache.service_repo_names.get('baz') is cache.MISS
+
+            host_service.set_tag('foo', '10.10.10.11', 'weight', '10')
+            assert host_service.list('foo')[1].tags['weight'] == '10'
+            assert host_service.list_by_service_repo_name('bar')[0].tags['weight'] == '10'
+
+            host_service.delete('foo', '10.10.10.11')
+            assert [h.ip_address for h in host_service.list('foo')] == ['10.10.10.10']
+            assert host_service.list_by_service_repo_name('bar') == []
+            assert not query.called
+            assert not query_secondary_index.called
+
+    def test_warm_cache(self):
+        backend = query_backends.MemoryQueryBackend()
+        backend.put(self._host_record('10.10.10.10'))
+        backend.put(self._host_record('10.10.10.11', last_check_in=datetime.utcnow() - timedelta(days=1)))
+        backend.put(self._host_record('10.10.10.12', service='baz', service_repo_name=None))
+        host_service = host.HostService(backend)
+
+        assert host_service.warm_cache() == 2
+        assert [h.ip_address for h in cache.services.get('foo').hosts] == ['10.10.10.10']
+        assert [h.ip_address for h in cache.services.get('baz').hosts] == ['10.10.10.12']
+        assert [h.ip_address for h in cache.service_repo_names.get('bar').hosts] == ['10.10.10.10']
+
+        with patch.object(backend, 'query') as query:
+            assert host_service.list('foo')[0].ip_address == '10.10.10.10'
+            assert not query.called
 
     def test_is_expired(self):
         host = self._new_host_service()
-        host1 = {
-            # datetime.utcnow() is used to set last_check_in at registration
-            # time so that's what we need to test with
-            'last_check_in':  datetime.utcnow() - timedelta(minutes=11),
-
-            # _is_expired method references these host fields...
-            'service': 'my_service',
-            'tags': {
-                'instance_id': 'my_id',
-            },
-        }
+        # datetime.utcnow() is used to set last_check_in at registration
+        # time so that's what we need to test with
+        host1 = self._host_record(last_check_in=datetime.utcnow() - timedelta(minutes=11))
 
         _environ = dict(os.environ)
         try:
@@ -0,0 +1,38 @@
+import unittest
+from datetime import datetime
+
+from discovery.app.models.record import HostRecord
+from discovery.app.services.index import HostIndex, host_weight
+
+
+class HostIndexTestCase(unittest.TestCase):
+    def _host(self, ip_address, az, revision='abc123', **tags):
+        tags.update({'az': az, 'instance_id': 'bar', 'region': 'us-east-1'})
+        return HostRecord('foo', ip_address, 'bar', 80, revision, datetime(2018, 1, 1, 12, 0, 0), tags)
+
+    def setUp(self):
+        self.index = HostIndex([
+            self._host('10.10.10.10', 'us-east-1a', load_balancing_weight=50),
+            self._host('10.10.10.11', 'us-east-1b', canary=True),
+            self._host('10.10.10.12', 'us-east-1a', revision='def456', load_balancing_weight='10'),
+            self._host('10.10.10.13', 'us-east-1a', canary='true', load_balancing_weight=100),
+        ])
+
+    def test_select_without_filters(self):
+        assert self.index.select(()) == [0, 1, 2, 3]
+
+    def test_select_by_tags(self):
+        assert self.index.select((('az', 'us-east-1a'),)) == [0, 2, 3]
+        assert self.index.select((('az', 'us-east-1a'), ('canary', False))) == [0, 2]
+        assert self.index.select((('canary', True), ('region', 'us-east-1'))) == [1, 3]
+        assert self.index.select((('revision', 'def456'),)) == [2]
+        assert self.index.select((('az', 'us-east-1c'), ('canary', False))) == []
+
+    def test_select_by_min_weight(self):
+        assert self.index.select((('min_weight', 10),)) == [0, 2, 3]
+        assert self.index.select((('az', 'us-east-1a'), ('min_weight', 50))) == [0, 3]
+        assert self.index.select((('min_weight', 101),)) == []
+
+    def test_host_weight_defaults(self):
+        assert host_weight(self._host('10.10.10.10', 'us-east-1a')) == 1
+        assert host_weight(self._host('10.10.10.10', 'us-east-1a', load_balancing_weight='x')) == 1
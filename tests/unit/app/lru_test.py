@@ -0,0 +1,47 @@
+import unittest
+
+from discovery.app.lru import LRUCache, SizedLRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        assert lru['a'] == 1
+        lru['c'] = 3
+
+        assert 'b' not in lru
+        assert len(lru) == 2
+
+
+class SizedLRUCacheTestCase(unittest.TestCase):
+    def test_evicts_by_size(self):
+        lru = SizedLRUCache(10, len)
+        lru['a'] = 'xxxx'
+        lru['b'] = 'xxxx'
+        assert lru['a'] == 'xxxx'
+        lru['c'] = 'xxxxxx'
+
+        assert 'b' not in lru
+        assert 'a' in lru and 'c' in lru
+        assert lru.size == 10
+        assert lru.evictions == 1
+
+    def test_replace_and_delete_update_size(self):
+        lru = SizedLRUCache(10, len)
+        lru['a'] = 'xxxx'
+        lru['a'] = 'xx'
+        assert lru.size == 2
+        del lru['a']
+        assert lru.size == 0
+        assert len(lru) == 0
+
+    def test_values_larger_than_budget_are_not_kept(self):
+        lru = SizedLRUCache(10, len)
+        lru['a'] = 'xxxx'
+        lru['b'] = 'x' * 11
+
+        assert 'b' not in lru
+        assert 'a' in lru
+        assert lru.evictions == 0
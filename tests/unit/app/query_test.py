@@ -1,6 +1,16 @@
 import abc
+import fcntl
+import gevent
+import json
+import os
+import pickle
+import tempfile
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
+from mock import patch
+from pynamodb.constants import ATTRIBUTES
+from pynamodb.exceptions import PutError
+from discovery.app.models.record import HostRecord
 from discovery.app.services import query
 
 
@@ -18,59 +28,130 @@ class QueryBackendTestCase(object):
         query = self._new_query_backend()
         self.assertEqual([], list(query.query('wut')))
 
-        host1 = {
-            'service': 'host1',
-            'ip_address': '1.1.1.1',
-            'service_repo_name': 'hosts_repo',
-            'port': 80,
-            'revision': 'host1_rev1',
-            'last_check_in': datetime.utcnow(),
-            'tags': self._generate_valid_tags()
-        }
-
-        host2 = {
-            'service': 'host2',
-            'ip_address': '1.1.1.1',
-            'service_repo_name': host1['service_repo_name'],
-            'port': 90,
-            'revision': 'host2_rev1',
-            'last_check_in': datetime.utcnow(),
-            'tags': self._generate_valid_tags()
-        }
+        host1 = HostRecord(
+            service='host1',
+            ip_address='1.1.1.1',
+            service_repo_name='hosts_repo',
+            port=80,
+            revision='host1_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+
+        host2 = HostRecord(
+            service='host2',
+            ip_address='1.1.1.1',
+            service_repo_name=host1.service_repo_name,
+            port=90,
+            revision='host2_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
 
         query.put(host1)
 
-        host1_get = query.get(host1['service'], host1['ip_address'])
+        host1_get = query.get(host1.service, host1.ip_address)
         self.assertEqual(host1, host1_get)
 
         query.put(host2)
 
-        host1_get = query.get(host1['service'], host1['ip_address'])
+        host1_get = query.get(host1.service, host1.ip_address)
         self.assertEqual(host1, host1_get)
 
-        host2_get = query.get(host2['service'], host2['ip_address'])
+        host2_get = query.get(host2.service, host2.ip_address)
         self.assertEqual(host2, host2_get)
 
-        host2_service = host2['service']
-        host2['service'] = 'bad!!!!'
-
-        self.assertNotEqual(host2, host2_get)
-
-        host2['service'] = host2_service
-        self.assertEqual(host2, host2_get)
+        self.assertNotEqual(host2.replace(service='bad!!!!'), host2_get)
 
         secondary_query = sorted(
-            query.query_secondary_index(host1['service_repo_name']),
-            key=lambda dct: sorted(dct.items()),
+            query.query_secondary_index(host1.service_repo_name),
+            key=lambda host: host.service,
         )
         self.assertEqual([host1, host2], secondary_query)
 
-        query.delete(host2['service'], host2['ip_address'])
+        query.delete(host2.service, host2.ip_address)
 
-        secondary_query = list(query.query_secondary_index(host1['service_repo_name']))
+        secondary_query = list(query.query_secondary_index(host1.service_repo_name))
         self.assertEqual([host1], secondary_query)
 
-        self.assertIsNone(query.get(host2['service'], host2['ip_address']))
+        self.assertIsNone(query.get(host2.service, host2.ip_address))
+
+    def test_upsert_merges_tags(self):
+        query = self._new_query_backend()
+        host = HostRecord(
+            service='upserted',
+            ip_address='1.1.1.1',
+            service_repo_name='upserted_repo',
+            port=80,
+            revision='upserted_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=dict(self._generate_valid_tags(), load_balancing_weight=10)
+        )
+        self.assertIsNone(query.upsert(host))
+        self.assertEqual(host, query.get(host.service, host.ip_address))
+
+        heartbeat = host.replace(revision='upserted_rev2', tags=self._generate_valid_tags())
+        stored_host = query.upsert(heartbeat)
+        self.assertEqual(host, stored_host)
+
+        expected = heartbeat.replace(tags=host.tags)
+        self.assertEqual(expected, query.get(host.service, host.ip_address))
+
+    def test_batch_put_and_get(self):
+        query = self._new_query_backend()
+        hosts = [HostRecord('batched', '1.1.1.%d' % i, 'batched_repo', 80, 'batched_rev1', datetime.utcnow(),
+                            self._generate_valid_tags())
+                 for i in range(3)]
+        self.assertTrue(query.batch_put(hosts))
+
+        found = query.batch_get([('batched', '1.1.1.0'), ('batched', '1.1.1.2'), ('batched', '1.1.1.9')])
+        self.assertEqual([hosts[0], hosts[2]], sorted(found, key=lambda host: host.ip_address))
+
+    def test_delete_expired_keeps_hosts_checked_in_again(self):
+        query = self._new_query_backend()
+        expired = HostRecord('expiring', '1.1.1.1', None, 80, 'rev1', datetime.utcnow() - timedelta(days=1),
+                             self._generate_valid_tags())
+        query.put(expired)
+        query.put(expired.replace(last_check_in=datetime.utcnow()))
+        cutoff = datetime.utcnow() - timedelta(hours=1)
+
+        self.assertEqual([], query.delete_expired([expired], cutoff))
+        self.assertIsNotNone(query.get('expiring', '1.1.1.1'))
+
+        query.put(expired)
+        self.assertEqual([expired], query.delete_expired([expired], cutoff))
+        self.assertIsNone(query.get('expiring', '1.1.1.1'))
+
+    def test_query_many(self):
+        query = self._new_query_backend()
+        hosts = [HostRecord(service, '1.1.1.1', None, 80, 'rev1', datetime.utcnow(), self._generate_valid_tags())
+                 for service in ('many1', 'many2')]
+        query.batch_put(hosts)
+
+        self.assertEqual({'many1': [hosts[0]], 'many2': [hosts[1]], 'many3': []},
+                         query.query_many(['many1', 'many2', 'many3']))
+
+    def test_secondary_index_follows_updates(self):
+        query = self._new_query_backend()
+        host = HostRecord(
+            service='indexed',
+            ip_address='1.1.1.1',
+            service_repo_name='indexed_repo1',
+            port=80,
+            revision='indexed_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+        query.put(host)
+        self.assertEqual([host], list(query.query_secondary_index('indexed_repo1')))
+
+        moved_host = host.replace(service_repo_name='indexed_repo2')
+        query.put(moved_host)
+        self.assertEqual([], list(query.query_secondary_index('indexed_repo1')))
+        self.assertEqual([moved_host], list(query.query_secondary_index('indexed_repo2')))
+
+        query.delete(host.service, host.ip_address)
+        self.assertEqual([], list(query.query_secondary_index('indexed_repo2')))
 
 
 class MemoryQueryBackendTestCase(unittest.TestCase, QueryBackendTestCase):
@@ -81,3 +162,414 @@ class MemoryQueryBackendTestCase(unittest.TestCase, QueryBackendTestCase):
 class LocalDistQueryBackendTestCase(MemoryQueryBackendTestCase):
     def _new_query_backend(self):
         return query.LocalFileQueryBackend()
+
+    def test_secondary_index_is_rebuilt_on_load(self):
+        backend = self._new_query_backend()
+        host = HostRecord(
+            service='reloaded',
+            ip_address='1.1.1.1',
+            service_repo_name='reloaded_repo',
+            port=80,
+            revision='reloaded_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+        backend.put(host)
+
+        reloaded = query.LocalFileQueryBackend(backend.file)
+        self.assertEqual([host], list(reloaded.query_secondary_index('reloaded_repo')))
+
+    def test_snapshot_of_host_dicts_is_loaded(self):
+        file = os.path.join(tempfile.mkdtemp(), 'hosts')
+        host = self._journaled_host('1.1.1.1')
+        legacy_host = host.to_dict()
+        del legacy_host['service']
+        del legacy_host['ip_address']
+        with open(file, 'wb') as f:
+            pickle.dump({'journaled': {'1.1.1.1': legacy_host}}, f)
+
+        reloaded = query.LocalFileQueryBackend(file)
+        self.assertEqual([host], list(reloaded.query_secondary_index('journaled_repo')))
+
+    def _journaled_host(self, ip_address):
+        return HostRecord(
+            service='journaled',
+            ip_address=ip_address,
+            service_repo_name='journaled_repo',
+            port=80,
+            revision='journaled_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+
+    def test_journal_is_replayed_over_snapshot(self):
+        file = os.path.join(tempfile.mkdtemp(), 'hosts')
+        backend = query.LocalFileQueryBackend(file, fsync_every=1, snapshot_every=3)
+        for i in range(4):
+            backend.put(self._journaled_host('1.1.1.%d' % i))
+        backend.delete('journaled', '1.1.1.0')
+
+        # the first 3 puts went to the snapshot, the rest is in the journal
+        self.assertEqual(2, backend.journaled)
+        reloaded = query.LocalFileQueryBackend(file)
+        self.assertEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'],
+                         sorted(host.ip_address for host in reloaded.query('journaled')))
+
+    def test_truncated_journal_record_is_ignored(self):
+        file = os.path.join(tempfile.mkdtemp(), 'hosts')
+        backend = query.LocalFileQueryBackend(file, fsync_every=1, snapshot_every=100)
+        backend.put(self._journaled_host('1.1.1.1'))
+        backend.put(self._journaled_host('1.1.1.2'))
+        backend.journal.close()
+        with open(backend.journal_file, 'rb+') as f:
+            f.truncate(os.path.getsize(backend.journal_file) - 10)
+
+        reloaded = query.LocalFileQueryBackend(file)
+        self.assertEqual(['1.1.1.1'], [host.ip_address for host in reloaded.query('journaled')])
+
+        reloaded.put(self._journaled_host('1.1.1.3'))
+        reloaded.journal.close()
+        self.assertEqual(['1.1.1.1', '1.1.1.3'],
+                         sorted(host.ip_address for host in query.LocalFileQueryBackend(file).query('journaled')))
+
+
+class MappedFileQueryBackendTestCase(unittest.TestCase, QueryBackendTestCase):
+    def setUp(self):
+        self.file = os.path.join(tempfile.mkdtemp(), 'hosts')
+
+    def _new_query_backend(self):
+        return query.MappedFileQueryBackend(self.file)
+
+    def _host(self, ip_address, service_repo_name='mapped_repo'):
+        return HostRecord(
+            service='mapped',
+            ip_address=ip_address,
+            service_repo_name=service_repo_name,
+            port=80,
+            revision='mapped_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+
+    def test_processes_see_each_others_writes(self):
+        writer = self._new_query_backend()
+        reader = self._new_query_backend()
+        host = self._host('1.1.1.1')
+
+        writer.put(host)
+        self.assertEqual([host], list(reader.query('mapped')))
+
+        updated_host = host.replace(revision='mapped_rev2', tags=dict(host.tags, canary=True))
+        writer.put(updated_host)
+        self.assertEqual(updated_host, reader.get('mapped', '1.1.1.1'))
+
+        moved_host = updated_host.replace(service_repo_name='other_repo')
+        writer.put(moved_host)
+        self.assertEqual([], list(reader.query_secondary_index('mapped_repo')))
+        self.assertEqual([moved_host], list(reader.query_secondary_index('other_repo')))
+
+        writer.delete('mapped', '1.1.1.1')
+        self.assertIsNone(reader.get('mapped', '1.1.1.1'))
+        self.assertEqual([], list(reader.query('mapped')))
+
+    def test_grows_and_compacts(self):
+        backend = self._new_query_backend()
+        reader = self._new_query_backend()
+        hosts = [self._host('10.0.%d.%d' % (i // 256, i % 256)) for i in range(3000)]
+        for host in hosts:
+            backend.put(host)
+        self.assertEqual(3000, len(list(reader.query('mapped'))))
+
+        backend.delete_expired(hosts[:2500], datetime.utcnow() + timedelta(days=1))
+        self.assertEqual(0, backend.dead)
+        self.assertEqual(sorted(h.ip_address for h in hosts[2500:]),
+                         sorted(h.ip_address for h in reader.query('mapped')))
+
+        reopened = self._new_query_backend()
+        self.assertEqual(500, reopened.indexed)
+
+    def test_compact_drops_unused_strings(self):
+        backend = self._new_query_backend()
+        reader = self._new_query_backend()
+        host = self._host('1.1.1.1')
+        for i in range(100):
+            backend.put(host.replace(revision='mapped_rev%d' % i))
+        strings_file = backend.strings_file
+
+        backend.compact()
+        self.assertFalse(os.path.exists(strings_file))
+        strings = ['mapped', 'mapped_repo', 'mapped_rev99', json.dumps(host.tags, sort_keys=True)]
+        self.assertEqual(sum(4 + len(string) for string in strings), os.path.getsize(backend.strings_file))
+        self.assertEqual([host.replace(revision='mapped_rev99')], reader.query('mapped'))
+
+    def test_heartbeats_keep_the_stored_strings(self):
+        backend = self._new_query_backend()
+        reader = self._new_query_backend()
+        host = self._host('1.1.1.1')
+        backend.put(host)
+        strings_size = os.path.getsize(backend.strings_file)
+
+        heartbeat = host.replace(last_check_in=datetime.utcnow())
+        reader.put(heartbeat)
+        self.assertEqual(strings_size, os.path.getsize(backend.strings_file))
+        self.assertEqual(heartbeat, backend.get('mapped', '1.1.1.1'))
+
+    def test_lock_is_polled(self):
+        backend = self._new_query_backend()
+        other_process = open(self.file + '.lock', 'ab')
+        fcntl.flock(other_process.fileno(), fcntl.LOCK_EX)
+        reader = gevent.spawn(backend.query, 'mapped')
+        try:
+            gevent.sleep(0.01)
+            self.assertFalse(reader.ready())
+        finally:
+            fcntl.flock(other_process.fileno(), fcntl.LOCK_UN)
+            other_process.close()
+        self.assertEqual([], reader.get(timeout=1))
+
+    def test_strings_file_is_compacted_when_doubled(self):
+        backend = self._new_query_backend()
+        backend.MIN_STRINGS_COMPACT_SIZE = 1000
+        host = self._host('1.1.1.1')
+        for i in range(100):
+            backend.put(host.replace(revision='mapped_rev%d' % i))
+
+        self.assertLess(backend.strings_size, 1000)
+        self.assertEqual('mapped_rev99', backend.get('mapped', '1.1.1.1').revision)
+
+
+class DictQueryBackend(query.QueryBackend):
+    """A plugin backend taking and returning host dicts."""
+
+    def __init__(self):
+        self.hosts = {}
+
+    def query(self, service):
+        return [dict(host) for host in self.hosts.values() if host['service'] == service]
+
+    def query_secondary_index(self, service_repo_name):
+        return [dict(host) for host in self.hosts.values() if host['service_repo_name'] == service_repo_name]
+
+    def get(self, service, ip_address):
+        host = self.hosts.get((service, ip_address))
+        return dict(host) if host is not None else None
+
+    def put(self, host):
+        assert isinstance(host, dict)
+        self.hosts[(host['service'], host['ip_address'])] = host
+        return True
+
+    def delete(self, service, ip_address):
+        return self.hosts.pop((service, ip_address), None) is not None
+
+
+class PluginQueryBackendTestCase(unittest.TestCase, QueryBackendTestCase):
+    def _new_query_backend(self):
+        return query.PluginQueryBackend(DictQueryBackend())
+
+
+class CoalescingQueryBackendTestCase(MemoryQueryBackendTestCase):
+    def _new_query_backend(self):
+        return query.CoalescingQueryBackend(query.MemoryQueryBackend(), max_age=60, capacity=10)
+
+    def test_heartbeats_are_coalesced(self):
+        backend = self._new_query_backend()
+        check_in = datetime.utcnow()
+        host = HostRecord(
+            service='host1',
+            ip_address='1.1.1.1',
+            service_repo_name='hosts_repo',
+            port=80,
+            revision='host1_rev1',
+            last_check_in=check_in,
+            tags=self._generate_valid_tags()
+        )
+        backend.upsert(host)
+
+        stored_host = backend.upsert(host.replace(last_check_in=check_in + timedelta(seconds=30)))
+        self.assertEqual(host, stored_host)
+        self.assertEqual(check_in, backend.get('host1', '1.1.1.1').last_check_in)
+        self.assertEqual((1, 1), (backend.written, backend.skipped))
+
+        backend.upsert(host.replace(last_check_in=check_in + timedelta(seconds=61)))
+        self.assertEqual(check_in + timedelta(seconds=61), backend.get('host1', '1.1.1.1').last_check_in)
+        self.assertEqual((2, 1), (backend.written, backend.skipped))
+
+        backend.upsert(host.replace(revision='host1_rev2', last_check_in=check_in + timedelta(seconds=62)))
+        self.assertEqual('host1_rev2', backend.get('host1', '1.1.1.1').revision)
+        self.assertEqual((3, 1), (backend.written, backend.skipped))
+
+    def test_delete_forgets_persisted_host(self):
+        backend = self._new_query_backend()
+        host = HostRecord(
+            service='host1',
+            ip_address='1.1.1.1',
+            service_repo_name='hosts_repo',
+            port=80,
+            revision='host1_rev1',
+            last_check_in=datetime.utcnow(),
+            tags=self._generate_valid_tags()
+        )
+        backend.upsert(host)
+        backend.delete('host1', '1.1.1.1')
+
+        self.assertIsNone(backend.upsert(host))
+        self.assertEqual(host, backend.get('host1', '1.1.1.1'))
+
+
+class WriteBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+
+    def _write(self, hosts):
+        self.writes.append(hosts)
+
+    def _host(self, service, ip_address, revision='rev1'):
+        return HostRecord(
+            service=service,
+            ip_address=ip_address,
+            service_repo_name='hosts_repo',
+            port=80,
+            revision=revision,
+            last_check_in=datetime.utcnow(),
+            tags={'az': 'foo', 'instance_id': 'bar', 'region': 'baz'}
+        )
+
+    def test_writes_are_deduplicated(self):
+        buffer = query.WriteBuffer(self._write, interval=60, batch_size=10, max_pending=100)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        buffer.add(self._host('host1', '1.1.1.2'))
+        buffer.add(self._host('host1', '1.1.1.1', revision='rev2'))
+        self.assertEqual('rev2', buffer.get('host1', '1.1.1.1').revision)
+
+        self.assertTrue(buffer.flush())
+        self.assertEqual(1, len(self.writes))
+        self.assertEqual([('1.1.1.2', 'rev1'), ('1.1.1.1', 'rev2')],
+                         [(host.ip_address, host.revision) for host in self.writes[0]])
+        self.assertIsNone(buffer.get('host1', '1.1.1.1'))
+        buffer.greenlet.kill()
+
+    def test_flushes_in_background_on_batch_size(self):
+        buffer = query.WriteBuffer(self._write, interval=60, batch_size=2, max_pending=100)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        gevent.sleep(0)
+        self.assertEqual([], self.writes)
+
+        buffer.add(self._host('host1', '1.1.1.2'))
+        gevent.sleep(0)
+        self.assertEqual(1, len(self.writes))
+        self.assertEqual(2, len(self.writes[0]))
+        buffer.greenlet.kill()
+
+    def test_writers_flush_when_full(self):
+        buffer = query.WriteBuffer(self._write, interval=60, batch_size=10, max_pending=2)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        buffer.add(self._host('host1', '1.1.1.2'))
+        self.assertEqual(1, len(self.writes))
+        self.assertEqual({}, dict(buffer.pending))
+        buffer.greenlet.kill()
+
+    def test_failed_flush_keeps_hosts_pending(self):
+        def failing_write(hosts):
+            raise IOError('throttled')
+        buffer = query.WriteBuffer(failing_write, interval=60, batch_size=10, max_pending=100)
+        buffer.add(self._host('host1', '1.1.1.1'))
+
+        self.assertFalse(buffer.flush())
+        self.assertIsNotNone(buffer.get('host1', '1.1.1.1'))
+        buffer.greenlet.kill()
+
+    def test_hosts_being_flushed_stay_visible(self):
+        def failing_write(hosts):
+            gevent.sleep(0.01)
+            raise IOError('throttled')
+        buffer = query.WriteBuffer(failing_write, interval=60, batch_size=10, max_pending=100)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        buffer.add(self._host('host1', '1.1.1.2'))
+        flush = gevent.spawn(buffer.flush)
+        gevent.sleep(0)
+
+        self.assertEqual({}, dict(buffer.pending))
+        self.assertEqual('rev1', buffer.get('host1', '1.1.1.1').revision)
+        self.assertEqual(['1.1.1.1', '1.1.1.2'], [host.ip_address for host in buffer.overlay([], lambda host: True)])
+        self.assertTrue(buffer.discard('host1', '1.1.1.2'))
+        self.assertFalse(flush.get())
+        self.assertIsNotNone(buffer.get('host1', '1.1.1.1'))
+        self.assertIsNone(buffer.get('host1', '1.1.1.2'))
+        buffer.greenlet.kill()
+
+    def test_discard_waits_for_flush_of_host(self):
+        def slow_write(hosts):
+            gevent.sleep(0.01)
+            self.writes.append(hosts)
+        buffer = query.WriteBuffer(slow_write, interval=60, batch_size=10, max_pending=100)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        flush = gevent.spawn(buffer.flush)
+        gevent.sleep(0)
+
+        self.assertTrue(buffer.discard('host1', '1.1.1.1'))
+        self.assertEqual(1, len(self.writes))
+        self.assertTrue(flush.get())
+        buffer.greenlet.kill()
+
+    def test_writers_write_through_when_full_and_failing(self):
+        def failing_write(hosts):
+            if len(hosts) > 1:
+                raise IOError('throttled')
+            self.writes.append(hosts)
+        buffer = query.WriteBuffer(failing_write, interval=60, batch_size=10, max_pending=2)
+        buffer.add(self._host('host1', '1.1.1.1'))
+        buffer.add(self._host('host1', '1.1.1.2'))
+        self.assertEqual(2, len(buffer.pending))
+
+        buffer.add(self._host('host1', '1.1.1.3'))
+        self.assertEqual(2, len(buffer.pending))
+        self.assertEqual([['1.1.1.3']], [[host.ip_address for host in hosts] for hosts in self.writes])
+        buffer.greenlet.kill()
+
+    def test_overlay(self):
+        buffer = query.WriteBuffer(self._write, interval=60, batch_size=10, max_pending=100)
+        stored = [self._host('host1', '1.1.1.1'), self._host('host1', '1.1.1.2')]
+        buffer.add(self._host('host1', '1.1.1.2', revision='rev2'))
+        buffer.add(self._host('host1', '1.1.1.3'))
+        buffer.add(self._host('host2', '1.1.1.1'))
+
+        hosts = list(buffer.overlay(stored, lambda host: host.service == 'host1'))
+        self.assertEqual([('1.1.1.1', 'rev1'), ('1.1.1.2', 'rev2'), ('1.1.1.3', 'rev1')],
+                         [(host.ip_address, host.revision) for host in hosts])
+        buffer.greenlet.kill()
+
+
+class DynamoQueryBackendTestCase(unittest.TestCase):
+    def _host(self, tags):
+        return HostRecord('dynamo', '1.1.1.1', None, 80, 'rev1', datetime.utcnow(), tags)
+
+    @patch('discovery.app.models.host.Host._get_connection')
+    def test_upsert_writes_tags_of_new_host_at_once(self, get_connection):
+        connection = get_connection.return_value
+        connection.update_item.return_value = {}
+
+        self.assertIsNone(query.DynamoQueryBackend().upsert(self._host({'az': 'foo', 'instance_id': 'bar'})))
+        self.assertEqual(1, connection.update_item.call_count)
+        actions = [str(action) for action in connection.update_item.call_args[1]['actions']]
+        self.assertIn('tags = if_not_exists (tags, {\'S\': \'{"az": "foo", "instance_id": "bar"}\'})', actions)
+
+    @patch('discovery.app.models.host.Host.from_raw_data')
+    @patch('discovery.app.models.host.Host._get_connection')
+    def test_upsert_merges_tags_of_existing_host(self, get_connection, from_raw_data):
+        from_raw_data.return_value = query.DynamoQueryBackend()._record_to_pynamo_host(
+            self._host({'az': 'foo', 'region': 'baz'}))
+        connection = get_connection.return_value
+        connection.update_item.return_value = {ATTRIBUTES: {'port': {'N': '80'}}}
+
+        self.assertEqual({'az': 'foo', 'region': 'baz'},
+                         query.DynamoQueryBackend().upsert(self._host({'az': 'qux'})).tags)
+        self.assertEqual(2, connection.update_item.call_count)
+        self.assertEqual(['tags = {\'S\': \'{"az": "qux", "region": "baz"}\'}'],
+                         [str(action) for action in connection.update_item.call_args[1]['actions']])
+
+    @patch('discovery.app.models.host.Host.batch_write')
+    def test_batch_put_returns_false_on_failure(self, batch_write):
+        batch_write.return_value.__exit__.side_effect = PutError('throttled')
+
+        self.assertFalse(query.DynamoQueryBackend().batch_put([self._host({'az': 'foo'})]))
@@ -0,0 +1,52 @@
+import pickle
+import unittest
+from datetime import datetime
+
+from discovery.app.models import record
+from discovery.app.models.record import HostRecord
+
+
+class HostRecordTestCase(unittest.TestCase):
+    def _host(self, ip_address='10.10.10.10'):
+        return HostRecord(''.join(['f', 'oo']), ip_address, 'bar', 80, 'abc123', datetime(2018, 1, 1),
+                          {'az': ''.join(['us-east-', '1a']), 'instance_id': 'i-1', 'region': 'us-east-1'})
+
+    def test_is_immutable(self):
+        host = self._host()
+        with self.assertRaises(AttributeError):
+            host.port = 90
+        with self.assertRaises(AttributeError):
+            host.extra = 'field'
+
+    def test_interns_shared_strings(self):
+        host1 = self._host('10.10.10.10')
+        host2 = self._host('10.10.10.11')
+        assert host1.service is host2.service
+        assert host1.tags['az'] is host2.tags['az']
+
+    def test_does_not_intern_revisions(self):
+        revision = ''.join(['def', '456'])
+        host = HostRecord('foo', '10.10.10.10', 'bar', 80, revision, datetime(2018, 1, 1), {'az': 'us-east-1a'})
+        assert host.revision is revision
+        assert revision not in record._strings
+
+    def test_with_tags_copies(self):
+        host = self._host()
+        tagged = host.with_tags({'load_balancing_weight': 10})
+        assert tagged.tags['load_balancing_weight'] == 10
+        assert tagged.tags['az'] == 'us-east-1a'
+        assert 'load_balancing_weight' not in host.tags
+        assert host.replace(port=90).port == 90
+
+    def test_dict_conversion(self):
+        host = self._host()
+        host_dict = host.to_dict()
+        assert host_dict['service'] == 'foo'
+        assert host_dict['tags'] == host.tags
+        assert host_dict['tags'] is not host.tags
+        assert HostRecord.from_dict(host_dict) == host
+
+    def test_pickle(self):
+        host = self._host()
+        assert pickle.loads(pickle.dumps(host, pickle.HIGHEST_PROTOCOL)) == host
+        assert pickle.loads(pickle.dumps(host, 0)) == host
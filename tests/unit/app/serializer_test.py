@@ -0,0 +1,28 @@
+import gzip
+import io
+import json
+import unittest
+from datetime import datetime
+
+from discovery.app.models.record import HostRecord
+from discovery.app.services.serializer import HostSerializer
+
+
+class HostSerializerTestCase(unittest.TestCase):
+    def _host(self):
+        return HostRecord('foo', '10.10.10.10', 'bar', 80, 'abc123', datetime(2018, 1, 1, 12, 0, 0),
+                          {'az': 'foo', 'instance_id': 'bar', 'region': 'baz'})
+
+    def test_serialize_converts_records(self):
+        host = self._host()
+        serialized = HostSerializer.serialize([host])
+        assert serialized[0] == dict(host.to_dict(), last_check_in='2018-01-01 12:00:00')
+        assert host.last_check_in == datetime(2018, 1, 1, 12, 0, 0)
+
+    def test_encode_and_compress(self):
+        payload = {'service': 'foo', 'env': 'development', 'hosts': HostSerializer.serialize([self._host()])}
+        body = HostSerializer.encode(payload)
+        assert json.loads(body.decode('utf-8')) == payload
+
+        compressed = HostSerializer.compress(body)
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == body
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gevent
+from discovery.app.services.shared_cache import SharedCacheStore
+
+
+class FakeEntry(object):
+    def __init__(self, hosts, refresh_at=None):
+        self.hosts = hosts
+        self.refresh_at = refresh_at
+        self.body = b'{"hosts": []}'
+        self.gzip_body = b'gzipped'
+        self.version = 'abc123'
+
+
+class SharedCacheStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SharedCacheStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_missing(self):
+        assert self.store.get('service:foo') is None
+
+    def test_set_and_get(self):
+        hosts = [{'service': 'foo', 'ip_address': '10.0.0.1', 'port': 80}]
+        refresh_at = time.time() + 5
+        self.store.set('service:foo', FakeEntry(hosts, refresh_at), 30)
+
+        # Another process sees the same entry through its own store.
+        entry = SharedCacheStore(self.directory).get('service:foo')
+        assert entry.version == 'abc123'
+        assert entry.body == b'{"hosts": []}'
+        assert entry.gzip_body == b'gzipped'
+        assert entry.refresh_at == refresh_at
+        assert entry.hosts == hosts
+        assert self.store.get('service:bar') is None
+
+    def test_bodies_are_not_copied(self):
+        self.store.set('service:foo', FakeEntry([]), 30)
+        entry = self.store.get('service:foo')
+        assert isinstance(entry.body, memoryview)
+        assert isinstance(entry.gzip_body, memoryview)
+
+    def test_get_reuses_mapped_entry(self):
+        self.store.set('service:foo', FakeEntry([{'ip_address': '10.0.0.1'}]), 30)
+        entry = self.store.get('service:foo')
+        assert self.store.get('service:foo') is entry
+
+        # A replaced file is mapped again.
+        self.store.set('service:foo', FakeEntry([{'ip_address': '10.0.0.2'}]), 30)
+        assert self.store.get('service:foo') is not entry
+        assert self.store.get('service:foo').hosts == [{'ip_address': '10.0.0.2'}]
+
+    def test_set_replaces_entry(self):
+        self.store.set('service:foo', FakeEntry([]), 30)
+        old = self.store.get('service:foo')
+        self.store.set('service:foo', FakeEntry([{'ip_address': '10.0.0.2'}]), 30)
+
+        assert self.store.get('service:foo').hosts == [{'ip_address': '10.0.0.2'}]
+        # Entries already read stay readable.
+        assert old.hosts == []
+        assert old.refresh_at is None
+
+    def test_expired_entry(self):
+        self.store.set('service:foo', FakeEntry([]), -1)
+        assert self.store.get('service:foo') is None
+
+    def test_lock_is_exclusive(self):
+        other = SharedCacheStore(self.directory)
+        with self.store.lock('service:foo') as acquired:
+            assert acquired
+            with other.lock('service:foo', blocking=False) as other_acquired:
+                assert not other_acquired
+            with other.lock('service:bar', blocking=False) as other_acquired:
+                assert other_acquired
+        with other.lock('service:foo', blocking=False) as other_acquired:
+            assert other_acquired
+
+    def test_blocking_lock_waits_for_release(self):
+        other = SharedCacheStore(self.directory)
+        order = []
+
+        def wait_for_lock():
+            with other.lock('service:foo') as acquired:
+                order.append(('waiter', acquired))
+
+        with self.store.lock('service:foo'):
+            waiter = gevent.spawn(wait_for_lock)
+            gevent.sleep(0.05)
+            order.append(('holder', True))
+        waiter.join(1)
+
+        assert order == [('holder', True), ('waiter', True)]
+
+    def test_evict_expired(self):
+        self.store.set('service:foo', FakeEntry([]), 30)
+        self.store.set('service:bar', FakeEntry([]), -1)
+        with self.store.lock('service:foo'):
+            pass
+        with self.store.lock('service:bar'):
+            pass
+        with self.store.lock('service:baz'):
+            pass
+
+        assert self.store.evict_expired() == 1
+        entry_file = os.path.basename(self.store._path('service:foo'))
+        assert sorted(os.listdir(self.directory)) == [entry_file, entry_file + '.lock']
+        assert self.store.get('service:foo') is not None
+
+    def test_lock_removed_while_waiting_is_not_shared(self):
+        other = SharedCacheStore(self.directory)
+        order = []
+
+        def wait_for_lock():
+            with other.lock('service:foo'):
+                order.append('waiter')
+                with SharedCacheStore(self.directory).lock('service:foo', blocking=False) as acquired:
+                    order.append(acquired)
+
+        with self.store.lock('service:foo'):
+            waiter = gevent.spawn(wait_for_lock)
+            gevent.sleep(0.05)
+            os.remove(self.store._path('service:foo') + '.lock')
+        waiter.join(1)
+
+        assert order == ['waiter', False]
@@ -0,0 +1,90 @@
+import unittest
+
+import gevent
+from discovery.app.singleflight import SingleFlight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def _slow_query(self, value):
+        self.calls += 1
+        gevent.sleep(0.01)
+        return value
+
+    def _failing_query(self):
+        self.calls += 1
+        gevent.sleep(0.01)
+        raise ValueError('backend down')
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        greenlets = [gevent.spawn(flight.do, 'foo', self._slow_query, [1, 2]) for _ in range(10)]
+        gevent.joinall(greenlets)
+
+        assert self.calls == 1
+        results = [g.value for g in greenlets]
+        assert all(result == [1, 2] for result, _ in results)
+        assert sorted(shared for _, shared in results) == [False] + [True] * 9
+        assert 'foo' not in flight
+
+    def test_different_keys_are_not_coalesced(self):
+        flight = SingleFlight()
+        greenlets = [
+            gevent.spawn(flight.do, 'foo', self._slow_query, 'foo'),
+            gevent.spawn(flight.do, 'bar', self._slow_query, 'bar'),
+        ]
+        gevent.joinall(greenlets)
+
+        assert self.calls == 2
+        assert [g.value for g in greenlets] == [('foo', False), ('bar', False)]
+
+    def test_exception_is_shared(self):
+        flight = SingleFlight()
+        greenlets = [gevent.spawn(flight.do, 'foo', self._failing_query) for _ in range(3)]
+        gevent.joinall(greenlets)
+
+        assert self.calls == 1
+        assert all(isinstance(g.exception, ValueError) for g in greenlets)
+        assert 'foo' not in flight
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flight = SingleFlight()
+        assert flight.do('foo', self._slow_query, 1) == (1, False)
+        assert flight.do('foo', self._slow_query, 2) == (2, False)
+        assert self.calls == 2
+
+    def _slow_query_many(self, keys):
+        self.calls += 1
+        gevent.sleep(0.01)
+        return dict((key, key * 2) for key in keys)
+
+    def test_many_calls_share_keys_in_flight(self):
+        flight = SingleFlight()
+        first = gevent.spawn(flight.do_many, [1, 2], self._slow_query_many)
+        gevent.sleep(0)
+        second = gevent.spawn(flight.do_many, [2, 3], self._slow_query_many)
+        single = gevent.spawn(flight.do, 3, self._slow_query, 'three')
+        gevent.joinall([first, second, single])
+
+        assert first.value == {1: 2, 2: 4}
+        # 2 was in flight for the first call, 3 was only asked for by the second one
+        assert second.value == {2: 4, 3: 6}
+        assert single.value == (6, True)
+        assert self.calls == 2
+        assert not flight.calls
+
+    def test_many_calls_share_exceptions(self):
+        def failing_query_many(keys):
+            gevent.sleep(0.01)
+            raise ValueError('backend down')
+        flight = SingleFlight()
+        first = gevent.spawn(flight.do_many, [1, 2], failing_query_many)
+        gevent.sleep(0)
+        second = gevent.spawn(flight.do, 2, self._slow_query, 'two')
+        gevent.joinall([first, second])
+
+        assert isinstance(first.exception, ValueError)
+        assert isinstance(second.exception, ValueError)
+        assert not flight.calls
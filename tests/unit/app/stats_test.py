@@ -0,0 +1,44 @@
+import unittest
+
+import gevent
+import statsd
+from mock import patch
+
+from discovery.app import stats
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = statsd.StatsClient()
+        patcher = patch.object(self.client, '_send')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_metrics_are_sent_in_batches(self):
+        metrics = stats.Metrics(self.client, flush_interval=10, batch_size=3)
+        foo = stats.Stats(metrics, 'foo')
+        foo.incr('bar')
+        foo.timing('baz', 12)
+        assert not self.send.called
+
+        foo.gauge('qux', 5)
+        self.send.assert_called_once_with('foo.bar:1|c\nfoo.baz:12.000000|ms\nfoo.qux:5|g')
+        assert metrics.pending == 0
+
+    def test_metrics_are_sent_after_the_interval(self):
+        metrics = stats.Metrics(self.client, flush_interval=0.01, batch_size=100)
+        stats.Stats(metrics, 'foo').incr('bar')
+        assert not self.send.called
+
+        gevent.sleep(0.02)
+        self.send.assert_called_once_with('foo.bar:1|c')
+        assert metrics.flusher is None
+
+    def test_metrics_are_sent_right_away_without_interval(self):
+        metrics = stats.Metrics(self.client, flush_interval=0, batch_size=100)
+        stats.Stats(metrics, '').incr('bar', 2)
+        self.send.assert_called_once_with('bar:2|c')
+
+    def test_get_stats_is_shared(self):
+        assert stats.get_stats('foo') is stats.get_stats('foo')
+        assert stats.get_stats('foo').metrics is stats.metrics
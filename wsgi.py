@@ -5,6 +5,16 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 from app import app, settings
+from app.resources.api import BACKEND_STORAGE
+from app.services.sweeper import Sweeper
+from app.services.warmup import Warmer
+
+
+if settings.value.CACHE_WARMUP:
+    Warmer(BACKEND_STORAGE).start(app)
+
+if settings.value.SWEEP_INTERVAL:
+    Sweeper(BACKEND_STORAGE).start(app)
 
 
 if __name__ == '__main__':